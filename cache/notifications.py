@@ -0,0 +1,11 @@
+from redis.asyncio import Redis
+
+PROMPT_HANDLE_FINISHED = 'finished'
+
+
+def prompt_handle_channel(handle_id: int) -> str:
+    return f'prompt_handle_{handle_id}_notifications'
+
+
+async def notify_prompt_handle_finished(redis: Redis, handle_id: int):
+    await redis.publish(prompt_handle_channel(handle_id), PROMPT_HANDLE_FINISHED)
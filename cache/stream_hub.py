@@ -0,0 +1,132 @@
+"""
+A single redis subscriber per process, shared by all the websockets of the http api.
+
+Subscribing each websocket to its channel on its own pubsub takes one redis connection per websocket. The
+StreamHub instead subscribes one pubsub to the channels of all the websockets of the process, adding and
+removing channels as websockets come and go, and hands the messages of each channel to the subscriptions of
+that channel through an asyncio.Queue.
+"""
+
+from typing import AsyncGenerator, Dict, Optional, Set
+import asyncio
+import weakref
+
+from redis.asyncio import Redis
+
+import cache.redis
+from config.logger import log
+
+
+class Subscription:
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.queue = asyncio.Queue()
+
+    async def listen(self) -> AsyncGenerator[dict, None]:
+        """
+        Yield the messages published to the channel, in the same form as `redis.asyncio.client.PubSub.listen`,
+        until the subscription is unsubscribed.
+        """
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            yield message
+
+
+class StreamHub:
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self.pubsub = redis.pubsub()
+        self.subscriptions: Dict[str, Set[Subscription]] = {}
+        self.reader: Optional[asyncio.Task] = None
+        # keeps the channels subscribed to in redis in line with the registry
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        async with self.lock:
+            if channel not in self.subscriptions:
+                self.subscriptions[channel] = set()
+                await self.pubsub.subscribe(channel)
+            self.subscriptions[channel].add(subscription)
+            self._start_reader()
+
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription):
+        async with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+            if subscriptions is None:
+                return
+
+            subscriptions.discard(subscription)
+            subscription.queue.put_nowait(None)
+            if len(subscriptions) == 0:
+                del self.subscriptions[subscription.channel]
+                await self.pubsub.unsubscribe(subscription.channel)
+
+    async def aclose(self):
+        """
+        Stop reading from redis, end the subscriptions and close the pubsub and the connection of the hub.
+        """
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.queue.put_nowait(None)
+        self.subscriptions = {}
+
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+
+    def _start_reader(self):
+        # the pubsub stops listening once it's been unsubscribed from every channel, so the reader is
+        # started again by the next subscription
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for message in self.pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+
+                for subscription in self.subscriptions.get(message['channel'], ()):
+                    subscription.queue.put_nowait(message)
+        except Exception as e:
+            log().error(f"stream hub stopped reading from redis: {e}")
+
+
+# the pubsub and queues of a hub belong to the event loop they were created in, so a process running several
+# event loops one after another, like a job worker, gets a hub per loop, and has to close it with
+# close_stream_hub before the loop is done
+_stream_hubs: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, StreamHub]" = weakref.WeakKeyDictionary()
+
+
+async def get_stream_hub() -> StreamHub:
+    loop = asyncio.get_running_loop()
+    if loop not in _stream_hubs:
+        redis = await cache.redis.get_redis_connection()
+        if loop not in _stream_hubs:
+            _stream_hubs[loop] = StreamHub(redis)
+        else:
+            await redis.aclose()
+
+    return _stream_hubs[loop]
+
+
+async def close_stream_hub():
+    """
+    Close the hub of the running event loop, if it has one.
+    """
+    hub = _stream_hubs.pop(asyncio.get_running_loop(), None)
+    if hub is not None:
+        await hub.aclose()
@@ -0,0 +1,147 @@
+"""
+The frames in which llm workers publish the tokens of a prompt handle to redis.
+
+Every token is published to the channel of the handle as a json frame carrying a sequence number, starting at
+1, and the offset of its text in the whole response. The stream is ended by a frame with "end" set. The http
+api subscribes to the channel and forwards the text of every frame to the websocket of the requester, and the
+termination string once the stream has ended.
+
+Workers can also publish compact frames, which skip the json encoding. A compact frame is a control character
+(STX for text, ETX for the end of the stream) followed by the sequence number and offset separated by spaces,
+and then a space and the text.
+
+Every frame is also appended to a redis stream kept for `retention_seconds` after the latest frame, so that a
+requester that reconnects mid-generation can be sent the frames it missed, see `read_token_stream`.
+
+Workers that stream their tokens over a websocket to the http api instead publish plain text, which is
+forwarded as is.
+"""
+
+from typing import List, Optional
+import json
+
+from redis.asyncio import Redis
+
+TERMINATION_STRING = "<<<END_OF_STREAM>>>"
+
+COMPACT_TEXT_FRAME = '\x02'
+COMPACT_END_FRAME = '\x03'
+
+
+class TokenFrame:
+
+    def __init__(self, seq: int, text: str = '', end: bool = False, offset: int = 0):
+        self.seq = seq
+        self.text = text
+        self.end = end
+        self.offset = offset
+
+
+def token_stream_channel(websocket_uri: str) -> str:
+    # the channel the http api subscribes to for the websocket at the uri "/ws/{session_id}"
+    return websocket_uri.removeprefix('/ws/')
+
+
+def token_stream_key(websocket_uri: str) -> str:
+    return f'token_stream:{token_stream_channel(websocket_uri)}'
+
+
+def encode_frame(frame: TokenFrame, compact: bool = False) -> str:
+    if compact:
+        kind = COMPACT_END_FRAME if frame.end else COMPACT_TEXT_FRAME
+        return f'{kind}{frame.seq} {frame.offset} {frame.text}'
+
+    if frame.end:
+        return json.dumps({'seq': frame.seq, 'offset': frame.offset, 'end': True})
+    return json.dumps({'seq': frame.seq, 'offset': frame.offset, 'text': frame.text})
+
+
+def decode_frame(data: str) -> Optional[TokenFrame]:
+    """
+    Decode a message published to a token stream channel. Returns None if the message isn't a frame, but a
+    plain text token published on behalf of a worker that streams over a websocket.
+    """
+    if data[:1] in (COMPACT_TEXT_FRAME, COMPACT_END_FRAME):
+        return _decode_compact_frame(data)
+
+    if not data.startswith('{'):
+        return None
+
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return None
+
+    if not isinstance(payload, dict) or not isinstance(payload.get('seq'), int):
+        return None
+
+    return TokenFrame(payload['seq'], payload.get('text', ''), payload.get('end', False), payload.get('offset', 0))
+
+
+def _decode_compact_frame(data: str) -> Optional[TokenFrame]:
+    parts = data[1:].split(' ', 2)
+    if len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+
+    seq, offset, text = parts
+    return TokenFrame(int(seq), text, data[0] == COMPACT_END_FRAME, int(offset))
+
+
+async def read_token_stream(redis: Redis, websocket_uri: str) -> List[TokenFrame]:
+    """
+    Read the frames published to the token stream of the websocket so far, in order.
+    """
+    entries = await redis.xrange(token_stream_key(websocket_uri))
+    frames = [decode_frame(fields['frame']) for _, fields in entries]
+    return [frame for frame in frames if frame is not None]
+
+
+async def end_token_stream(redis: Redis, websocket_uri: str, compact: bool = False, retention_seconds: int = 300):
+    """
+    End the token stream of a websocket that its worker couldn't end, such as when generating the response
+    failed, so that the requester isn't left waiting. The end frame follows the last frame in the stream.
+    """
+    publisher = TokenStreamPublisher(redis, websocket_uri, compact, retention_seconds)
+
+    entries = await redis.xrevrange(token_stream_key(websocket_uri), count=1)
+    last_frame = decode_frame(entries[0][1]['frame']) if len(entries) > 0 else None
+    if last_frame is not None:
+        if last_frame.end:
+            return
+        publisher.seq = last_frame.seq
+        publisher.offset = last_frame.offset + len(last_frame.text)
+
+    await publisher.finish()
+
+
+class TokenStreamPublisher:
+
+    def __init__(self, redis: Redis, websocket_uri: str, compact: bool = False, retention_seconds: int = 300):
+        self.redis = redis
+        self.channel = token_stream_channel(websocket_uri)
+        self.key = token_stream_key(websocket_uri)
+        self.compact = compact
+        self.retention_seconds = retention_seconds
+        self.seq = 0
+        self.offset = 0
+
+    async def send(self, text: str):
+        await self._publish(TokenFrame(self.seq + 1, text, offset=self.offset))
+        self.offset += len(text)
+
+    async def finish(self):
+        await self._publish(TokenFrame(self.seq + 1, end=True, offset=self.offset))
+
+    async def _publish(self, frame: TokenFrame):
+        self.seq = frame.seq
+        data = encode_frame(frame, self.compact)
+
+        # appended before it's published, so that a requester reading the stream after subscribing to the
+        # channel sees every frame in at least one of them. The expiry is pushed back by every frame, so the
+        # stream of a long generation doesn't expire while it's still being written. The three commands are
+        # sent in a single round trip
+        async with self.redis.pipeline(transaction=False) as pipeline:
+            pipeline.xadd(self.key, {'frame': data})
+            pipeline.expire(self.key, self.retention_seconds)
+            pipeline.publish(self.channel, data)
+            await pipeline.execute()
@@ -10,6 +10,7 @@ from db.actions.course import find_course_by_canvas_id
 from services.chat.chat_service import ChatService
 from services.llm.supported_models import LLMModel
 from db.models import Chat, Message, Course, Faq
+from cache.stream_hub import close_stream_hub
 from services.llm.llm import LLMService
 from config.logger import log
 
@@ -153,8 +154,15 @@ async def main():
         log().info("saved new faq.")
 
 
+async def _main_and_close_stream_hub():
+    try:
+        await main()
+    finally:
+        await close_stream_hub()
+
+
 def sync_main():
-    asyncio.run(main())
+    asyncio.run(_main_and_close_stream_hub())
 
 
 if __name__ == '__main__':
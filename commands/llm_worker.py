@@ -1,4 +1,5 @@
 from os.path import basename
+from functools import partial
 import asyncio
 import socket
 import sys
@@ -10,10 +11,16 @@ import arrow
 
 from services.llm.supported_models import get_enum_from_enum_name, LLMModel, EMBEDDING_MODELS
 from llms.openai import load_openai_sdk, generate_text_streaming, compute_embedding
-from llms.embeddings import load_hf_embedding_model
+from llms.speculative import generate_text_streaming as generate_hf_text_streaming_speculatively
+from llms.generate import generate_text_streaming as generate_hf_text_streaming, load_hf_model
+from llms.openai import compute_embeddings as compute_openai_embeddings
+from llms.embeddings import load_hf_embedding_model, compute_embeddings
 from cache.redis import get_redis_connection
 from services.llm.llm import LLMService
-from services.llm.worker import Worker
+from services.llm.worker import Worker, BatchedWorker, ConcurrentWorker
+from services.llm.rate_limiter import RateLimiter
+from llms.batching import ContinuousBatchingEngine
+from llms.prefix_cache import PrefixCache
 import config.settings as settings
 from config.logger import log
 
@@ -100,6 +107,13 @@ async def _find_available_port(start_port: int = 1337):
     raise OSError("No available port found")
 
 
+def _create_openai_rate_limiter() -> RateLimiter:
+    return RateLimiter(
+        requests_per_minute=settings.get_settings().OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.get_settings().OPENAI_TOKENS_PER_MINUTE,
+    )
+
+
 async def worker_main():
     if len(sys.argv) != 3 or sys.argv[1] in ['-h', '--help']:
         print_help()
@@ -120,20 +134,27 @@ async def worker_main():
 
     service = LLMService(model_enum, await get_redis_connection())
 
+    quantization = settings.get_settings().LLM_WORKER_QUANTIZATION
+
     if model_enum in EMBEDDING_MODELS and model_enum is not LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE:
         worker = Worker(
             service,
             model_enum,
             device='cpu',
-            model_loader_func=load_hf_embedding_model,
+            model_loader_func=partial(load_hf_embedding_model, quantization=quantization),
+            batch_embedding_function=compute_embeddings,
         )
     elif model_enum is LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE:
-        worker = Worker(
+        worker = ConcurrentWorker(
             service,
             model_enum,
             device='python-api',
+            max_concurrent_requests=settings.get_settings().LLM_WORKER_MAX_CONCURRENT_REQUESTS,
+            rate_limiter=_create_openai_rate_limiter(),
             model_loader_func=load_openai_sdk,
-            embedding_function=compute_embedding
+            embedding_function=compute_embedding,
+            batch_embedding_function=compute_openai_embeddings,
+            embedding_batch_size=settings.get_settings().OPENAI_EMBEDDING_BATCH_SIZE,
         )
     elif model_enum is not LLMModel.OPENAI_GPT4:
         if not download_only:
@@ -141,12 +162,67 @@ async def worker_main():
         else:
             device_name = 'cpu'
 
-        worker = Worker(service, model_enum, device=device_name)
+        prefix_cache = None
+        prefix_cache_memory_mb = settings.get_settings().LLM_WORKER_PREFIX_CACHE_MEMORY_MB
+        if prefix_cache_memory_mb > 0:
+            log().info(f"caching the KV cache of prompt prefixes, using up to {prefix_cache_memory_mb} MB")
+            prefix_cache = PrefixCache(max_bytes=prefix_cache_memory_mb * 1024 * 1024)
+
+        prefill_chunk_size = settings.get_settings().LLM_WORKER_PREFILL_CHUNK_SIZE
+
+        max_batch_size = settings.get_settings().LLM_WORKER_MAX_BATCH_SIZE
+        if max_batch_size > 1:
+            log().info(f"using continuous batching with a max batch size of {max_batch_size}")
+            worker = BatchedWorker(
+                service,
+                model_enum,
+                device=device_name,
+                max_batch_size=max_batch_size,
+                model_loader_func=partial(load_hf_model, quantization=quantization),
+                engine_factory=partial(
+                    ContinuousBatchingEngine,
+                    prefix_cache=prefix_cache,
+                    prefill_chunk_size=prefill_chunk_size,
+                ),
+            )
+        elif settings.get_settings().LLM_WORKER_DRAFT_MODEL is not None:
+            draft_model_name = settings.get_settings().LLM_WORKER_DRAFT_MODEL
+            num_speculative_tokens = settings.get_settings().LLM_WORKER_SPECULATIVE_TOKENS
+            log().info(f"using speculative decoding with draft model {draft_model_name}, "
+                       f"proposing {num_speculative_tokens} tokens at a time")
+            draft_model, _ = load_hf_model(draft_model_name, device_name, quantization=quantization)
+            worker = Worker(
+                service,
+                model_enum,
+                device=device_name,
+                model_loader_func=partial(load_hf_model, quantization=quantization),
+                text_generator=partial(
+                    generate_hf_text_streaming_speculatively,
+                    draft_model=draft_model,
+                    num_speculative_tokens=num_speculative_tokens,
+                    prefix_cache=prefix_cache,
+                    prefill_chunk_size=prefill_chunk_size,
+                ),
+            )
+        else:
+            worker = Worker(
+                service,
+                model_enum,
+                device=device_name,
+                model_loader_func=partial(load_hf_model, quantization=quantization),
+                text_generator=partial(
+                    generate_hf_text_streaming,
+                    prefix_cache=prefix_cache,
+                    prefill_chunk_size=prefill_chunk_size,
+                ),
+            )
     else:
-        worker = Worker(
+        worker = ConcurrentWorker(
             service,
             model_enum,
             device='python-api',
+            max_concurrent_requests=settings.get_settings().LLM_WORKER_MAX_CONCURRENT_REQUESTS,
+            rate_limiter=_create_openai_rate_limiter(),
             model_loader_func=load_openai_sdk,
             text_generator=generate_text_streaming
         )
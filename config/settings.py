@@ -12,6 +12,21 @@ class Settings(BaseSettings):
     BACKEND_CORS_ORIGINS: List[HttpUrl] = []
     WEBSOCKET_TIMEOUT_DURATION: int = 30
     LLM_WORKER_SHUTDOWN_DELAY_SECONDS: int = 420
+    LLM_WORKER_MAX_BATCH_SIZE: int = 1
+    LLM_WORKER_EMBEDDING_BATCH_SIZE: int = 16
+    LLM_WORKER_EMBEDDING_CLAIM_SIZE: int = 64
+    LLM_WORKER_MAX_CONCURRENT_REQUESTS: int = 8
+    LLM_WORKER_PREFIX_CACHE_MEMORY_MB: int = 1024
+    LLM_WORKER_DRAFT_MODEL: Optional[str] = None
+    LLM_WORKER_SPECULATIVE_TOKENS: int = 4
+    LLM_WORKER_QUANTIZATION: Optional[str] = None
+    LLM_WORKER_PREFILL_CHUNK_SIZE: int = 512
+    LLM_WORKER_PUBLISH_TOKENS_TO_REDIS: bool = True
+    LLM_WORKER_TOKEN_FLUSH_INTERVAL_MS: int = 30
+    LLM_WORKER_TOKEN_FLUSH_CHARS: int = 64
+    LLM_WORKER_COMPACT_TOKEN_FRAMES: bool = False
+    LLM_WORKER_TOKEN_STREAM_RETENTION_SECONDS: int = 300
+    LLM_WORKER_CLAIM_TIMEOUT_SECONDS: int = 30 * 60
     COOKIE_IDENTIFIER: str
 
     QUEUE_WORKER_QUEUE_NAME: Optional[str] = None
@@ -21,6 +36,16 @@ class Settings(BaseSettings):
     CRAWLER_MODE_IS_HEADLESS: bool = True
     CANVAS_PROFILE_PAGE_VALIDATION_SEARCH_STRING: str
 
+    INDEX_UNCHANGED_CONTENT_BY_COPYING: bool = True
+    INDEX_MAX_CONCURRENT_EMBEDDING_WAITS: int = 16
+    EMBEDDING_CACHE_TTL_DAYS: int = 30
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 500000
+    ANSWER_CACHE_ENABLED: bool = False
+    ANSWER_CACHE_EMBEDDING_MODEL: str = "openai/text-embedding-3-large"
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.95
+    ANSWER_CACHE_MAX_CANDIDATES: int = 1000
+    FAQ_ANSWERS_PRECOMPUTE_ENABLED: bool = True
+
     POSTGRES_SERVER: str
     POSTGRES_PORT: str
     POSTGRES_USER: str
@@ -37,6 +62,10 @@ class Settings(BaseSettings):
 
     HUGGINGFACE_ACCESS_TOKEN: Optional[str] = None
     OPENAI_API_KEY: Optional[str] = None
+    OPENAI_REQUESTS_PER_MINUTE: int = 500
+    OPENAI_TOKENS_PER_MINUTE: int = 300000
+    OPENAI_MAX_RETRIES: int = 5
+    OPENAI_EMBEDDING_BATCH_SIZE: int = 256
 
     class Config:
         case_sensitive = True
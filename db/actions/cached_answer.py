@@ -0,0 +1,25 @@
+def find_finished_cached_answers(course, snapshot, llm_model_name, index_type, language: str, limit: int):
+    from db.models.cached_answer import CachedAnswer
+    from db.models.prompt_handle import PromptHandle
+    return CachedAnswer.select(CachedAnswer, PromptHandle).join(PromptHandle).filter(
+        CachedAnswer.course == course
+    ).filter(
+        CachedAnswer.snapshot == snapshot
+    ).filter(
+        CachedAnswer.llm_model_name == llm_model_name
+    ).filter(
+        CachedAnswer.index_type == index_type
+    ).filter(
+        CachedAnswer.language == language
+    ).filter(
+        PromptHandle.state == PromptHandle.States.FINISHED
+    ).order_by(
+        CachedAnswer.created_at.desc()
+    ).limit(limit)
+
+
+def delete_cached_answers_of_course_not_in_snapshot(course, snapshot) -> int:
+    from db.models.cached_answer import CachedAnswer
+    return CachedAnswer.delete().where(
+        (CachedAnswer.course == course) & (CachedAnswer.snapshot != snapshot)
+    ).execute()
@@ -0,0 +1,25 @@
+def find_cached_embedding(llm_model_name, sha: str):
+    from db.models.cached_embedding import CachedEmbedding
+    return CachedEmbedding.select().filter(
+        CachedEmbedding.llm_model_name == llm_model_name
+    ).filter(
+        CachedEmbedding.sha == sha
+    ).first()
+
+
+def delete_cached_embeddings_not_used_since(cutoff) -> int:
+    from db.models.cached_embedding import CachedEmbedding
+    return CachedEmbedding.delete().where(
+        CachedEmbedding.last_used_at < cutoff
+    ).execute()
+
+
+def delete_least_recently_used_cached_embeddings(keep: int) -> int:
+    from db.models.cached_embedding import CachedEmbedding
+    least_recently_used = CachedEmbedding.select(CachedEmbedding.id).order_by(
+        CachedEmbedding.last_used_at.desc()
+    ).offset(keep)
+
+    return CachedEmbedding.delete().where(
+        CachedEmbedding.id.in_(least_recently_used)
+    ).execute()
@@ -4,3 +4,8 @@ from peewee import fn
 def get_random_chat_config():
     from db.models.chat_config import ChatConfig
     return ChatConfig.select().where(ChatConfig.is_active == True).order_by(fn.Random()).first()  # noqa
+
+
+def get_active_chat_configs():
+    from db.models.chat_config import ChatConfig
+    return ChatConfig.select().where(ChatConfig.is_active == True)  # noqa
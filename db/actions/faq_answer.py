@@ -0,0 +1,53 @@
+def find_faq_answer(faq, snapshot, llm_model_name, index_type):
+    from db.models.faq_answer import FaqAnswer
+    from db.models.prompt_handle import PromptHandle
+    return FaqAnswer.select(FaqAnswer, PromptHandle).join(PromptHandle).filter(
+        FaqAnswer.faq == faq
+    ).filter(
+        FaqAnswer.snapshot == snapshot
+    ).filter(
+        FaqAnswer.llm_model_name == llm_model_name
+    ).filter(
+        FaqAnswer.index_type == index_type
+    ).filter(
+        PromptHandle.state != PromptHandle.States.FAILED
+    ).first()
+
+
+def find_finished_faq_answer(faq, snapshot, llm_model_name, index_type):
+    from db.models.faq_answer import FaqAnswer
+    from db.models.prompt_handle import PromptHandle
+    return FaqAnswer.select(FaqAnswer, PromptHandle).join(PromptHandle).filter(
+        FaqAnswer.faq == faq
+    ).filter(
+        FaqAnswer.snapshot == snapshot
+    ).filter(
+        FaqAnswer.llm_model_name == llm_model_name
+    ).filter(
+        FaqAnswer.index_type == index_type
+    ).filter(
+        PromptHandle.state == PromptHandle.States.FINISHED
+    ).first()
+
+
+def delete_faq_answers_of_course_not_in_snapshots(course, snapshot, faq_snapshot) -> int:
+    from db.models.faq_answer import FaqAnswer
+    from db.models.faq_snapshot import FaqSnapshot
+    from db.models.faq import Faq
+    faqs_of_course = Faq.select(Faq.id).join(FaqSnapshot).where(FaqSnapshot.course == course)
+    stale_faqs = Faq.select(Faq.id).where(Faq.snapshot != faq_snapshot)
+    return FaqAnswer.delete().where(
+        FaqAnswer.faq.in_(faqs_of_course) & ((FaqAnswer.snapshot != snapshot) | FaqAnswer.faq.in_(stale_faqs))
+    ).execute()
+
+
+def delete_failed_faq_answers_of_course(course) -> int:
+    from db.models.prompt_handle import PromptHandle
+    from db.models.faq_answer import FaqAnswer
+    from db.models.faq_snapshot import FaqSnapshot
+    from db.models.faq import Faq
+    faqs_of_course = Faq.select(Faq.id).join(FaqSnapshot).where(FaqSnapshot.course == course)
+    failed_handles = PromptHandle.select(PromptHandle.id).where(PromptHandle.state == PromptHandle.States.FAILED)
+    return FaqAnswer.delete().where(
+        FaqAnswer.faq.in_(faqs_of_course) & FaqAnswer.prompt_handle.in_(failed_handles)
+    ).execute()
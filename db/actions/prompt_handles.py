@@ -1,3 +1,7 @@
+from typing import List, Optional
+
+import arrow
+
 
 def find_prompt_handle_by_websocket_uri(uri: str):
     from db.models.prompt_handle import PromptHandle
@@ -13,3 +17,58 @@ def find_most_recent_pending_handle_for_model(model_name):
     ).order_by(
         PromptHandle.created_at.asc()
     ).first()
+
+
+def claim_pending_handles_for_model(model_name, limit: int = 1, stale_before: Optional[arrow.Arrow] = None) -> List:
+    """
+    Move up to `limit` of the oldest pending handles for the model into the in progress state, and return them.
+
+    The claim is a single UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED LIMIT n) RETURNING
+    statement, so any number of workers for the same model can claim handles at the same time without
+    waiting on each other or claiming the same handle twice. Databases without row locks (sqlite in the
+    test-suite) serialize writes anyway, so the subquery is used without the locking clause there.
+
+    Handles that were claimed before `stale_before`, and are still in progress, are claimed again, since the
+    worker that claimed them has most likely died without finishing them.
+    """
+    from db.models.prompt_handle import PromptHandle
+
+    claimable = PromptHandle.state == PromptHandle.States.PENDING
+    if stale_before is not None:
+        claimable |= (
+            (PromptHandle.state == PromptHandle.States.IN_PROGRESS) & (PromptHandle.modified_at < stale_before)
+        )
+
+    pending = PromptHandle.select(PromptHandle.id).filter(
+        claimable
+    ).filter(
+        PromptHandle.llm_model_name == model_name
+    ).order_by(
+        PromptHandle.created_at.asc()
+    ).limit(limit)
+
+    if PromptHandle._meta.database.for_update:
+        pending = pending.for_update('FOR UPDATE SKIP LOCKED')
+
+    claimed = PromptHandle.update(
+        state=PromptHandle.States.IN_PROGRESS,
+        modified_at=arrow.utcnow(),
+    ).where(
+        PromptHandle.id.in_(pending)
+    ).returning(PromptHandle).execute()
+
+    return sorted(claimed, key=lambda handle: (handle.created_at, handle.id))
+
+
+def fail_prompt_handle_if_pending(handle) -> bool:
+    """
+    Move the handle into the failed state, unless a worker has already claimed it. Returns whether it was moved.
+    """
+    from db.models.prompt_handle import PromptHandle
+    updated = PromptHandle.update(
+        state=PromptHandle.States.FAILED,
+        modified_at=arrow.utcnow(),
+    ).where(
+        (PromptHandle.id == handle.id) & (PromptHandle.state == PromptHandle.States.PENDING)
+    ).execute()
+    return updated > 0
@@ -46,3 +46,24 @@ def find_url_referencing_content_in_snapshot(snapshot, content):
     ).filter(
         Url.snapshot == snapshot
     ).first()
+
+
+def find_indexed_url_with_content_sha_in_other_snapshot(snapshot, sha: str):
+    from db.models.snapshot import Snapshot
+    from db.models.content import Content
+    from db.models.url import Url
+    return Url.select().join(
+        Content, on=(Url.content == Content.id)
+    ).switch(Url).join(
+        Snapshot, on=(Url.snapshot == Snapshot.id)
+    ).filter(
+        Snapshot.course == snapshot.course
+    ).filter(
+        Snapshot.id != snapshot.id
+    ).filter(
+        Url.state == Url.States.INDEXED
+    ).filter(
+        Content.sha == sha
+    ).order_by(
+        Snapshot.created_at.desc()
+    ).first()
@@ -0,0 +1,13 @@
+from peewee_migrate import Migrator
+import peewee as pw
+
+from db.models import CachedAnswer
+from db.connection import db
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    db.create_tables([CachedAnswer])
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    db.drop_tables([CachedAnswer])
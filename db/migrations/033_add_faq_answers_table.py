@@ -0,0 +1,13 @@
+from peewee_migrate import Migrator
+import peewee as pw
+
+from db.models import FaqAnswer
+from db.connection import db
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    db.create_tables([FaqAnswer])
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    db.drop_tables([FaqAnswer])
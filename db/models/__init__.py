@@ -15,6 +15,9 @@ from .faq import Faq
 from .message import Message
 from .feedback_question import FeedbackQuestion
 from .feedback import Feedback
+from .cached_embedding import CachedEmbedding
+from .cached_answer import CachedAnswer
+from .faq_answer import FaqAnswer
 
 all_models = [
     PromptHandle,
@@ -31,4 +34,7 @@ all_models = [
     Faq,
     FeedbackQuestion,
     Feedback,
+    CachedEmbedding,
+    CachedAnswer,
+    FaqAnswer,
 ]
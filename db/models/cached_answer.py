@@ -0,0 +1,31 @@
+import warnings
+
+import peewee
+
+from db.custom_fields import ModelNameField, IndexTypeField, EmbeddingField
+from . import BaseModel, Course, Snapshot, PromptHandle
+
+# Suppress specific DeprecationWarning about db_table, this is needed for migrations to work
+warnings.filterwarnings(
+    "ignore",
+    message='"db_table" has been deprecated in favor of "table_name" for Models.',
+    category=DeprecationWarning,
+    module='peewee'
+)
+
+
+class CachedAnswer(BaseModel):
+    class Meta:
+        db_table = 'cached_answers'
+        table_name = 'cached_answers'
+
+    id = peewee.AutoField()
+    course = peewee.ForeignKeyField(Course, null=False, backref='cached_answers', on_delete='CASCADE')
+    snapshot = peewee.ForeignKeyField(Snapshot, null=False, backref='cached_answers', on_delete='CASCADE')
+    llm_model_name = ModelNameField(null=False, index=True)
+    index_type = IndexTypeField(null=False, index=True)
+    language = peewee.CharField(null=False, max_length=4, default='en')
+    question = peewee.TextField(null=False)
+    embedding = EmbeddingField(null=False)
+    prompt_handle = peewee.ForeignKeyField(PromptHandle, null=False, backref='cached_answers', on_delete='CASCADE')
+    hits = peewee.IntegerField(null=False, default=0)
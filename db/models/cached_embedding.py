@@ -0,0 +1,39 @@
+import warnings
+import hashlib
+
+import peewee
+import arrow
+
+from db.custom_fields import ModelNameField, EmbeddingField, ArrowDateTimeField
+from . import BaseModel
+
+# Suppress specific DeprecationWarning about db_table, this is needed for migrations to work
+warnings.filterwarnings(
+    "ignore",
+    message='"db_table" has been deprecated in favor of "table_name" for Models.',
+    category=DeprecationWarning,
+    module='peewee'
+)
+
+
+class CachedEmbedding(BaseModel):
+    class Meta:
+        db_table = 'cached_embeddings'
+        table_name = 'cached_embeddings'
+        indexes = (
+            (('llm_model_name', 'sha'), True),
+        )
+
+    id = peewee.AutoField()
+    llm_model_name = ModelNameField(null=False, index=True)
+    sha = peewee.CharField(null=False, index=True)
+    embedding = EmbeddingField(null=False)
+    last_used_at = ArrowDateTimeField(null=False, index=True, default=arrow.utcnow)
+    hits = peewee.IntegerField(null=False, default=0)
+
+    @staticmethod
+    def make_sha(text: str):
+        if text is None:
+            raise ValueError("cannot generate sha if text is not defined")
+
+        return hashlib.sha256(str(text).encode('utf-8')).hexdigest()
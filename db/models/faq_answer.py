@@ -0,0 +1,30 @@
+import warnings
+
+import peewee
+
+from db.custom_fields import ModelNameField, IndexTypeField
+from . import BaseModel, Faq, Snapshot, PromptHandle
+
+# Suppress specific DeprecationWarning about db_table, this is needed for migrations to work
+warnings.filterwarnings(
+    "ignore",
+    message='"db_table" has been deprecated in favor of "table_name" for Models.',
+    category=DeprecationWarning,
+    module='peewee'
+)
+
+
+class FaqAnswer(BaseModel):
+    class Meta:
+        db_table = 'faq_answers'
+        table_name = 'faq_answers'
+        indexes = (
+            (('faq', 'snapshot', 'llm_model_name', 'index_type'), True),
+        )
+
+    id = peewee.AutoField()
+    faq = peewee.ForeignKeyField(Faq, null=False, backref='answers', on_delete='CASCADE')
+    snapshot = peewee.ForeignKeyField(Snapshot, null=False, backref='faq_answers', on_delete='CASCADE')
+    llm_model_name = ModelNameField(null=False, index=True)
+    index_type = IndexTypeField(null=False, index=True)
+    prompt_handle = peewee.ForeignKeyField(PromptHandle, null=False, backref='faq_answers', on_delete='CASCADE')
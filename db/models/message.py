@@ -35,9 +35,11 @@ class Message(BaseModel):
           of the message is being streamed into the chat
         - a message is pending if the system is gathering data to generate the message,
           such as gathering data from an index
+        - a message has failed if generating it failed, it will never be ready
         """
         READY = 'ready'
         PENDING = 'pending'
+        FAILED = 'failed'
 
     id = peewee.AutoField()
     message_id = peewee.CharField(null=False, index=True, unique=True, default=generate_public_id)
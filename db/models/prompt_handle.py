@@ -31,6 +31,7 @@ class PromptHandle(BaseModel):
         PENDING = 'pending'
         FINISHED = 'finished'
         IN_PROGRESS = 'in_progress'
+        FAILED = 'failed'
 
     id = peewee.AutoField()
     state = peewee.CharField(null=False, index=True, default=States.PENDING)
@@ -0,0 +1,53 @@
+"""
+The purpose of this example is to compare the time spent selecting the next token with the fused sampling
+in `llms.sampling_strategies.sample_tokens` against the original, one sequence at a time, sampling functions.
+
+Run it with an optional vocabulary size and batch size, e.g. `python examples/benchmark_sampling.py 32000 8`.
+"""
+
+import time
+import sys
+
+import torch
+
+from llms.sampling_strategies import sample_tokens, top_k_sampling, top_p_sampling, top_k_and_p_sampling
+
+ITERATIONS = 200
+
+
+def benchmark(name: str, func):
+    func()  # warm up
+    started_at = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = time.perf_counter() - started_at
+    print(f'{name:<40} {elapsed / ITERATIONS * 1000:8.3f} ms per step')
+
+
+def main():
+    vocabulary_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    k = 50
+    p = 0.7
+
+    torch.manual_seed(0)
+    logits = torch.randn(batch_size, vocabulary_size)
+
+    print(f'vocabulary size {vocabulary_size}, batch size {batch_size}, k={k}, p={p}')
+
+    benchmark('top_k_sampling', lambda: [top_k_sampling(row, k) for row in logits])
+    benchmark('top_p_sampling', lambda: [top_p_sampling(row.clone(), p) for row in logits])
+    benchmark('top_k_and_p_sampling', lambda: [top_k_and_p_sampling(row, k, p) for row in logits])
+
+    temperatures = [0.7] * batch_size
+    top_k = [k] * batch_size
+    top_p = [p] * batch_size
+    no_top_k = [0] * batch_size
+    no_top_p = [1.0] * batch_size
+    benchmark('sample_tokens, top-k', lambda: sample_tokens(logits, temperatures, top_k, no_top_p))
+    benchmark('sample_tokens, top-p', lambda: sample_tokens(logits, temperatures, no_top_k, top_p))
+    benchmark('sample_tokens, top-k and top-p', lambda: sample_tokens(logits, temperatures, top_k, top_p))
+
+
+if __name__ == '__main__':
+    main()
@@ -37,7 +37,9 @@ export const MESSAGE_PENDING = "pending";
 
 export const MESSAGE_READY = "ready";
 
-export type MessageState = typeof MESSAGE_READY | typeof MESSAGE_PENDING;
+export const MESSAGE_FAILED = "failed";
+
+export type MessageState = typeof MESSAGE_READY | typeof MESSAGE_PENDING | typeof MESSAGE_FAILED;
 
 export interface Message {
   message_id: string;
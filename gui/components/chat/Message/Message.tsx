@@ -7,7 +7,7 @@ import React, { useEffect, useRef, useState } from "react";
 
 import { Feedback } from "@/components/chat";
 
-import { MESSAGE_PENDING, MESSAGE_READY, Message as MessageType, fetchMessage } from "@/api/chat";
+import { MESSAGE_FAILED, MESSAGE_PENDING, MESSAGE_READY, Message as MessageType, fetchMessage } from "@/api/chat";
 import { makeWebsocketUrl } from "@/api/http";
 import { TERMINATION_STRING } from "@/api/websocket";
 
@@ -16,6 +16,9 @@ import styles from "./styles.module.css";
 // 10 minutes
 const REFETCH_TIMEOUT = 1000 * 60 * 10;
 
+const MAX_RECONNECT_ATTEMPTS = 5;
+const RECONNECT_DELAY = 500;
+
 const markdownLinkPattern = /\[([^\]]+)\]\(([^)]+)\)/g;
 const markdownBoldPattern = /\*\*([^*]+)\*\*/g;
 const markdownCodePattern = /`([^`]+)`/g;
@@ -78,29 +81,14 @@ export default function Message(props: MessageProps) {
     if (message.streaming && message.websocket && !wsInitialized.current) {
       wsInitialized.current = true;
       setShowLoading(true);
-      const ws = new WebSocket(makeWebsocketUrl(message.websocket));
-      ws.onmessage = (event) => {
-        if (event.data === TERMINATION_STRING) {
-          setShowLoading(false);
-          ws.close();
-          return;
-        }
-        setDisplayedContent((prevContent) => {
-          let newContent = prevContent + event.data;
-          newContent = newContent.replace(/\n/g, "<br>");
-          newContent = newContent.replace(
-            markdownLinkPattern,
-            (match, p1, p2) => `<a href="${p2}" target="_blank">${p1}</a>`,
-          );
-          newContent = newContent.replace(markdownBoldPattern, (match, p1) => `<strong>${p1}</strong>`);
-          newContent = newContent.replace(markdownCodePattern, (match, p1) => `<code>${p1}</code>`);
-
-          setNumberOfWords(newContent.split(" ").length);
-          return newContent;
-        });
-      };
-      ws.onclose = () => {
-        console.log("WebSocket closed");
+      // the number of characters received, in code points, to resume the stream from if the websocket drops
+      let receivedLength = 0;
+      let reconnectAttempts = 0;
+      let streamEnded = false;
+      let disposed = false;
+      let ws: WebSocket;
+
+      const finishStreaming = () => {
         setShowLoading(false);
         wsInitialized.current = false;
 
@@ -108,17 +96,49 @@ export default function Message(props: MessageProps) {
           queryKey: ["messages", courseId, chatId],
         });
       };
-      ws.onerror = (error) => {
-        console.log("WebSocket error:", error);
-        setShowLoading(false);
-        wsInitialized.current = false;
 
-        queryClient.invalidateQueries({
-          queryKey: ["messages", courseId, chatId],
-        });
+      const connect = () => {
+        ws = new WebSocket(makeWebsocketUrl(`${message.websocket}?offset=${receivedLength}`));
+        ws.onmessage = (event) => {
+          if (event.data === TERMINATION_STRING) {
+            streamEnded = true;
+            setShowLoading(false);
+            ws.close();
+            return;
+          }
+          receivedLength += Array.from(event.data as string).length;
+          reconnectAttempts = 0;
+          setDisplayedContent((prevContent) => {
+            let newContent = prevContent + event.data;
+            newContent = newContent.replace(/\n/g, "<br>");
+            newContent = newContent.replace(
+              markdownLinkPattern,
+              (match, p1, p2) => `<a href="${p2}" target="_blank">${p1}</a>`,
+            );
+            newContent = newContent.replace(markdownBoldPattern, (match, p1) => `<strong>${p1}</strong>`);
+            newContent = newContent.replace(markdownCodePattern, (match, p1) => `<code>${p1}</code>`);
+
+            setNumberOfWords(newContent.split(" ").length);
+            return newContent;
+          });
+        };
+        ws.onclose = () => {
+          console.log("WebSocket closed");
+          if (!streamEnded && !disposed && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+            reconnectAttempts += 1;
+            setTimeout(connect, RECONNECT_DELAY * reconnectAttempts);
+            return;
+          }
+          finishStreaming();
+        };
+        ws.onerror = (error) => {
+          console.log("WebSocket error:", error);
+        };
       };
+      connect();
 
       return () => {
+        disposed = true;
         if (ws.readyState === WebSocket.OPEN) {
           ws.close();
         }
@@ -174,7 +194,7 @@ export default function Message(props: MessageProps) {
                 </span>
               </SimpleGrid>
             )}
-            {message.state === MESSAGE_PENDING && !shouldRefetch && (
+            {((message.state === MESSAGE_PENDING && !shouldRefetch) || message.state === MESSAGE_FAILED) && (
               <Alert
                 className={styles.error}
                 variant="light"
@@ -1,7 +1,11 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI
 
-from jobs.schedule import schedule_job_start_crawler_worker, schedule_job_capture_snapshots
+from jobs.schedule import (
+    schedule_job_precompute_faq_answers,
+    schedule_job_start_crawler_worker,
+    schedule_job_capture_snapshots,
+)
 import config.settings as settings
 from http_api.routers import (
     websocket,
@@ -45,6 +49,10 @@ def main():
     log().info("starting 1 snapshot worker")
     schedule_job_capture_snapshots(1, True)
 
+    if settings.get_settings().FAQ_ANSWERS_PRECOMPUTE_ENABLED:
+        log().info("starting faq answers worker")
+        schedule_job_precompute_faq_answers(1)
+
     log().info(f"starting {num_crawler_workers} crawler workers")
     schedule_job_start_crawler_worker(1, True)
     for i in range(num_crawler_workers - 1):
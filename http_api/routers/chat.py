@@ -300,6 +300,7 @@ async def get_messages(
         streaming = False
         websocket = None
         content = msg.content
+        state = msg.state
         if msg.prompt_handle:
             if msg.prompt_handle.state == PromptHandle.States.PENDING:
                 streaming = True
@@ -313,6 +314,11 @@ async def get_messages(
                 streaming = False
                 websocket = None
                 content = msg.prompt_handle.response
+            elif msg.prompt_handle.state == PromptHandle.States.FAILED:
+                streaming = False
+                websocket = None
+                content = None
+                state = Message.States.FAILED
 
         feedback_id = None
         if msg.sender == Message.Sender.FEEDBACK:
@@ -328,7 +334,7 @@ async def get_messages(
             message_id=msg.message_id,
             content=content,
             sender=msg.sender,
-            state=msg.state,
+            state=state,
             created_at=str(msg.created_at),
             streaming=streaming,
             websocket=websocket,
@@ -376,6 +382,7 @@ async def get_message(
     streaming = False
     websocket = None
     content = msg.content
+    state = msg.state
     if msg.prompt_handle:
         if msg.prompt_handle.state == PromptHandle.States.PENDING:
             streaming = True
@@ -389,6 +396,11 @@ async def get_message(
             streaming = False
             websocket = None
             content = msg.prompt_handle.response
+        elif msg.prompt_handle.state == PromptHandle.States.FAILED:
+            streaming = False
+            websocket = None
+            content = None
+            state = Message.States.FAILED
 
     feedback_id = None
     if msg.sender == Message.Sender.FEEDBACK:
@@ -404,7 +416,7 @@ async def get_message(
         message_id=msg.message_id,
         content=content,
         sender=msg.sender,
-        state=msg.state,
+        state=state,
         created_at=str(msg.created_at),
         streaming=streaming,
         websocket=websocket,
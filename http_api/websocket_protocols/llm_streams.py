@@ -1,12 +1,15 @@
+from typing import Optional
 import asyncio
+import heapq
 import uuid
 
 from starlette.websockets import WebSocketDisconnect
-from redis.asyncio.client import PubSub
 from redis.asyncio import Redis
 from fastapi import WebSocket
 import arrow
 
+from cache.token_streams import decode_frame, read_token_stream, TERMINATION_STRING
+from cache.stream_hub import StreamHub, Subscription
 import config.settings as settings
 from config.logger import log
 
@@ -14,7 +17,8 @@ from config.logger import log
 async def handle_websocket_connection_between_worker_and_requester(
         websocket: WebSocket,
         session_id: str,
-        redis: Redis
+        hub: StreamHub,
+        resume_offset: int = 0
 ):
     """
     Handle the communication between workers and requesters over a websocket.
@@ -23,13 +27,18 @@ async def handle_websocket_connection_between_worker_and_requester(
     i.e. one requester is listening on the websocket to messages sent by one worker.
     There is no enforcement of this in the protocol below.
 
+    Requesters are first sent the text the worker published before they connected, so that a requester that
+    reconnects mid-generation can pick up where it left off, and then the text published from there on.
+
     :param websocket: The websocket over which the communication happens
     :param session_id: The id of the session. Given a websocket uri "/ws/{session_id}"
-    :param redis: A redis connection to push and read messages from.
+    :param hub: The stream hub of the process, to read messages from, and whose redis connection to push
+                messages to.
+    :param resume_offset: The number of characters of the response the requester has already received.
     :return: None
     """
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(session_id)
+    redis = hub.redis
+    subscription = await hub.subscribe(session_id)
 
     websocket_session = {
         'id': uuid.uuid4(),
@@ -37,34 +46,91 @@ async def handle_websocket_connection_between_worker_and_requester(
         'last_activity_time': arrow.now(),
         'write_only': False,  # write-only sessions are for llm workers
         'closed': False,
-        'tokens_transmitted': 0
+        'tokens_transmitted': 0,
+        'last_seq': 0,
     }
 
     try:
+        if await replay_token_stream(redis, websocket, session_id, websocket_session, resume_offset):
+            return
+
+        websocket_timeouts.track(websocket, websocket_session, settings.get_settings().WEBSOCKET_TIMEOUT_DURATION)
         await asyncio.gather(
-            listen_to_redis(pubsub, websocket, websocket_session),
+            listen_to_redis(subscription, websocket, websocket_session),
             listen_to_websocket(websocket, redis, session_id, websocket_session),
-            check_timeout(websocket, websocket_session, settings.get_settings().WEBSOCKET_TIMEOUT_DURATION),
         )
     except WebSocketDisconnect:
         log().debug(f"[websocket_id:{websocket_session['id']}] client disconnected from websocket.")
         await close_websocket(websocket, websocket_session)
     finally:
-        await pubsub.unsubscribe(session_id)
-        await redis.close()
+        websocket_timeouts.untrack(websocket_session)
+        await hub.unsubscribe(subscription)
         await close_websocket(websocket, websocket_session)
 
 
-async def listen_to_redis(pubsub: PubSub, websocket: WebSocket, websocket_session: dict):
-    async for message in pubsub.listen():
+async def replay_token_stream(
+        redis: Redis,
+        websocket: WebSocket,
+        session_id: str,
+        websocket_session: dict,
+        resume_offset: int = 0
+) -> bool:
+    """
+    Send the text of the frames published to the token stream so far, skipping the first `resume_offset`
+    characters. Returns True if the stream has already ended.
+    """
+    for frame in await read_token_stream(redis, f'/ws/{session_id}'):
+        websocket_session['last_seq'] = frame.seq
+        if frame.end:
+            await websocket.send_text(TERMINATION_STRING)
+            return True
+
+        text = frame.text[max(0, resume_offset - frame.offset):]
+        if text:
+            await websocket.send_text(text)
+            websocket_session['tokens_transmitted'] += 1
+
+    if websocket_session['last_seq'] > 0:
+        log().debug(f"[websocket_id:{websocket_session['id']}] replayed {websocket_session['last_seq']} frames "
+                    f"of the token stream from offset {resume_offset}.")
+    return False
+
+
+async def listen_to_redis(subscription: Subscription, websocket: WebSocket, websocket_session: dict):
+    async for message in subscription.listen():
         if message['type'] == 'message':
             if not websocket_session['write_only']:
-                await websocket.send_text(message['data'])
-                websocket_session['tokens_transmitted'] += 1
+                text = _text_of_message(message['data'], websocket_session)
+                if text is not None:
+                    await websocket.send_text(text)
+                    websocket_session['tokens_transmitted'] += 1
 
             websocket_session['last_activity_time'] = arrow.now()
 
 
+def _text_of_message(data: str, websocket_session: dict) -> Optional[str]:
+    """
+    Workers that publish their tokens to redis directly publish them as frames (see cache.token_streams),
+    while the tokens of workers streaming over a websocket are published as plain text. Returns None for
+    frames that were already sent when the token stream was replayed.
+    """
+    frame = decode_frame(data)
+    if frame is None:
+        return data
+
+    if frame.seq <= websocket_session['last_seq']:
+        return None
+
+    if frame.seq != websocket_session['last_seq'] + 1:
+        log().warning(f"[websocket_id:{websocket_session['id']}] expected frame {websocket_session['last_seq'] + 1} "
+                      f"of the token stream but received frame {frame.seq}.")
+    websocket_session['last_seq'] = frame.seq
+
+    if frame.end:
+        return TERMINATION_STRING
+    return frame.text
+
+
 async def listen_to_websocket(websocket: WebSocket, redis, session_id: str, websocket_session: dict):
     while True:
         data = await websocket.receive_text()
@@ -80,31 +146,115 @@ async def listen_to_websocket(websocket: WebSocket, redis, session_id: str, webs
         websocket_session['last_activity_time'] = arrow.now()
 
 
-async def check_timeout(websocket: WebSocket, websocket_session: dict, timeout_duration=30):
-    while True:
-        await asyncio.sleep(1)
+class WebsocketTimeouts:
+    """
+    Closes the websockets that have been inactive for longer than their timeout.
+
+    The deadlines of all the websockets of the process are kept in a heap, and a single task sleeps until
+    the earliest one. Activity only updates the last activity time of a websocket, so when a deadline is
+    reached, the websocket is checked again and, if it has been active since, pushed back with a new deadline.
+    Waking up therefore only costs as much as the number of deadlines that have passed.
+    """
+
+    def __init__(self, report_interval_seconds: int = 60):
+        self.report_interval_seconds = report_interval_seconds
+        self.websockets = {}
+        self.deadlines = []
+        # the event and the task belong to the event loop they're created in, so they're only created
+        # once a websocket is tracked, and created again if websockets are tracked in another loop
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.number_of_timeouts = 0
+        self.number_of_closed = 0
+
+    def track(self, websocket: WebSocket, websocket_session: dict, timeout_duration: int = 30):
+        self._start()
+        self.websockets[websocket_session['id']] = (websocket, websocket_session, timeout_duration)
+        self._push(websocket_session['id'], websocket_session['last_activity_time'].timestamp() + timeout_duration)
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # the websockets of the previous loop went away with it
+            self.loop = loop
+            self.wakeup = asyncio.Event()
+            self.task = None
+            self.websockets = {}
+            self.deadlines = []
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def untrack(self, websocket_session: dict):
+        # the deadline is left in the heap, and dropped once it's reached
+        if self.websockets.pop(websocket_session['id'], None) is not None:
+            self.number_of_closed += 1
+
+    def _push(self, websocket_id: uuid.UUID, deadline: float):
+        if len(self.deadlines) == 0 or deadline < self.deadlines[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.deadlines, (deadline, websocket_id))
+
+    async def _run(self):
+        next_report_at = arrow.now().timestamp() + self.report_interval_seconds
+        while True:
+            now = arrow.now().timestamp()
+            if now >= next_report_at:
+                self._report()
+                next_report_at = now + self.report_interval_seconds
+
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                _, websocket_id = heapq.heappop(self.deadlines)
+                if websocket_id in self.websockets:
+                    await self._check(*self.websockets[websocket_id])
+
+            next_wakeup_at = next_report_at
+            if len(self.deadlines) > 0:
+                next_wakeup_at = min(next_wakeup_at, self.deadlines[0][0])
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(next_wakeup_at - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, websocket: WebSocket, websocket_session: dict, timeout_duration: int):
         if websocket_session['closed']:
-            return await close_websocket(websocket, websocket_session)
+            self.untrack(websocket_session)
+            return
 
-        log().debug(f"[websocket_id:{websocket_session['id']}] Transmitted "
-                    f"{websocket_session['tokens_transmitted']} tokens over websocket.")
+        last_activity_time = websocket_session['last_activity_time'].timestamp()
+        if arrow.now().timestamp() - last_activity_time < timeout_duration:
+            self._push(websocket_session['id'], last_activity_time + timeout_duration)
+            return
 
-        elapsed_time = (arrow.now() - websocket_session['last_activity_time']).total_seconds()
-        log().debug(f"[websocket_id:{websocket_session['id']}] Checking timeout: {elapsed_time} "
-                    f"seconds elapsed since last activity.")
+        # a requester that reconnected after it had already received every frame has seen no tokens on this
+        # websocket, but has been replayed frames, so a worker did pick up its prompt handle
+        waiting_for_worker = websocket_session['tokens_transmitted'] == 0 and websocket_session['last_seq'] == 0
+        if waiting_for_worker and not websocket_session['write_only']:
+            # no worker has picked up the prompt handle yet, the requester waits for as long as that takes
+            self._push(websocket_session['id'], arrow.now().timestamp() + timeout_duration)
+            return
 
-        if websocket_session['tokens_transmitted'] == 0 and not websocket_session['write_only']:
-            log().info(f"[websocket_id:{websocket_session['id']}] Ignoring timout since no tokens have been "
-                       f"transmitted and this is not a write only thread. No worker has picked-up the prompt handle. "
-                       f"Waiting for next token.")
-            continue
+        log().info(f"[websocket_id:{websocket_session['id']}] Timeout detected. Closing "
+                   f"WebSocket due to inactivity.")
+        self.number_of_timeouts += 1
+        self.untrack(websocket_session)
+        await close_websocket(websocket, websocket_session)
 
-        if elapsed_time > timeout_duration:
-            log().info(f"[websocket_id:{websocket_session['id']}] Timeout detected. Closing "
-                       f"WebSocket due to inactivity.")
-            await close_websocket(websocket, websocket_session)
+    def _report(self):
+        if len(self.websockets) == 0 and self.number_of_closed == 0:
             return
 
+        log().info(f"{len(self.websockets)} websockets open, {self.number_of_closed} closed and "
+                   f"{self.number_of_timeouts} timed out in the last {self.report_interval_seconds} seconds.")
+        self.number_of_closed = 0
+        self.number_of_timeouts = 0
+
+
+websocket_timeouts = WebsocketTimeouts()
+
 
 async def close_websocket(websocket: WebSocket, websocket_session: dict):
     try:
@@ -1,6 +1,7 @@
 from peewee import DoesNotExist
 
 from services.index.index import IndexService
+from cache.stream_hub import close_stream_hub
 from config.logger import log
 from db.models import Url
 
@@ -23,3 +24,6 @@ async def job(url: Url):
         log().error(f"failed indexing url: {url.href} for snapshot {url.snapshot} no longer exists in the database")
     except Exception:  # noqa
         log().error(f"failed indexing url: {url.href}", exc_info=True)
+    finally:
+        # every job runs in an event loop of its own
+        await close_stream_hub()
@@ -0,0 +1,23 @@
+from services.chat.faq_answers import precompute_faq_answers
+from db.actions.chat_config import get_active_chat_configs
+from cache.stream_hub import close_stream_hub
+from db.models import Course
+
+# 30 minute timeout
+TIMEOUT = 30 * 60
+
+
+def start_job_again_in(seconds: int):
+    from jobs.schedule import schedule_job_precompute_faq_answers
+    schedule_job_precompute_faq_answers(seconds)
+
+
+async def job():
+    try:
+        chat_configs = list(get_active_chat_configs())
+        for course in Course.select():
+            await precompute_faq_answers(course, chat_configs)
+    finally:
+        # every job runs in an event loop of its own
+        await close_stream_hub()
+        start_job_again_in(5 * 60)
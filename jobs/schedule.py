@@ -2,8 +2,10 @@ from datetime import timedelta
 
 from redis.exceptions import ConnectionError
 
+from jobs.faq.precompute_faq_answers import TIMEOUT as PRECOMPUTE_FAQ_ANSWERS_TIMEOUT
 from jobs.crawl.start_crawler_worker import TIMEOUT as START_CRAWLER_WORKER_TIMEOUT
 from jobs.snapshot.capture_snapshots import TIMEOUT as CAPTURE_SNAPSHOTS_TIMEOUT
+from jobs.faq.precompute_faq_answers import job as precompute_faq_answers
 from jobs.crawl.start_crawler_worker import job as start_crawler_worker
 from jobs.snapshot.capture_snapshots import job as capture_snapshots
 from jobs.queues import get_crawler_queue, get_snapshots_queue
@@ -43,3 +45,17 @@ def schedule_job_capture_snapshots(start_in_seconds: int, should_empty: bool = F
         q.enqueue_in(timedelta(seconds=start_in_seconds), capture_snapshots, job_timeout=CAPTURE_SNAPSHOTS_TIMEOUT)
     except ConnectionError:
         log().error("failed to connect to redis, couldn't schedule capture_snapshots job")
+
+
+def schedule_job_precompute_faq_answers(start_in_seconds: int):
+    # runs on the snapshots queue, which is emptied when the capture_snapshots job is scheduled on startup
+    try:
+        redis = get_redis_connection_sync()
+        q = get_snapshots_queue(redis)
+        q.enqueue_in(
+            timedelta(seconds=start_in_seconds),
+            precompute_faq_answers,
+            job_timeout=PRECOMPUTE_FAQ_ANSWERS_TIMEOUT
+        )
+    except ConnectionError:
+        log().error("failed to connect to redis, couldn't schedule precompute_faq_answers job")
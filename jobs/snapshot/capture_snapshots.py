@@ -1,4 +1,6 @@
 from db.actions.snapshot import find_latest_snapshot_for_course
+from services.index.embedding_cache import evict_cached_embeddings
+from services.chat.answer_cache import evict_cached_answers
 from services.crawler.crawler import CrawlerService
 from config.logger import log
 from db.models import Course
@@ -24,5 +26,9 @@ async def job():
             if CrawlerService.snapshot_expired(snapshot, course):
                 log().info(f"last snapshot for course {course.canvas_id} expired, creating new snapshot.")
                 CrawlerService.create_snapshot(course)
+
+            evict_cached_answers(course)
+
+        evict_cached_embeddings()
     finally:
         start_job_again_in(60)
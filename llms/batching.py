@@ -0,0 +1,221 @@
+"""
+Continuous batching for text generation with huggingface models.
+
+Instead of decoding one prompt at a time, the engine keeps a batch of running sequences and advances all of
+them by one token per step. New sequences can be admitted between any two steps, and each sequence is retired
+as soon as it hits the eos token, one of its stop strings or its token limit, so a long answer never holds up
+the short ones running next to it.
+
+Each sequence owns its own KV cache. Before a decoding step the caches of the running sequences are left-padded
+to the same length and stacked into a single batch, and after the step they are split up again. This keeps
+admission and retirement of sequences trivial, at the cost of copying the caches once per step.
+"""
+
+from typing import Dict, List, Any, Optional
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+import torch.nn.functional as F
+import torch
+
+from .generate import _initialize_prompt, _select_token, select_tokens, should_stop_generating
+from .detokenizer import IncrementalDetokenizer, StopStringMatcher
+from .prefix_cache import PrefixCache, ChunkedPrefill
+from .config import Params
+
+
+class Sequence:
+
+    def __init__(self, sequence_id: Any, params: Params, input_ids: List[int], tokenizer: AutoTokenizer):
+        self.sequence_id = sequence_id
+        self.params = params
+        self.input_ids = input_ids
+        self.output_token_ids = []
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.stop_string_matcher = StopStringMatcher(params.stop_strings)
+        self.past_key_values = None
+        self.chunked_prefill = None
+        self.finished = False
+
+    @property
+    def cache_length(self) -> int:
+        return self.past_key_values[0][0].shape[2]
+
+
+class SequenceOutput:
+
+    def __init__(self, sequence_id: Any, text: str, finished: bool):
+        self.sequence_id = sequence_id
+        self.text = text
+        self.finished = finished
+
+
+class ContinuousBatchingEngine:
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        tokenizer: AutoTokenizer,
+        device: str,
+        max_batch_size: int = 8,
+        prefix_cache: Optional[PrefixCache] = None,
+        prefill_chunk_size: Optional[int] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+        self.waiting: List[Sequence] = []
+        self.running: List[Sequence] = []
+
+    def add_sequence(self, sequence_id: Any, params: Params, prompt: str):
+        input_ids = _initialize_prompt(self.tokenizer, params, prompt)
+        self.waiting.append(Sequence(sequence_id, params, input_ids, self.tokenizer))
+
+    def retire_sequence(self, sequence_id: Any):
+        self.waiting = [sequence for sequence in self.waiting if sequence.sequence_id != sequence_id]
+        self.running = [sequence for sequence in self.running if sequence.sequence_id != sequence_id]
+
+    def free_slots(self) -> int:
+        return max(0, self.max_batch_size - len(self.waiting) - len(self.running))
+
+    def has_capacity(self) -> bool:
+        return self.free_slots() > 0
+
+    def has_unfinished_sequences(self) -> bool:
+        return len(self.waiting) + len(self.running) > 0
+
+    def step(self) -> List[SequenceOutput]:
+        """
+        Advance every running sequence by one token, then prefill the next slice of the prompt of every sequence
+        waiting for admission. A sequence is admitted into the running batch once its whole prompt has been
+        prefilled, which produces its first token. Returns the newly generated text of every sequence that was
+        advanced or admitted.
+        """
+        outputs = []
+        admitted = []
+        with torch.no_grad():
+            if len(self.running) > 0:
+                outputs += self._decode(self.running)
+
+            waiting = []
+            for sequence in self.waiting:
+                output = self._prefill(sequence)
+                if output is None:
+                    waiting.append(sequence)
+                    continue
+                outputs.append(output)
+                admitted.append(sequence)
+            self.waiting = waiting
+
+        self.running = [sequence for sequence in self.running + admitted if not sequence.finished]
+        return outputs
+
+    def _prefill(self, sequence: Sequence) -> Optional[SequenceOutput]:
+        if sequence.chunked_prefill is None:
+            sequence.chunked_prefill = ChunkedPrefill(
+                self.model,
+                sequence.input_ids,
+                self.device,
+                self.prefix_cache,
+                self.prefill_chunk_size,
+            )
+
+        if not sequence.chunked_prefill.step():
+            return None
+
+        out = sequence.chunked_prefill.output
+        sequence.chunked_prefill = None
+        sequence.past_key_values = out.past_key_values
+        token_id = _select_token(out.logits[0][-1], sequence.params)
+        return self._append_token(sequence, token_id)
+
+    def _decode(self, sequences: List[Sequence]) -> List[SequenceOutput]:
+        input_ids = torch.as_tensor(
+            [[sequence.output_token_ids[-1]] for sequence in sequences],
+            device=self.device
+        )
+        position_ids = torch.as_tensor(
+            [[sequence.cache_length] for sequence in sequences],
+            device=self.device
+        )
+
+        if len(sequences) == 1:
+            out = self.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                past_key_values=sequences[0].past_key_values,
+                use_cache=True,
+            )
+        else:
+            past_key_values, attention_mask = _merge_past_key_values(sequences, self.device)
+            out = self.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+
+        token_ids = select_tokens(out.logits[:, -1], [sequence.params for sequence in sequences])
+
+        outputs = []
+        for idx, sequence in enumerate(sequences):
+            sequence.past_key_values = _split_past_key_values(out.past_key_values, idx, sequence.cache_length + 1)
+            outputs.append(self._append_token(sequence, token_ids[idx]))
+        return outputs
+
+    def _append_token(self, sequence: Sequence, token_id: int) -> SequenceOutput:
+        sequence.output_token_ids.append(token_id)
+
+        new_text = sequence.detokenizer.add_token(token_id)
+
+        if should_stop_generating(self.tokenizer, token_id, sequence.stop_string_matcher, new_text):
+            sequence.finished = True
+            return SequenceOutput(sequence.sequence_id, '', True)
+
+        if len(sequence.output_token_ids) >= sequence.params.max_new_tokens:
+            sequence.finished = True
+
+        return SequenceOutput(sequence.sequence_id, new_text, sequence.finished)
+
+
+def _merge_past_key_values(sequences: List[Sequence], device: str) -> (tuple, torch.Tensor):
+    max_length = max(sequence.cache_length for sequence in sequences)
+
+    # one extra position for the token that is being decoded in this step
+    attention_mask = torch.zeros((len(sequences), max_length + 1), dtype=torch.long, device=device)
+    for idx, sequence in enumerate(sequences):
+        attention_mask[idx, max_length - sequence.cache_length:] = 1
+
+    merged = []
+    for layer in range(len(sequences[0].past_key_values)):
+        keys = []
+        values = []
+        for sequence in sequences:
+            key, value = sequence.past_key_values[layer]
+            padding = max_length - key.shape[2]
+            keys.append(F.pad(key, (0, 0, padding, 0)))
+            values.append(F.pad(value, (0, 0, padding, 0)))
+        merged.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+
+    return tuple(merged), attention_mask
+
+
+def _split_past_key_values(past_key_values: tuple, idx: int, length: int) -> tuple:
+    return tuple(
+        (key[idx:idx + 1, :, -length:, :], value[idx:idx + 1, :, -length:, :])
+        for key, value in past_key_values
+    )
+
+
+def drain(engine: ContinuousBatchingEngine) -> Dict[Any, str]:
+    """
+    Run the engine until every admitted sequence has finished, and return the complete text of each sequence.
+    """
+    texts = {}
+    while engine.has_unfinished_sequences():
+        for output in engine.step():
+            texts[output.sequence_id] = texts.get(output.sequence_id, '') + output.text
+    return texts
@@ -0,0 +1,103 @@
+"""
+Incremental detokenisation and stop string matching for streaming text generation.
+
+Decoding the whole output after every generated token makes a long answer quadratic in its length. The
+`IncrementalDetokenizer` instead only decodes a short trailing window of tokens per step. The window starts
+at the token before the one that was last emitted, so tokens whose text depends on their neighbours (such as
+the leading space of sentencepiece tokens) decode the same way as they would in the full output. Text ending
+in the unicode replacement character is held back, since it means the last token ended in the middle of a
+multi-byte character, which is completed by the tokens that follow.
+
+The `StopStringMatcher` is an Aho–Corasick automaton over the characters of the stop strings. It is fed the
+text as it's emitted, and keeps its state between calls, so stop strings spanning several tokens are found
+without ever rescanning the output.
+"""
+
+from typing import List, Dict
+from collections import deque
+
+from transformers import AutoTokenizer
+
+REPLACEMENT_CHARACTER = '\ufffd'
+
+
+class IncrementalDetokenizer:
+
+    def __init__(self, tokenizer: AutoTokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add_token(self, token_id: int) -> str:
+        """
+        Add a generated token, and return the text it completed. This is an empty string if the token does
+        not complete any text yet.
+        """
+        self.token_ids.append(token_id)
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(text) <= len(prefix_text) or text.endswith(REPLACEMENT_CHARACTER):
+            return ''
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return text[len(prefix_text):]
+
+    def _decode(self, token_ids: List[int]) -> str:
+        if len(token_ids) == 0:
+            return ''
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+
+class StopStringMatcher:
+
+    def __init__(self, stop_strings: List[str]):
+        self.transitions: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.matches: List[bool] = [False]
+        self.state = 0
+
+        for stop_string in stop_strings:
+            self._add(stop_string)
+        self._build_failure_links()
+
+    def feed(self, text: str) -> bool:
+        """
+        Feed the next piece of emitted text to the matcher. Returns true once any stop string has occurred in
+        the text fed so far.
+        """
+        for char in text:
+            while self.state != 0 and char not in self.transitions[self.state]:
+                self.state = self.fail[self.state]
+            self.state = self.transitions[self.state].get(char, 0)
+            if self.matches[self.state]:
+                return True
+        return False
+
+    def _add(self, stop_string: str):
+        if stop_string == '':
+            return
+
+        state = 0
+        for char in stop_string:
+            if char not in self.transitions[state]:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.matches.append(False)
+                self.transitions[state][char] = len(self.transitions) - 1
+            state = self.transitions[state][char]
+        self.matches[state] = True
+
+    def _build_failure_links(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                fail = self.fail[state]
+                while fail != 0 and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.transitions[fail].get(char, 0)
+                self.matches[next_state] = self.matches[next_state] or self.matches[self.fail[next_state]]
+                queue.append(next_state)
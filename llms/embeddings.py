@@ -1,32 +1,69 @@
-from typing import List
+from typing import List, Optional
+import asyncio
 
 from transformers import AutoTokenizer, AutoModel
 import torch.nn.functional as F
 from torch import Tensor, nn
 import torch
 
-from config.settings import get_settings
+from .loading import load_pretrained
 
 
-def load_hf_embedding_model(model_path: str, device: str) -> (nn.Module, AutoTokenizer):
-    tokenizer = AutoTokenizer.from_pretrained(model_path, token=get_settings().HUGGINGFACE_ACCESS_TOKEN)
-    model = AutoModel.from_pretrained(model_path, token=get_settings().HUGGINGFACE_ACCESS_TOKEN)
+def load_hf_embedding_model(
+    model_path: str,
+    device: str,
+    quantization: Optional[str] = None,
+) -> (nn.Module, AutoTokenizer):
+    return load_pretrained(AutoModel, model_path, device, quantization=quantization)
 
-    model.to(device)
 
-    return model, tokenizer
+async def compute_embedding(model: nn.Module, tokeniser: AutoTokenizer, text: str) -> List[float]:
+    embeddings = await compute_embeddings(model, tokeniser, [text])
+    return embeddings[0]
 
 
-async def compute_embedding(model: nn.Module, tokeniser: AutoTokenizer, text: str) -> List[float]:
-    tokenised_inputs = _tokenise_inputs(tokeniser, [text])
-    model_embeddings = _compute_model_embeddings(model, tokenised_inputs)
-    pooled_embeddings = _last_token_pool(model_embeddings, tokenised_inputs['attention_mask'])
-    normalised_embeddings = _normalise_embeddings(pooled_embeddings)
-    return normalised_embeddings[0].cpu().numpy().tolist()
+async def compute_embeddings(
+    model: nn.Module,
+    tokeniser: AutoTokenizer,
+    texts: List[str],
+    batch_size: int = 8,
+) -> List[List[float]]:
+    """
+    Compute the embeddings of many texts, running them through the model in padded batches of `batch_size`.
+
+    The texts are tokenised once, and sorted by their token length before they are batched, so that texts of
+    similar length share a batch and little compute is spent on padding. The embeddings are returned in the
+    same order as the texts were given. The model runs in a thread, so the event loop isn't blocked meanwhile.
+    """
+    return await asyncio.to_thread(_compute_embeddings, model, tokeniser, texts, batch_size)
+
+
+def _compute_embeddings(model: nn.Module, tokeniser: AutoTokenizer, texts: List[str], batch_size: int) -> list:
+    encodings = _tokenise_inputs(tokeniser, texts)
+    order = sorted(range(len(texts)), key=lambda idx: len(encodings['input_ids'][idx]))
+
+    embeddings = [None] * len(texts)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+
+        batch_encodings = {key: [values[idx] for idx in batch] for key, values in encodings.items()}
+        tokenised_inputs = _pad_inputs(tokeniser, batch_encodings)
+        model_embeddings = _compute_model_embeddings(model, tokenised_inputs)
+        pooled_embeddings = _last_token_pool(model_embeddings, tokenised_inputs['attention_mask'])
+        normalised_embeddings = _normalise_embeddings(pooled_embeddings).cpu().numpy().tolist()
+
+        for idx, embedding in zip(batch, normalised_embeddings):
+            embeddings[idx] = embedding
+
+    return embeddings
 
 
 def _tokenise_inputs(tokeniser: AutoTokenizer, input_texts: list[str], max_length: int = 8192) -> dict:
-    return tokeniser(input_texts, max_length=max_length, padding=True, truncation=True, return_tensors='pt')
+    return tokeniser(input_texts, max_length=max_length, truncation=True)
+
+
+def _pad_inputs(tokeniser: AutoTokenizer, encodings: dict) -> dict:
+    return tokeniser.pad(encodings, padding=True, return_tensors='pt')
 
 
 def _compute_model_embeddings(model: nn.Module, tokenised_inputs: dict) -> Tensor:
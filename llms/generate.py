@@ -1,29 +1,34 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional, List
 import asyncio
 
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 
-from .sampling_strategies import top_k_sampling, top_p_sampling, top_k_and_p_sampling
+from .sampling_strategies import sample_tokens
+from .detokenizer import IncrementalDetokenizer, StopStringMatcher
+from .prefix_cache import PrefixCache, ChunkedPrefill
+from .truncation import truncate_prompt
+from .loading import load_pretrained
 from config.settings import get_settings
 from config.logger import log
 from .config import Params
 
 
-def load_hf_model(model_path: str, device: str) -> (AutoModelForCausalLM, AutoTokenizer):
+def load_hf_model(
+    model_path: str,
+    device: str,
+    quantization: Optional[str] = None,
+) -> (AutoModelForCausalLM, AutoTokenizer):
     log().debug(f"loading model {model_path} with token {get_settings().HUGGINGFACE_ACCESS_TOKEN}")
 
-    tokenizer = AutoTokenizer.from_pretrained(model_path, token=get_settings().HUGGINGFACE_ACCESS_TOKEN)
-    model = AutoModelForCausalLM.from_pretrained(
+    return load_pretrained(
+        AutoModelForCausalLM,
         model_path,
+        device,
         torch_dtype=torch.float16,
-        token=get_settings().HUGGINGFACE_ACCESS_TOKEN
+        quantization=quantization,
     )
 
-    model.to(device)
-
-    return model, tokenizer
-
 
 def generate_text(
         model: AutoModelForCausalLM,
@@ -45,29 +50,29 @@ async def generate_text_streaming(
     device: str,
     params: Params,
     prompt: str,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefill_chunk_size: Optional[int] = None,
 ) -> AsyncGenerator[str, None]:
-    prompt = params.system_prompt + prompt
+    input_ids = _initialize_prompt(tokenizer, params, prompt)
 
-    input_ids = _initialize_prompt(tokenizer, prompt)
-    output_token_ids = []
-    max_src_len = params.context_length - params.max_new_tokens - 8
-    input_ids = input_ids[-max_src_len:]
-
-    past_key_values = None
-    generated_text = ""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    stop_string_matcher = StopStringMatcher(params.stop_strings)
     with torch.no_grad():
+        # a long prompt is run in slices, yielding to the event loop between them (see the comment below)
+        chunked_prefill = ChunkedPrefill(model, input_ids, device, prefix_cache, prefill_chunk_size)
+        while not chunked_prefill.step():
+            await asyncio.sleep(0)
+        out = chunked_prefill.output
+
+        token_id = None
         for i in range(params.max_new_tokens):
-            out, past_key_values = _generate_output(model, input_ids, device, i, past_key_values)
+            if i > 0:
+                out = _generate_output(model, token_id, device, out.past_key_values)
             token_id = _select_token(out.logits[0][-1], params)
 
-            output_token_ids.append(token_id)
-            input_ids = [token_id]
+            new_text = detokenizer.add_token(token_id)
 
-            current_text = tokenizer.decode(output_token_ids, skip_special_tokens=True)
-            new_text = current_text[len(generated_text):]
-            generated_text = current_text
-
-            if should_stop_generating(output_token_ids, tokenizer, params, token_id):
+            if should_stop_generating(tokenizer, token_id, stop_string_matcher, new_text):
                 break
 
             # This call to asyncio.sleep is a non-blocking call that immediately yields control back to the event loop.
@@ -82,58 +87,52 @@ async def generate_text_streaming(
             yield new_text
 
 
-def _initialize_prompt(tokenizer: AutoTokenizer, prompt: str) -> list:
-    input_ids = tokenizer(prompt).input_ids
-    return input_ids
+def _initialize_prompt(tokenizer: AutoTokenizer, params: Params, prompt: str) -> list:
+    max_src_len = params.context_length - params.max_new_tokens - 8
+    return truncate_prompt(tokenizer, params.system_prompt + prompt, max_src_len)
 
 
 def _generate_output(
     model: AutoModelForCausalLM,
-    input_ids: list,
+    token_id: int,
     device: str,
-    iteration: int,
-    past_key_values
-) -> tuple:
-    if iteration == 0:
-        out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
-    else:
-        out = model(
-            input_ids=torch.as_tensor(
-                [[input_ids[-1]]],
-                device=device
-            ),
-            use_cache=True,
-            past_key_values=past_key_values
-        )
-    return out, out.past_key_values
+    past_key_values: tuple,
+):
+    return model(
+        input_ids=torch.as_tensor(
+            [[token_id]],
+            device=device
+        ),
+        use_cache=True,
+        past_key_values=past_key_values
+    )
 
 
 def _select_token(logits: torch.Tensor, params: Params) -> int:
-    if params.temperature < 1e-4:
-        token_id = int(torch.argmax(logits))
-    else:
-        probabilities = torch.softmax(logits / params.temperature, dim=-1)
-        if params.enable_top_k_filter and params.enable_top_p_filter:
-            token_id = top_k_and_p_sampling(logits, params.top_k_limit, params.top_p_threshold)
-        elif params.enable_top_k_filter:
-            token_id = top_k_sampling(logits, params.top_k_limit)
-        elif params.enable_top_p_filter:
-            token_id = top_p_sampling(logits, params.top_p_threshold)
-        else:
-            token_id = int(torch.multinomial(probabilities, num_samples=1))
-    return token_id
+    return select_tokens(logits.unsqueeze(0), [params])[0]
+
+
+def select_tokens(logits: torch.Tensor, params: List[Params]) -> List[int]:
+    """
+    Select the next token of every sequence in a batch, from logits of shape (batch, vocabulary).
+    """
+    token_ids = sample_tokens(
+        logits,
+        temperatures=[p.temperature for p in params],
+        top_k=[p.top_k_limit if p.enable_top_k_filter else 0 for p in params],
+        top_p=[p.top_p_threshold if p.enable_top_p_filter else 1.0 for p in params],
+    )
+    return token_ids.tolist()
 
 
 def should_stop_generating(
-    output_token_ids: list,
     tokenizer: AutoTokenizer,
-    params: Params,
-    token_id: int
+    token_id: int,
+    stop_string_matcher: StopStringMatcher,
+    new_text: str,
 ) -> bool:
     if token_id in [tokenizer.eos_token_id]:
         return True
-    if params.stop_strings:
-        output = tokenizer.decode(output_token_ids, skip_special_tokens=True)
-        if any(stop_str in output for stop_str in params.stop_strings):
-            return True
+    if stop_string_matcher.feed(new_text):
+        return True
     return False
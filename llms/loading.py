@@ -0,0 +1,77 @@
+"""
+Loading of huggingface models, shared by the text generation and embedding workers.
+
+Weights are read from the safetensors files of a model when it has them, which are memory-mapped rather than
+unpickled, and from its pytorch .bin files otherwise. When accelerate is installed the model is created without
+first allocating randomly initialised weights. The linear layers can optionally be quantized to 8 or 4 bits, see
+`llms.quantization`. The layers are quantized once the whole model has been loaded, so quantization lowers the
+memory the model takes while the worker runs, but neither the peak memory used while it is loaded nor the time
+it takes to load. The time spent in each step is logged, so slow worker startups can be traced to the step
+that's slow.
+"""
+
+from typing import Optional, Type
+import time
+
+from transformers import AutoTokenizer, PreTrainedModel
+from transformers.utils import is_accelerate_available
+from torch import nn
+import torch
+
+from .quantization import quantize_model, SUPPORTED_QUANTIZATIONS, UnsupportedQuantizationError
+from config.settings import get_settings
+from config.logger import log
+
+
+class StartupTimer:
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.step_started_at = self.started_at
+        self.steps = []
+
+    def step_finished(self, name: str):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.step_started_at))
+        self.step_started_at = now
+
+    def report(self) -> str:
+        steps = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.steps)
+        return f'{time.perf_counter() - self.started_at:.2f}s ({steps})'
+
+
+def load_pretrained(
+    model_class: Type[PreTrainedModel],
+    model_path: str,
+    device: str,
+    torch_dtype: Optional[torch.dtype] = None,
+    quantization: Optional[str] = None,
+) -> (nn.Module, AutoTokenizer):
+    if quantization is not None and quantization not in SUPPORTED_QUANTIZATIONS:
+        raise UnsupportedQuantizationError(
+            f"unsupported quantization {quantization}, use one of {', '.join(SUPPORTED_QUANTIZATIONS)}"
+        )
+
+    timer = StartupTimer()
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path, token=get_settings().HUGGINGFACE_ACCESS_TOKEN)
+    timer.step_finished('tokenizer')
+
+    model = model_class.from_pretrained(
+        model_path,
+        torch_dtype=torch_dtype,
+        token=get_settings().HUGGINGFACE_ACCESS_TOKEN,
+        low_cpu_mem_usage=is_accelerate_available(),
+    )
+    timer.step_finished('weights')
+
+    if quantization is not None:
+        quantize_model(model, quantization)
+        timer.step_finished(f'{quantization} quantization')
+
+    model.to(device)
+    timer.step_finished(f'move to {device}')
+
+    log().info(f"loaded model {model_path} in {timer.report()}")
+
+    return model, tokenizer
@@ -1,6 +1,8 @@
-from typing import Tuple, AsyncGenerator, List
+from typing import Tuple, AsyncGenerator, List, Callable, Awaitable, Any
+import asyncio
+import random
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
 import tiktoken
 from tiktoken import Encoding
 
@@ -11,6 +13,11 @@ from config.logger import log
 MODEL = 'gpt-4-turbo'
 EMBEDDING_MODEL = 'text-embedding-3-large'
 MAX_TOKENS = 4096
+RATE_LIMIT_BACKOFF_BASE_SECONDS = 1
+
+# the embeddings endpoint accepts at most 2048 inputs and 300k tokens per request
+EMBEDDING_REQUEST_MAX_INPUTS = 2048
+EMBEDDING_REQUEST_TOKEN_BUDGET = 250000
 
 
 class OpenAiError(Exception):
@@ -21,10 +28,32 @@ def load_openai_sdk(model_name: str, device: str) -> Tuple[AsyncOpenAI, None]:
     api_key = get_settings().OPENAI_API_KEY
     if api_key is None:
         raise OpenAiError("OpenAI API key was not set in the settings.")
-    client = AsyncOpenAI(api_key=api_key)
+    # rate limit errors are retried by with_rate_limit_retries, so that the backoff can be logged
+    client = AsyncOpenAI(api_key=api_key, max_retries=0)
     return client, None
 
 
+async def with_rate_limit_retries(create_request: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Make a request, retrying it with exponential backoff and some jitter if the api responds
+    that the rate limit was exceeded. Gives up after OPENAI_MAX_RETRIES retries.
+    """
+    max_retries = get_settings().OPENAI_MAX_RETRIES
+    attempt = 0
+    while True:
+        try:
+            return await create_request()
+        except RateLimitError:
+            if attempt >= max_retries:
+                raise
+
+            backoff = RATE_LIMIT_BACKOFF_BASE_SECONDS * (2 ** attempt) * (1 + random.random() / 4)
+            attempt += 1
+            log().warning(f"openai rate limit exceeded, retrying in {backoff:.1f} seconds "
+                          f"(attempt {attempt} of {max_retries})")
+            await asyncio.sleep(backoff)
+
+
 async def generate_text_streaming(
     model: AsyncOpenAI,
     tokenizer,
@@ -57,7 +86,7 @@ async def stream_tokens_async(
     log().debug(f"init openai stream. MAX_TOKENS: {MAX_TOKENS}, prompt_tokens: {num_tokens}, params.max_new_tokens: "
                 f"{params.max_new_tokens}, max_tokens being used: {max_tokens}")
 
-    stream = await client.chat.completions.create(
+    stream = await with_rate_limit_retries(lambda: client.chat.completions.create(
         model=MODEL,
         temperature=params.temperature,
         max_tokens=max_tokens,
@@ -66,7 +95,7 @@ async def stream_tokens_async(
             {'role': 'user', 'content': prompt},
         ],
         stream=True,
-    )
+    ))
     async for chunk in stream:
         token = chunk.choices[0].delta.content or ''
         if token in params.stop_strings:
@@ -76,11 +105,57 @@ async def stream_tokens_async(
 
 async def compute_embedding(model: AsyncOpenAI, tokeniser, text: str) -> List[float]:
     log().info(f"Computing embedding using openai embedding model: {EMBEDDING_MODEL}")
-    response = await model.embeddings.create(input=text, model=EMBEDDING_MODEL)
+    response = await with_rate_limit_retries(lambda: model.embeddings.create(input=text, model=EMBEDDING_MODEL))
     log().info(f"Usage was {response.usage}")
     return response.data[0].embedding
 
 
+async def compute_embeddings(
+    model: AsyncOpenAI,
+    tokeniser,
+    texts: List[str],
+    batch_size: int = EMBEDDING_REQUEST_MAX_INPUTS,
+    rate_limiter=None,
+) -> List[List[float]]:
+    """
+    Compute the embeddings of many texts, sending as many of them as possible in each request. A request
+    holds at most `batch_size` texts, and no more texts than fit in the token budget of a request. The
+    embeddings are returned in the same order as the texts were given. When a rate limiter is given, its
+    acquire is awaited with the number of tokens of every request before the request is sent.
+    """
+    log().info(f"Computing {len(texts)} embeddings using openai embedding model: {EMBEDDING_MODEL}")
+
+    embeddings = []
+    for batch, tokens in _split_texts_by_token_budget(texts, min(batch_size, EMBEDDING_REQUEST_MAX_INPUTS)):
+        if rate_limiter is not None:
+            await rate_limiter.acquire(tokens)
+        response = await with_rate_limit_retries(lambda: model.embeddings.create(input=batch, model=EMBEDDING_MODEL))
+        log().info(f"Usage for {len(batch)} inputs was {response.usage}")
+        embeddings += [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+    return embeddings
+
+
+def _split_texts_by_token_budget(texts: List[str], max_inputs: int) -> List[Tuple[List[str], int]]:
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if len(batch) > 0 and (len(batch) >= max_inputs or batch_tokens + tokens > EMBEDDING_REQUEST_TOKEN_BUDGET):
+            batches.append((batch, batch_tokens))
+            batch = []
+            batch_tokens = 0
+
+        batch.append(text)
+        batch_tokens += tokens
+
+    if len(batch) > 0:
+        batches.append((batch, batch_tokens))
+
+    return batches
+
+
 def truncate_text_to_token_limit(input_string: str, token_limit: int) -> str:
     encoding = tiktoken.encoding_for_model(MODEL)
     tokens = encoding.encode(input_string)
@@ -92,6 +167,11 @@ def truncate_text_to_token_limit(input_string: str, token_limit: int) -> str:
         return input_string
 
 
+def count_tokens(text: str) -> int:
+    encoding = tiktoken.encoding_for_model(MODEL)
+    return len(encoding.encode(text))
+
+
 def get_tokeniser() -> Encoding:
     encoding = tiktoken.encoding_for_model(MODEL)
     return encoding
@@ -0,0 +1,187 @@
+"""
+A cache of the KV cache of prompts, so that a prompt that starts with the same tokens as an earlier prompt
+only has to prefill the tokens that are new.
+
+Prompts are split into blocks of `block_size` tokens, and every block is identified by a hash chained over
+all blocks before it, so a block hash identifies the whole prefix up to and including that block. When a
+prompt is stored, its KV cache is cropped to the last full block and every block hash of the prompt is
+registered in the index. A lookup walks the block hashes of a new prompt and picks the longest prefix that
+is in the index. Entries are evicted least recently used first, once their tensors exceed the memory budget.
+"""
+
+from typing import List, Tuple, Optional, Dict
+from collections import OrderedDict
+
+import torch
+
+from config.logger import log
+
+
+class _Entry:
+
+    def __init__(self, token_ids: Tuple[int, ...], past_key_values: tuple, block_hashes: List[int]):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.block_hashes = block_hashes
+        self.size_bytes = sum(key.nbytes + value.nbytes for key, value in past_key_values)
+
+
+class PrefixCache:
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.size_bytes = 0
+        self.entries: OrderedDict[int, _Entry] = OrderedDict()
+        self.index: Dict[int, Tuple[_Entry, int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+        Find the longest cached prefix of the prompt. Returns the length of that prefix, along with its KV
+        cache, or (0, None) if no prefix of the prompt is cached. At least the last token of the prompt is
+        always left out of the prefix, since the model has to run on it to produce the next token's logits.
+        """
+        matched_length = 0
+        matched_entry = None
+        for length, block_hash in self._block_hashes(input_ids[:-1]):
+            found = self.index.get(block_hash)
+            if found is None:
+                break
+
+            entry, _ = found
+            if entry.token_ids[:length] != tuple(input_ids[:length]):
+                break  # a hash collision
+
+            matched_length = length
+            matched_entry = entry
+
+        if matched_entry is None:
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        self.entries.move_to_end(matched_entry.block_hashes[-1])
+        return matched_length, _crop(matched_entry.past_key_values, matched_length)
+
+    def store(self, input_ids: List[int], past_key_values: tuple):
+        """
+        Store the KV cache of a prompt, cropped to the last full block of the prompt.
+        """
+        length = (len(input_ids) // self.block_size) * self.block_size
+        if length == 0:
+            return
+
+        block_hashes = [block_hash for _, block_hash in self._block_hashes(input_ids[:length])]
+        found = self.index.get(block_hashes[-1])
+        if found is not None:
+            # the whole prompt is already covered by an earlier entry
+            self.entries.move_to_end(found[0].block_hashes[-1])
+            return
+
+        entry = _Entry(
+            tuple(input_ids[:length]),
+            tuple((key.contiguous(), value.contiguous()) for key, value in _crop(past_key_values, length)),
+            block_hashes,
+        )
+        if entry.size_bytes > self.max_bytes:
+            return
+
+        self.entries[block_hashes[-1]] = entry
+        self.size_bytes += entry.size_bytes
+        for idx, block_hash in enumerate(block_hashes):
+            self.index[block_hash] = (entry, (idx + 1) * self.block_size)
+
+        while self.size_bytes > self.max_bytes:
+            self._evict_least_recently_used()
+
+    def _evict_least_recently_used(self):
+        _, entry = self.entries.popitem(last=False)
+        self.size_bytes -= entry.size_bytes
+        for block_hash in entry.block_hashes:
+            found = self.index.get(block_hash)
+            if found is not None and found[0] is entry:
+                del self.index[block_hash]
+
+    def _block_hashes(self, input_ids: List[int]):
+        block_hash = 0
+        for end in range(self.block_size, len(input_ids) + 1, self.block_size):
+            block_hash = hash((block_hash, tuple(input_ids[end - self.block_size:end])))
+            yield end, block_hash
+
+
+def _crop(past_key_values: tuple, length: int) -> tuple:
+    return tuple((key[:, :, :length, :], value[:, :, :length, :]) for key, value in past_key_values)
+
+
+class ChunkedPrefill:
+    """
+    Runs the model on a prompt in slices of at most `chunk_size` tokens, one slice per call to `step`, so that
+    the caller can do other work between the slices of a long prompt. The KV cache of the longest cached
+    prefix of the prompt is reused when a prefix cache is given, and the KV cache of the prompt is stored in
+    the prefix cache once the whole prompt has been run.
+    """
+
+    def __init__(
+        self,
+        model,
+        input_ids: List[int],
+        device: str,
+        prefix_cache: Optional[PrefixCache] = None,
+        chunk_size: Optional[int] = None,
+    ):
+        self.model = model
+        self.input_ids = input_ids
+        self.device = device
+        self.prefix_cache = prefix_cache
+        self.chunk_size = chunk_size if chunk_size else len(input_ids)
+        self.position = 0
+        self.past_key_values = None
+        self.output = None
+
+        if prefix_cache is not None:
+            self.position, self.past_key_values = prefix_cache.lookup(input_ids)
+            log().debug(f"reusing the KV cache of {self.position} of {len(input_ids)} prompt tokens, the prefix "
+                        f"cache has had {prefix_cache.hits} hits and {prefix_cache.misses} misses")
+
+    @property
+    def finished(self) -> bool:
+        return self.output is not None
+
+    def step(self) -> bool:
+        """
+        Run the model on the next slice of the prompt. Returns true once the whole prompt has been run, the
+        output of the model for the last slice is then available as `output`.
+        """
+        end = min(self.position + self.chunk_size, len(self.input_ids))
+        out = self.model(
+            input_ids=torch.as_tensor([self.input_ids[self.position:end]], device=self.device),
+            past_key_values=self.past_key_values,
+            use_cache=True,
+        )
+        self.position = end
+        self.past_key_values = out.past_key_values
+
+        if self.position < len(self.input_ids):
+            return False
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(self.input_ids, out.past_key_values)
+        self.output = out
+        return True
+
+
+def prefill(
+    model,
+    input_ids: List[int],
+    device: str,
+    prefix_cache: Optional[PrefixCache] = None,
+):
+    """
+    Run the model on a whole prompt at once, see `ChunkedPrefill`.
+    """
+    chunked_prefill = ChunkedPrefill(model, input_ids, device, prefix_cache)
+    while not chunked_prefill.step():
+        pass
+    return chunked_prefill.output
@@ -0,0 +1,151 @@
+"""
+Weight-only quantisation of the linear layers of a model, to cut the memory used by a worker.
+
+The weights of every linear layer are stored as 8 or 4 bit integers, with a float scale per group of
+`group_size` input features. The activations are left untouched, and the weights are dequantised to the
+activations' dtype right before every matrix multiplication. Two 4 bit weights are packed into each byte.
+
+This trades speed for memory: the weights are dequantised again on every forward pass, so a quantized model is
+slower than the full precision one. A large layer is dequantised a block of output rows at a time, so that only
+a block of its weights, rather than the whole layer, is ever held in full precision.
+
+This needs nothing but torch, so it works on the cpu as well as on any other device.
+"""
+
+from typing import Tuple
+
+import torch.nn.functional as F
+from torch import Tensor, nn
+import torch
+
+SUPPORTED_QUANTIZATIONS = {
+    'int8': 8,
+    'int4': 4,
+}
+
+# the number of weights dequantised at a time by a forward pass
+DEQUANTIZE_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class UnsupportedQuantizationError(Exception):
+    pass
+
+
+class QuantizedLinear(nn.Module):
+
+    def __init__(self, in_features: int, out_features: int, bits: int, group_size: int, bias: bool, dtype):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+
+        packed_features = in_features // 2 if bits == 4 else in_features
+        self.register_buffer('qweight', torch.zeros((out_features, packed_features), dtype=torch.uint8))
+        self.register_buffer('scales', torch.zeros((out_features, in_features // group_size), dtype=dtype))
+        self.register_buffer('bias', torch.zeros(out_features, dtype=dtype) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int, group_size: int) -> 'QuantizedLinear':
+        quantized = cls(
+            linear.in_features,
+            linear.out_features,
+            bits,
+            group_size,
+            linear.bias is not None,
+            linear.weight.dtype,
+        )
+        qweight, scales = _quantize(linear.weight.data, bits, group_size)
+        quantized.qweight = qweight
+        quantized.scales = scales.to(linear.weight.dtype)
+        if linear.bias is not None:
+            quantized.bias = linear.bias.data
+        return quantized
+
+    def dequantize(self, start: int = 0, end: int | None = None) -> Tensor:
+        """
+        Dequantize the weights of the output rows from start up to end, or of all rows by default.
+        """
+        qweight = self.qweight[start:end]
+        scales = self.scales[start:end]
+        rows = qweight.shape[0]
+
+        if self.bits == 4:
+            low = (qweight & 0x0F).to(torch.int8) - 8
+            high = (qweight >> 4).to(torch.int8) - 8
+            weight = torch.stack((low, high), dim=-1).reshape(rows, self.in_features)
+        else:
+            weight = qweight.view(torch.int8)
+
+        weight = weight.reshape(rows, -1, self.group_size).to(scales.dtype)
+        weight = weight * scales.unsqueeze(-1)
+        return weight.reshape(rows, self.in_features)
+
+    def forward(self, x: Tensor) -> Tensor:
+        block_rows = max(1, DEQUANTIZE_BLOCK_SIZE // self.in_features)
+        if block_rows >= self.out_features:
+            return F.linear(x, self.dequantize().to(x.dtype), self.bias)
+
+        output = torch.cat([
+            F.linear(x, self.dequantize(start, start + block_rows).to(x.dtype))
+            for start in range(0, self.out_features, block_rows)
+        ], dim=-1)
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def extra_repr(self) -> str:
+        return f'in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, ' \
+               f'group_size={self.group_size}'
+
+
+def quantize_model(model: nn.Module, quantization: str, group_size: int = 128) -> nn.Module:
+    """
+    Replace the linear layers of the model with quantized ones, one layer at a time, so that only a single
+    layer's weights are ever held in two precisions at once. The output layer is left in full precision,
+    since quantizing it costs a lot of accuracy for very little memory.
+    """
+    if quantization not in SUPPORTED_QUANTIZATIONS:
+        raise UnsupportedQuantizationError(
+            f"unsupported quantization {quantization}, use one of {', '.join(SUPPORTED_QUANTIZATIONS)}"
+        )
+    bits = SUPPORTED_QUANTIZATIONS[quantization]
+
+    output_layer = model.get_output_embeddings() if hasattr(model, 'get_output_embeddings') else None
+    for parent_name, parent in list(model.named_modules()):
+        for name, child in list(parent.named_children()):
+            if not isinstance(child, nn.Linear) or child is output_layer:
+                continue
+
+            layer_group_size = _group_size(child.in_features, bits, group_size)
+            if layer_group_size is None:
+                continue
+
+            setattr(parent, name, QuantizedLinear.from_linear(child, bits, layer_group_size))
+
+    return model
+
+
+def _group_size(in_features: int, bits: int, group_size: int) -> int | None:
+    if bits == 4 and in_features % 2 != 0:
+        return None
+    if in_features % group_size == 0:
+        return group_size
+    return in_features
+
+
+def _quantize(weight: Tensor, bits: int, group_size: int) -> Tuple[Tensor, Tensor]:
+    max_value = 2 ** (bits - 1) - 1
+    out_features, in_features = weight.shape
+
+    grouped = weight.float().reshape(out_features, in_features // group_size, group_size)
+    scales = grouped.abs().amax(dim=-1).clamp(min=1e-8) / max_value
+    quantized = torch.round(grouped / scales.unsqueeze(-1)).clamp(-max_value - 1, max_value)
+    quantized = quantized.to(torch.int8).reshape(out_features, in_features)
+
+    if bits == 4:
+        unsigned = (quantized + 8).to(torch.uint8)
+        packed = unsigned[:, 0::2] | (unsigned[:, 1::2] << 4)
+        return packed, scales
+
+    return quantized.view(torch.uint8), scales
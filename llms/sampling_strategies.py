@@ -7,8 +7,13 @@ be generated during the text creation process. Each function implements a differ
                     mass of P.
 - top_k_p_sampling: hybrid approach that combines top-k and top-p sampling methods to produce the best choice for the
                     next token.
+- sample_tokens:    fused top-k and top-p sampling over a batch of sequences, each with its own temperature, k and p.
+                    The temperature is applied once, and top-p only considers the k tokens that survived top-k, so the
+                    full vocabulary is never sorted unless top-k is disabled. This is what the text generation uses.
 """
 
+from typing import List
+
 from torch import Tensor
 import torch
 
@@ -37,6 +42,60 @@ def top_k_and_p_sampling(logits: Tensor, k: int, p: float) -> int:
     return token_id
 
 
+def sample_tokens(logits: Tensor, temperatures: List[float], top_k: List[int], top_p: List[float]) -> Tensor:
+    """
+    Sample the next token of every sequence in a batch, from logits of shape (batch, vocabulary). A temperature
+    of zero selects the most likely token, a k of zero disables top-k and a p of 1 disables top-p.
+    """
+    greedy = [temperature < 1e-4 for temperature in temperatures]
+    if all(greedy):
+        return torch.argmax(logits, dim=-1)
+
+    probabilities, indices = top_k_and_p_probabilities(logits, temperatures, top_k, top_p)
+    choices = torch.multinomial(probabilities, num_samples=1)
+    if any(greedy):
+        choices.masked_fill_(torch.as_tensor(greedy, device=logits.device).unsqueeze(-1), 0)
+    return indices.gather(-1, choices).squeeze(-1)
+
+
+def top_k_and_p_probabilities(
+    logits: Tensor,
+    temperatures: List[float],
+    top_k: List[int],
+    top_p: List[float],
+) -> (Tensor, Tensor):
+    """
+    The probabilities of the tokens that survive top-k and top-p filtering, for logits of shape (batch, vocabulary).
+    Returns the probabilities and the token ids of the k most likely tokens of each sequence, sorted in descending
+    order, where k is the largest top-k of the batch. Filtered tokens have a probability of zero.
+    """
+    device = logits.device
+    vocabulary_size = logits.shape[-1]
+    k = [vocabulary_size if limit <= 0 else min(limit, vocabulary_size) for limit in top_k]
+    values, indices = torch.topk(logits, max(k), dim=-1)
+    values = values.float()
+
+    scale = [1 / max(temperature, 1e-4) for temperature in temperatures]
+    if len(set(scale)) == 1:
+        values.mul_(scale[0])
+    else:
+        values.mul_(torch.as_tensor(scale, device=device).unsqueeze(-1))
+
+    if min(k) < values.shape[-1]:
+        ranks = torch.arange(values.shape[-1], device=device)
+        values.masked_fill_(ranks >= torch.as_tensor(k, device=device).unsqueeze(-1), float('-inf'))
+
+    probabilities = torch.softmax(values, dim=-1)
+    if min(top_p) >= 1.0:
+        return probabilities, indices
+
+    # a token is dropped by top-p when the tokens ranked above it already hold a probability mass of p
+    mass_above = torch.cumsum(probabilities, dim=-1).sub_(probabilities)
+    values.masked_fill_(mass_above > torch.as_tensor(top_p, device=device).unsqueeze(-1), float('-inf'))
+
+    return torch.softmax(values, dim=-1), indices
+
+
 def _get_top_k(logits: Tensor, k: int) -> (Tensor, Tensor):
     return torch.topk(logits, k)
 
@@ -0,0 +1,203 @@
+"""
+Speculative decoding for text generation with huggingface models.
+
+A small draft model, which must share the vocabulary of the target model, proposes the next few tokens one at a
+time. The target model then scores all of the proposed tokens in a single forward pass, instead of one forward
+pass per token. Each proposed token is accepted with probability min(1, p(token) / q(token)), where p and q are
+the target and draft model's distributions under the sampling params. At the first rejected token, a token is
+sampled from the normalised residual max(0, p - q) instead, and the rest of the proposal is discarded. If every
+proposed token is accepted, a bonus token is sampled from the target model's last distribution. This makes the
+generated tokens follow exactly the distribution the target model would have produced on its own, so the
+temperature, top-k and top-p params keep their meaning. When the temperature is zero both distributions are
+one-hot, and the target model's greedy choice is always the one that's kept.
+"""
+
+from typing import AsyncGenerator, Optional, List
+import asyncio
+
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from torch import Tensor
+import torch
+
+from .generate import _initialize_prompt, should_stop_generating
+from .sampling_strategies import top_k_and_p_probabilities
+from .detokenizer import IncrementalDetokenizer, StopStringMatcher
+from .prefix_cache import PrefixCache, ChunkedPrefill
+from config.logger import log
+from .config import Params
+
+
+async def generate_text_streaming(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    device: str,
+    params: Params,
+    prompt: str,
+    draft_model: AutoModelForCausalLM,
+    num_speculative_tokens: int = 4,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefill_chunk_size: Optional[int] = None,
+) -> AsyncGenerator[str, None]:
+    input_ids = _initialize_prompt(tokenizer, params, prompt)
+
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    stop_string_matcher = StopStringMatcher(params.stop_strings)
+    num_generated_tokens = 0
+    num_proposed_tokens = 0
+    num_accepted_tokens = 0
+
+    with torch.no_grad():
+        chunked_prefill = ChunkedPrefill(model, input_ids, device, prefix_cache, prefill_chunk_size)
+        while not chunked_prefill.step():
+            await asyncio.sleep(0)
+        out = chunked_prefill.output
+        past_key_values = out.past_key_values
+        draft_prefill = ChunkedPrefill(draft_model, input_ids, device, chunk_size=prefill_chunk_size)
+        while not draft_prefill.step():
+            await asyncio.sleep(0)
+        draft_past_key_values = draft_prefill.output.past_key_values
+
+        # the target model's cache covers every token but the last one, the draft model's cache lags behind
+        # by the tokens in draft_input_ids
+        token_id = _sample(_distributions(out.logits[0, -1:], params)[0])
+        draft_input_ids = [token_id]
+        new_token_ids = [token_id]
+
+        while True:
+            for token_id in new_token_ids:
+                num_generated_tokens += 1
+                new_text = detokenizer.add_token(token_id)
+                if should_stop_generating(tokenizer, token_id, stop_string_matcher, new_text):
+                    _log_acceptance_rate(num_accepted_tokens, num_proposed_tokens)
+                    return
+
+                await asyncio.sleep(0)
+                yield new_text
+
+                if num_generated_tokens >= params.max_new_tokens:
+                    _log_acceptance_rate(num_accepted_tokens, num_proposed_tokens)
+                    return
+
+            num_tokens = min(num_speculative_tokens, params.max_new_tokens - num_generated_tokens)
+            proposed_token_ids, draft_distributions, draft_past_key_values = _propose(
+                draft_model,
+                draft_input_ids,
+                draft_past_key_values,
+                device,
+                params,
+                num_tokens,
+            )
+
+            pending_token_id = new_token_ids[-1]
+            cache_length = past_key_values[0][0].shape[2]
+            out = model(
+                input_ids=torch.as_tensor([[pending_token_id] + proposed_token_ids], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            target_distributions = _distributions(out.logits[0], params)
+
+            accepted_token_ids, next_token_id = _verify(
+                proposed_token_ids,
+                draft_distributions,
+                target_distributions,
+            )
+            num_proposed_tokens += len(proposed_token_ids)
+            num_accepted_tokens += len(accepted_token_ids)
+
+            past_key_values = _crop(out.past_key_values, cache_length + 1 + len(accepted_token_ids))
+            if len(accepted_token_ids) == len(proposed_token_ids):
+                # the draft model never ran on its last proposed token
+                draft_input_ids = [proposed_token_ids[-1], next_token_id]
+            else:
+                draft_past_key_values = _crop(draft_past_key_values, cache_length + 1 + len(accepted_token_ids))
+                draft_input_ids = [next_token_id]
+
+            new_token_ids = accepted_token_ids + [next_token_id]
+
+
+def _propose(
+    draft_model: AutoModelForCausalLM,
+    input_ids: List[int],
+    past_key_values: tuple,
+    device: str,
+    params: Params,
+    num_tokens: int,
+) -> (List[int], List[Tensor], tuple):
+    proposed_token_ids = []
+    distributions = []
+    for _ in range(num_tokens):
+        out = draft_model(
+            input_ids=torch.as_tensor([input_ids], device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        past_key_values = out.past_key_values
+
+        distribution = _distributions(out.logits[0, -1:], params)[0]
+        token_id = _sample(distribution)
+        proposed_token_ids.append(token_id)
+        distributions.append(distribution)
+        input_ids = [token_id]
+
+    return proposed_token_ids, distributions, past_key_values
+
+
+def _verify(
+    proposed_token_ids: List[int],
+    draft_distributions: List[Tensor],
+    target_distributions: List[Tensor],
+) -> (List[int], int):
+    """
+    Accept or reject the proposed tokens, see the module docstring. Returns the accepted tokens, and the
+    token sampled from the target model after them.
+    """
+    accepted_token_ids = []
+    for token_id, q, p in zip(proposed_token_ids, draft_distributions, target_distributions):
+        if torch.rand(1).item() * q[token_id] < p[token_id]:
+            accepted_token_ids.append(token_id)
+            continue
+
+        residual = torch.clamp(p - q, min=0)
+        if residual.sum() <= 0:
+            residual = p
+        return accepted_token_ids, _sample(residual / residual.sum())
+
+    return accepted_token_ids, _sample(target_distributions[len(proposed_token_ids)])
+
+
+def _distributions(logits: Tensor, params: Params) -> Tensor:
+    """
+    The probability of every token under the sampling params, for logits of shape (positions, vocabulary). This
+    follows the same rules as `generate.select_tokens`.
+    """
+    if params.temperature < 1e-4:
+        probabilities = torch.zeros_like(logits, dtype=torch.float)
+        probabilities.scatter_(-1, torch.argmax(logits, dim=-1, keepdim=True), 1)
+        return probabilities
+
+    positions = logits.shape[0]
+    top_k_probabilities, indices = top_k_and_p_probabilities(
+        logits,
+        temperatures=[params.temperature] * positions,
+        top_k=[params.top_k_limit if params.enable_top_k_filter else 0] * positions,
+        top_p=[params.top_p_threshold if params.enable_top_p_filter else 1.0] * positions,
+    )
+    probabilities = torch.zeros_like(logits, dtype=torch.float)
+    probabilities.scatter_(-1, indices, top_k_probabilities)
+    return probabilities
+
+
+def _sample(probabilities: Tensor) -> int:
+    return int(torch.multinomial(probabilities, num_samples=1))
+
+
+def _crop(past_key_values: tuple, length: int) -> tuple:
+    return tuple((key[:, :, :length, :], value[:, :, :length, :]) for key, value in past_key_values)
+
+
+def _log_acceptance_rate(num_accepted_tokens: int, num_proposed_tokens: int):
+    if num_proposed_tokens == 0:
+        return
+    log().debug(f"accepted {num_accepted_tokens} of {num_proposed_tokens} tokens proposed by the draft model "
+                f"({num_accepted_tokens / num_proposed_tokens:.0%})")
@@ -0,0 +1,62 @@
+"""
+Running text generation off the event loop.
+
+The forward passes of a huggingface model block the thread they run in for as long as they take. When they
+run inside the event loop, nothing else, such as the websockets or the health check, gets to run until the
+model yields. `stream_in_thread` instead runs a text generator in its own event loop in an executor thread,
+and hands the generated tokens back to the calling event loop through an asyncio.Queue.
+"""
+
+from typing import AsyncGenerator, Callable, Optional
+from concurrent.futures import Executor
+import threading
+import asyncio
+
+_END_OF_STREAM = object()
+
+
+async def stream_in_thread(
+    generator_factory: Callable[[], AsyncGenerator[str, None]],
+    executor: Optional[Executor] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Iterate the generator created by `generator_factory` in a thread of the executor, yielding its tokens as
+    they're generated. The generator is created in, and only ever touched by, that thread. If the caller stops
+    iterating, the generator is stopped before the next token.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    def put(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    async def generate():
+        generator = generator_factory()
+        try:
+            async for token in generator:
+                if stopped.is_set():
+                    break
+                put(token)
+        finally:
+            await generator.aclose()
+
+    def run():
+        try:
+            asyncio.run(generate())
+            put(_END_OF_STREAM)
+        except BaseException as e:  # noqa, the error is re-raised in the calling event loop
+            put(e)
+
+    future = loop.run_in_executor(executor, run)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END_OF_STREAM:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        await future
@@ -0,0 +1,104 @@
+"""
+Truncation of prompts that don't fit in the context window of a model.
+
+Cutting tokens off the front of a prompt throws away the system prompt first, and leaves the prompt starting
+in the middle of whatever was cut. Instead the prompt is split into the parts built by
+`services.llm.formatters`, the chat turns (lines starting with <|user|> or <|assistant|>) and the documents
+(blocks starting with a name: and url: line). Whole parts are then dropped until the prompt fits. First the
+oldest chat turns are dropped, always keeping the last one, then the documents from the last one, which is the
+least relevant, to the first one. Everything else, such as the system prompt and the headings, is always kept.
+
+If the prompt still doesn't fit once nothing more can be dropped, it's cut from the front as a last resort.
+"""
+
+from typing import List
+import re
+
+from transformers import AutoTokenizer
+
+from config.logger import log
+
+CHAT_TURN_PATTERN = re.compile(r'^<\|(?:user|assistant)\|> ', re.MULTILINE)
+DOCUMENT_PATTERN = re.compile(r'^name: .*\nurl: .*\n```', re.MULTILINE)
+HEADING_PATTERN = re.compile(r'^.*\n=+$', re.MULTILINE)
+CLOSING_FENCE_PATTERN = re.compile(r'^```$', re.MULTILINE)
+
+
+class _Part:
+
+    def __init__(self, text: str, kind: str = None):
+        self.text = text
+        self.kind = kind
+        self.dropped = False
+
+
+def truncate_prompt(tokenizer: AutoTokenizer, prompt: str, max_tokens: int) -> List[int]:
+    """
+    Tokenise the prompt, dropping whole chat turns and documents until it has at most `max_tokens` tokens.
+    """
+    input_ids = _tokenise(tokenizer, prompt)
+    if len(input_ids) <= max_tokens:
+        return input_ids
+
+    parts = _split(prompt)
+    excess = len(input_ids) - max_tokens
+    for part in _drop_order(parts):
+        if excess <= 0:
+            break
+        part.dropped = True
+        excess -= len(_tokenise(tokenizer, part.text))
+
+    truncated_prompt = ''.join(part.text for part in parts if not part.dropped)
+    number_of_dropped_parts = len([part for part in parts if part.dropped])
+    log().info(f"prompt of {len(input_ids)} tokens exceeded the limit of {max_tokens} tokens, "
+               f"dropped {number_of_dropped_parts} chat turns and documents")
+
+    input_ids = _tokenise(tokenizer, truncated_prompt)
+    if len(input_ids) > max_tokens:
+        log().warning(f"prompt still has {len(input_ids)} tokens after dropping chat turns and documents, "
+                      f"cutting it to the last {max_tokens} tokens")
+        input_ids = input_ids[-max_tokens:]
+
+    return input_ids
+
+
+def _tokenise(tokenizer: AutoTokenizer, text: str) -> List[int]:
+    return tokenizer(text).input_ids
+
+
+def _split(prompt: str) -> List[_Part]:
+    starts = {}
+    fenced_blocks = []
+    for match in DOCUMENT_PATTERN.finditer(prompt):
+        starts[match.start()] = 'document'
+        closing_fence = CLOSING_FENCE_PATTERN.search(prompt, match.end())
+        fenced_blocks.append((match.end(), closing_fence.end() if closing_fence else len(prompt)))
+
+    # the text of a document can contain lines that look like a chat turn or a heading, which
+    # would split the document in two, so only the ones outside the documents are parts of their own
+    def is_in_document(position: int) -> bool:
+        return any(start <= position < end for start, end in fenced_blocks)
+
+    for match in CHAT_TURN_PATTERN.finditer(prompt):
+        if not is_in_document(match.start()):
+            starts[match.start()] = 'chat_turn'
+    for match in HEADING_PATTERN.finditer(prompt):
+        if not is_in_document(match.start()):
+            starts[match.start()] = None
+
+    boundaries = sorted(starts)
+    parts = []
+    if len(boundaries) == 0 or boundaries[0] > 0:
+        parts.append(_Part(prompt[:boundaries[0] if boundaries else len(prompt)]))
+
+    for idx, start in enumerate(boundaries):
+        end = boundaries[idx + 1] if idx + 1 < len(boundaries) else len(prompt)
+        parts.append(_Part(prompt[start:end], starts[start]))
+
+    return parts
+
+
+def _drop_order(parts: List[_Part]) -> List[_Part]:
+    chat_turns = [part for part in parts if part.kind == 'chat_turn']
+    documents = [part for part in parts if part.kind == 'document']
+    return chat_turns[:-1] + list(reversed(documents))
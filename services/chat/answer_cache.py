@@ -0,0 +1,162 @@
+"""
+A semantic cache of the answers to the first question of a chat.
+
+Students of the same course ask the same questions over and over. The first question of a chat is embedded,
+while it is being rewritten for retrieval, and compared with the most recent questions that have been
+answered before in the same course and snapshot, by the same model, index type and language. If one of them
+is similar enough, its answer is served again without retrieving or generating anything.
+
+Only the first question of a chat is cached, since the answer to a later question also depends on the chat
+that came before it. Answers are cached per snapshot, so they stop being served as soon as the course has a
+new current snapshot, and are deleted by the capture_snapshots job after that.
+"""
+
+from typing import List, Optional
+import asyncio
+import math
+
+from db.actions.cached_answer import find_finished_cached_answers, delete_cached_answers_of_course_not_in_snapshot
+from services.crawler.crawler import CrawlerService, NoValidSnapshotException
+from services.llm.supported_models import get_enum_from_enum_value
+from db.models import CachedAnswer, Chat, Course, Message, PromptHandle, Snapshot
+from services.llm.llm import LLMService
+import config.settings as settings
+from config.logger import log
+
+
+class AnswerCacheLookup:
+
+    def __init__(self, chat: Chat, snapshot: Snapshot, question: str):
+        self.chat = chat
+        self.snapshot = snapshot
+        self.question = question
+        self.embedding: Optional[List[float]] = None
+        self.answer: Optional[CachedAnswer] = None
+        self.similarity = 0.0
+
+
+class AnswerCache:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0
+
+    @staticmethod
+    async def embed(messages: List[Message], enabled: bool = True) -> Optional[List[float]]:
+        """
+        Embed the question of the messages for a lookup. This doesn't need the rewritten question, so it can
+        run while the question is being rewritten. Returns None if the question can't be cached at all, or the
+        cache isn't enabled.
+        """
+        if not enabled or not settings.get_settings().ANSWER_CACHE_ENABLED or not _is_first_question(messages):
+            return None
+        return await _embed(messages[0].content)
+
+    def lookup(
+        self,
+        chat: Chat,
+        messages: List[Message],
+        snapshot: Snapshot,
+        embedding: Optional[List[float]]
+    ) -> AnswerCacheLookup:
+        """
+        Look for an answer to a question similar to the embedded one. The answer of the lookup is None on a
+        miss, and so is its embedding if the question can't be cached at all.
+        """
+        lookup = AnswerCacheLookup(chat, snapshot, messages[-1].content)
+        if embedding is None:
+            return lookup
+
+        lookup.embedding = embedding
+
+        threshold = settings.get_settings().ANSWER_CACHE_SIMILARITY_THRESHOLD
+        for cached in find_finished_cached_answers(
+            chat.course,
+            snapshot,
+            chat.llm_model_name,
+            chat.index_type,
+            chat.language,
+            limit=settings.get_settings().ANSWER_CACHE_MAX_CANDIDATES
+        ):
+            similarity = _cosine_similarity(lookup.embedding, cached.embedding)
+            if similarity >= threshold and similarity > lookup.similarity:
+                lookup.answer = cached
+                lookup.similarity = similarity
+
+        if lookup.answer is None:
+            self.misses += 1
+            log().info(f"answer cache miss for chat {chat.id}, hit rate: {self.hit_rate:.0%}")
+            return lookup
+
+        self.hits += 1
+        self.seconds_saved += lookup.answer.prompt_handle.response_time_taken_s or 0
+        CachedAnswer.update(hits=CachedAnswer.hits + 1).where(CachedAnswer.id == lookup.answer.id).execute()
+        log().info(f"answer cache hit for chat {chat.id}, similarity {lookup.similarity:.3f} to cached answer "
+                   f"{lookup.answer.id}, hit rate: {self.hit_rate:.0%}, {self.seconds_saved}s of generation saved")
+
+        return lookup
+
+    @staticmethod
+    def store(lookup: AnswerCacheLookup, handle: PromptHandle):
+        """
+        Cache the handle answering the question of a lookup that missed. The answer is served once the handle
+        has finished.
+        """
+        if lookup.embedding is None or lookup.answer is not None:
+            return
+
+        CachedAnswer(
+            course=lookup.chat.course,
+            snapshot=lookup.snapshot,
+            llm_model_name=lookup.chat.llm_model_name,
+            index_type=lookup.chat.index_type,
+            language=lookup.chat.language,
+            question=lookup.question,
+            embedding=lookup.embedding,
+            prompt_handle=handle,
+        ).save()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+
+answer_cache = AnswerCache()
+
+
+def _is_first_question(messages: List[Message]) -> bool:
+    return len(messages) == 1 and messages[0].sender == Message.Sender.STUDENT
+
+
+async def _embed(question: str) -> List[float]:
+    embedding_model = get_enum_from_enum_value(settings.get_settings().ANSWER_CACHE_EMBEDDING_MODEL)
+    handle = LLMService.dispatch_prompt(question, embedding_model)
+    try:
+        handle = await LLMService.wait_for_handle(handle)
+    except asyncio.CancelledError:
+        # the chat service stops waiting for the embedding when the question turns out not to be one
+        LLMService.cancel(handle)
+        raise
+    return handle.embedding
+
+
+def _cosine_similarity(a: List[float], b: List[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    if norm == 0 or len(a) != len(b):
+        return 0.0
+    return sum(x * y for x, y in zip(a, b)) / norm
+
+
+def evict_cached_answers(course: Course):
+    try:
+        snapshot = CrawlerService.current_snapshot(course)
+    except NoValidSnapshotException:
+        return
+
+    deleted = delete_cached_answers_of_course_not_in_snapshot(course, snapshot)
+    if deleted > 0:
+        log().info(f"evicted {deleted} cached answers of previous snapshots of course {course.canvas_id}")
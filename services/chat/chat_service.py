@@ -1,23 +1,27 @@
-from typing import List
+from typing import List, Optional
 import asyncio
 
-from db.models.feedback_question import FAQ_TRIGGER
 from services.chat.questions import generate_question_from_messages, generate_keyword_query_from_messages
 from db.models import Chat, Message, Session, Course, Snapshot, FaqSnapshot, FeedbackQuestion, Feedback
 from services.index.supported_indices import IndexType, is_post_processing_index
 from db.actions.feedback_question import find_feedback_questions_with_trigger
+from services.crawler.crawler import CrawlerService, NoValidSnapshotException
 from db.actions.faq_snapshot import find_latest_faq_snapshot_for_course
+from db.actions.faq_answer import find_finished_faq_answer
 from db.actions.chat import count_chats_with_session
 from services.chat.docs import post_process_document
-from services.crawler.crawler import CrawlerService
+from db.models.feedback_question import FAQ_TRIGGER
+from services.chat.answer_cache import answer_cache
 from db.models.feedback import QUESTION_UNANSWERED
 from services.llm.supported_models import LLMModel
 from services.chat.system import get_system_prompt
 from services.index.opensearch import Document
 from services.index.index import IndexService
+from db.models import PromptHandle, Faq
 from services.llm.llm import LLMService
 import services.llm.prompts as prompts
 from llms.config import Params
+from config.logger import log
 
 
 class ChatServiceException(Exception):
@@ -28,18 +32,26 @@ class UnsupportedIndexTypeException(Exception):
     pass
 
 
+def _is_no_question(question: str) -> bool:
+    return 'NO_QUESTION' in question.strip().upper()
+
+
 class ChatService:
 
     @staticmethod
-    def start_new_chat_for_session_and_course(session: Session, course: Course) -> Chat:
+    def make_chat_params(course: Course) -> Params:
         params = Params()
         params.system_prompt = get_system_prompt(course.language, course.name, course.description)
         params.stop_strings = ['<|user|>', '<|user', '<|assistant|>', '<|assistant', '```']
+        return params
+
+    @staticmethod
+    def start_new_chat_for_session_and_course(session: Session, course: Course) -> Chat:
         chat = Chat(
             course=course,
             session=session,
             llm_model_name=session.default_llm_model_name,
-            llm_model_params=params,
+            llm_model_params=ChatService.make_chat_params(course),
             index_type=session.default_index_type,
             language=course.language,
         )
@@ -74,87 +86,139 @@ class ChatService:
 
     @staticmethod
     async def start_next_message(chat: Chat, next_message: Message) -> Message:
+        messages = [message for message in chat.get_student_and_assistant_messages()[:-1]]
+
+        handle = None
+        if next_message.faq is not None and len(messages) == 1:
+            handle = ChatService._find_precomputed_faq_answer(chat, next_message.faq)
+        if handle is None:
+            handle = await ChatService.generate_answer(chat, messages)
+
+        next_message.refresh()
+        next_message.prompt_handle = handle
+        next_message.state = Message.States.READY
+        next_message.save()
+
+        ChatService._trigger_feedback_message_if_matching_trigger_exists(chat)
+
+        return next_message
+
+    @staticmethod
+    async def generate_answer(chat: Chat, messages: List[Message], use_answer_cache: bool = True) -> PromptHandle:
+        """
+        Dispatch the prompt answering the last of the messages, using the index of the chat. The chat and the
+        messages don't have to be saved. The answer cache is neither looked up nor stored to unless
+        use_answer_cache is set.
+        """
         if chat.index_type == IndexType.NO_INDEX:
-            return ChatService._generate_next_message_without_index(chat, next_message)
+            return ChatService._generate_answer_without_index(chat, messages)
 
         should_post_process = is_post_processing_index(chat.index_type)
 
         if chat.index_type in [IndexType.FULL_TEXT_SEARCH, IndexType.FULL_TEXT_SEARCH_WITH_POST_PROCESSING]:
-            return await ChatService._generate_next_message_with_full_text_search_index(
+            return await ChatService._generate_answer_with_full_text_search_index(
                 chat,
-                next_message,
-                should_post_process
+                messages,
+                should_post_process,
+                use_answer_cache
             )
 
         if chat.index_type in [
             IndexType.VECTOR_SEARCH_SALESFORCE_SFR_EMBEDDING_MISTRAL,
             IndexType.VECTOR_SEARCH_SALESFORCE_SFR_EMBEDDING_MISTRAL_WITH_POST_PROCESSING,
         ]:
-            return await ChatService._generate_next_message_with_vector_search(
+            return await ChatService._generate_answer_with_vector_search(
                 chat,
-                next_message,
+                messages,
                 LLMModel.SALESFORCE_SFR_EMBEDDING_MISTRAL,
-                should_post_process
+                should_post_process,
+                use_answer_cache
             )
 
         if chat.index_type in [
             IndexType.VECTOR_SEARCH_OPENAI_TEXT_EMBEDDING_3_LARGE,
             IndexType.VECTOR_SEARCH_OPENAI_TEXT_EMBEDDING_3_LARGE_WITH_POST_PROCESSING,
         ]:
-            return await ChatService._generate_next_message_with_vector_search(
+            return await ChatService._generate_answer_with_vector_search(
                 chat,
-                next_message,
+                messages,
                 LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE,
-                should_post_process
+                should_post_process,
+                use_answer_cache
             )
 
         raise UnsupportedIndexTypeException(f"cannot request new message for index type {chat.index_type} as"
                                             f" it is not supported")
 
     @staticmethod
-    async def _generate_next_message_with_full_text_search_index(
+    async def _generate_answer_with_full_text_search_index(
         chat: Chat,
-        next_message: Message,
-        should_post_process_docs: bool
-    ) -> Message:
-        messages = [message for message in chat.get_student_and_assistant_messages()[:-1]]
-
-        question = await generate_question_from_messages(messages, chat)
-        if 'NO_QUESTION' in question.strip().upper():
-            return ChatService._generate_next_message_without_index(chat, next_message)
-
-        keyword_query = await generate_keyword_query_from_messages(messages, chat)
-
-        snapshot = ChatService.find_most_recent_snapshot_for_chat(chat)
-
-        index = IndexService()
-        docs = index.query_index(snapshot, query=keyword_query)
+        messages: List[Message],
+        should_post_process_docs: bool,
+        use_answer_cache: bool
+    ) -> PromptHandle:
+        # the question, the keyword query and the embedding for the answer cache are generated at the same
+        # time, the answer cache is looked up before the index is queried, and the index is queried as soon as
+        # the keyword query is ready, while the question may still be generating
+        question_task = asyncio.create_task(generate_question_from_messages(messages, chat))
+        keyword_query_task = asyncio.create_task(generate_keyword_query_from_messages(messages, chat))
+        embedding_task = asyncio.create_task(answer_cache.embed(messages, use_answer_cache))
+        try:
+            await asyncio.wait([question_task, keyword_query_task], return_when=asyncio.FIRST_COMPLETED)
+            if question_task.done() and _is_no_question(question_task.result()):
+                return ChatService._generate_answer_without_index(chat, messages)
+
+            snapshot = ChatService.find_most_recent_snapshot_for_chat(chat)
+
+            cache_lookup = answer_cache.lookup(chat, messages, snapshot, await embedding_task)
+            if cache_lookup.answer is not None:
+                return ChatService._copy_finished_handle(chat, cache_lookup.answer.prompt_handle)
+
+            keyword_query = await keyword_query_task
+
+            index = IndexService()
+            docs = index.query_index(snapshot, query=keyword_query)
+
+            question = await question_task
+        finally:
+            question_task.cancel()
+            keyword_query_task.cancel()
+            embedding_task.cancel()
+
+        if _is_no_question(question):
+            return ChatService._generate_answer_without_index(chat, messages)
 
         if should_post_process_docs:
-            return await ChatService._generate_next_message_with_post_processed_docs(
-                messages,
-                chat,
-                next_message,
-                docs,
-                question
-            )
+            handle = await ChatService._generate_answer_with_post_processed_docs(messages, chat, docs, question)
+        else:
+            handle = ChatService._generate_answer_with_docs(messages, chat, docs)
 
-        return await ChatService._generate_next_message_with_docs(messages, chat, next_message, docs)
+        answer_cache.store(cache_lookup, handle)
+        return handle
 
     @staticmethod
-    async def _generate_next_message_with_vector_search(
+    async def _generate_answer_with_vector_search(
         chat: Chat,
-        next_message: Message,
+        messages: List[Message],
         embedding_model: LLMModel,
-        should_post_process_docs: bool
-    ) -> Message:
-        messages = [message for message in chat.get_student_and_assistant_messages()[:-1]]
+        should_post_process_docs: bool,
+        use_answer_cache: bool
+    ) -> PromptHandle:
+        # the embedding for the answer cache is generated while the question is
+        embedding_task = asyncio.create_task(answer_cache.embed(messages, use_answer_cache))
+        try:
+            question = await generate_question_from_messages(messages, chat)
+            if _is_no_question(question):
+                return ChatService._generate_answer_without_index(chat, messages)
 
-        question = await generate_question_from_messages(messages, chat)
-        if 'NO_QUESTION' in question.strip().upper():
-            return ChatService._generate_next_message_without_index(chat, next_message)
+            snapshot = ChatService.find_most_recent_snapshot_for_chat(chat)
 
-        snapshot = ChatService.find_most_recent_snapshot_for_chat(chat)
+            cache_lookup = answer_cache.lookup(chat, messages, snapshot, await embedding_task)
+        finally:
+            embedding_task.cancel()
+
+        if cache_lookup.answer is not None:
+            return ChatService._copy_finished_handle(chat, cache_lookup.answer.prompt_handle)
 
         index = IndexService()
         docs = await index.query_index_with_vector(
@@ -164,74 +228,66 @@ class ChatService:
         )
 
         if should_post_process_docs:
-            return await ChatService._generate_next_message_with_post_processed_docs(
-                messages,
-                chat,
-                next_message,
-                docs,
-                question
-            )
+            handle = await ChatService._generate_answer_with_post_processed_docs(messages, chat, docs, question)
+        else:
+            handle = ChatService._generate_answer_with_docs(messages, chat, docs)
 
-        return await ChatService._generate_next_message_with_docs(messages, chat, next_message, docs)
+        answer_cache.store(cache_lookup, handle)
+        return handle
 
     @staticmethod
-    async def _generate_next_message_with_docs(
-        messages: List[Message],
-        chat: Chat,
-        next_message: Message,
-        docs: List[Document],
-    ) -> Message:
+    def _generate_answer_with_docs(messages: List[Message], chat: Chat, docs: List[Document]) -> PromptHandle:
         prompt = prompts.prompt_make_next_ai_message_with_documents(messages, docs)
-        handle = LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
-
-        next_message.refresh()
-        next_message.prompt_handle = handle
-        next_message.state = Message.States.READY
-        next_message.save()
-
-        ChatService._trigger_feedback_message_if_matching_trigger_exists(chat)
-
-        return next_message
+        return LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
 
     @staticmethod
-    async def _generate_next_message_with_post_processed_docs(
+    async def _generate_answer_with_post_processed_docs(
         messages: List[Message],
         chat: Chat,
-        next_message: Message,
         docs: List[Document],
         question: str
-    ) -> Message:
+    ) -> PromptHandle:
         post_processed_docs = list(await asyncio.gather(
             *[post_process_document(chat, doc, question) for doc in docs]
         ))
 
         prompt = prompts.prompt_make_next_ai_message_with_post_processed_documents(messages, post_processed_docs)
-        handle = LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
-
-        next_message.refresh()
-        next_message.prompt_handle = handle
-        next_message.state = Message.States.READY
-        next_message.save()
-
-        ChatService._trigger_feedback_message_if_matching_trigger_exists(chat)
-
-        return next_message
+        return LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
 
     @staticmethod
-    def _generate_next_message_without_index(chat: Chat, next_message: Message) -> Message:
-        messages = [message for message in chat.get_student_and_assistant_messages()[:-1]]
+    def _generate_answer_without_index(chat: Chat, messages: List[Message]) -> PromptHandle:
         prompt = prompts.prompt_make_next_ai_message(messages)
+        return LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
 
-        handle = LLMService.dispatch_prompt(prompt, chat.llm_model_name, chat.llm_model_params)
+    @staticmethod
+    def _find_precomputed_faq_answer(chat: Chat, faq: Faq) -> Optional[PromptHandle]:
+        try:
+            snapshot = ChatService.find_most_recent_snapshot_for_chat(chat)
+        except NoValidSnapshotException:
+            return None
 
-        next_message.refresh()
-        next_message.state = Message.States.READY
-        next_message.prompt_handle = handle
-        next_message.save()
+        faq_answer = find_finished_faq_answer(faq, snapshot, chat.llm_model_name, chat.index_type)
+        if faq_answer is None:
+            return None
 
-        ChatService._trigger_feedback_message_if_matching_trigger_exists(chat)
+        log().info(f"answering faq {faq.id} in chat {chat.id} with precomputed answer {faq_answer.id}")
+        return ChatService._copy_finished_handle(chat, faq_answer.prompt_handle)
 
-        return next_message
+    @staticmethod
+    def _copy_finished_handle(chat: Chat, finished_handle: PromptHandle) -> PromptHandle:
+        # the copy is created finished, so the answer is shown straight away rather than streamed
+        handle = PromptHandle(
+            prompt=finished_handle.prompt,
+            llm_model_name=chat.llm_model_name,
+            llm_model_params=chat.llm_model_params,
+            state=PromptHandle.States.FINISHED,
+            time_spent_pending_ms=0,
+            response=finished_handle.response,
+            response_length=finished_handle.response_length,
+            response_time_taken_s=0,
+        )
+        handle.save()
+        return handle
 
     @staticmethod
     def _trigger_feedback_message_if_matching_trigger_exists(chat: Chat):
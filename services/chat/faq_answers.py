@@ -0,0 +1,82 @@
+"""
+Answers to the FAQs of a course, generated ahead of time.
+
+The FAQs of a course only change with its FAQ snapshot, and most first messages in a chat are a click on one
+of them. The answer to every FAQ of the latest FAQ snapshot is therefore generated in the background, against
+the current snapshot of the course, for every active chat config, and a click on a FAQ is answered with a
+copy of the finished answer instead of running the chat pipeline.
+"""
+
+from typing import List
+
+from db.actions.faq_answer import (
+    find_faq_answer,
+    delete_failed_faq_answers_of_course,
+    delete_faq_answers_of_course_not_in_snapshots,
+)
+from db.models import ChatConfig, Chat, Course, FaqAnswer, Message
+from services.crawler.crawler import CrawlerService, NoValidSnapshotException
+from db.actions.faq_snapshot import find_latest_faq_snapshot_for_course
+from services.chat.chat_service import ChatService
+from config.logger import log
+
+
+async def precompute_faq_answers(course: Course, chat_configs: List[ChatConfig]) -> int:
+    """
+    Dispatch the answers to the FAQs of the course that haven't been generated against the current snapshot
+    of the course, and delete the answers generated against earlier snapshots. Answers that failed are deleted
+    and dispatched again. Returns the number of answers dispatched.
+    """
+    faq_snapshot = find_latest_faq_snapshot_for_course(course)
+    if faq_snapshot is None:
+        return 0
+
+    try:
+        snapshot = CrawlerService.current_snapshot(course)
+    except NoValidSnapshotException:
+        return 0
+
+    deleted = delete_faq_answers_of_course_not_in_snapshots(course, snapshot, faq_snapshot)
+    if deleted > 0:
+        log().info(f"deleted {deleted} faq answers of previous snapshots of course {course.canvas_id}")
+
+    failed = delete_failed_faq_answers_of_course(course)
+    if failed > 0:
+        log().info(f"deleted {failed} failed faq answers of course {course.canvas_id}, dispatching them again")
+
+    dispatched = 0
+    for faq in faq_snapshot.faqs:
+        for chat_config in chat_configs:
+            if find_faq_answer(faq, snapshot, chat_config.llm_model_name, chat_config.index_type) is not None:
+                continue
+
+            # the chat and message are never saved, they only carry what the chat pipeline needs
+            chat = Chat(
+                course=course,
+                llm_model_name=chat_config.llm_model_name,
+                llm_model_params=ChatService.make_chat_params(course),
+                index_type=chat_config.index_type,
+                language=course.language,
+            )
+            message = Message(chat=chat, content=faq.question, sender=Message.Sender.STUDENT, faq=faq)
+
+            try:
+                # the answers are served from the faq answers, they don't belong in the answer cache as well
+                handle = await ChatService.generate_answer(chat, [message], use_answer_cache=False)
+            except Exception:  # noqa
+                log().error(f"failed to generate answer to faq {faq.id} of course {course.canvas_id}", exc_info=True)
+                continue
+
+            FaqAnswer(
+                faq=faq,
+                snapshot=snapshot,
+                llm_model_name=chat_config.llm_model_name,
+                index_type=chat_config.index_type,
+                prompt_handle=handle,
+            ).save()
+            dispatched += 1
+
+    if dispatched > 0:
+        log().info(f"dispatched {dispatched} faq answers for course {course.canvas_id}")
+
+    return dispatched
@@ -1,7 +1,8 @@
 from typing import List
+import asyncio
 
 from services.llm.llm import LLMService
-from db.models import Message, Chat
+from db.models import Message, Chat, PromptHandle
 from services.llm.prompts import (
     prompt_generate_question_from_chat_history,
     prompt_generate_keyword_query_from_chat_history
@@ -10,6 +11,16 @@ from llms.config import Params
 from config.logger import log
 
 
+async def _wait_for_handle_or_cancel(handle: PromptHandle):
+    # the chat service stops waiting for the keyword query, or the question, once it knows it has no use
+    # for it, and the handle is then cancelled so that no worker spends time on it
+    try:
+        await LLMService.wait_for_handle(handle)
+    except asyncio.CancelledError:
+        LLMService.cancel(handle)
+        raise
+
+
 async def generate_question_from_messages(messages: List[Message], chat: Chat) -> str:
     log().debug(f"generating questions for message in chat {chat.id}")
 
@@ -18,7 +29,7 @@ async def generate_question_from_messages(messages: List[Message], chat: Chat) -
 
     prompt = prompt_generate_question_from_chat_history(messages, chat.language)
     handle = LLMService.dispatch_prompt(prompt, chat.llm_model_name, params)
-    await LLMService.wait_for_handle(handle)
+    await _wait_for_handle_or_cancel(handle)
 
     response = handle.response
     response = response.replace('</question>', '')
@@ -36,7 +47,7 @@ async def generate_keyword_query_from_messages(messages: List[Message], chat: Ch
 
     prompt = prompt_generate_keyword_query_from_chat_history(messages, chat.language, chat.course.description)
     handle = LLMService.dispatch_prompt(prompt, chat.llm_model_name, params)
-    await LLMService.wait_for_handle(handle)
+    await _wait_for_handle_or_cancel(handle)
 
     response = handle.response
     response = response.replace('</query>', '')
@@ -0,0 +1,72 @@
+"""
+A content addressed cache of embeddings, shared by all snapshots.
+
+Most of a course room doesn't change between two snapshots, so most of the chunks that are indexed
+have been embedded before. The cache is keyed by the embedding model and the sha256 of a key given by the
+caller, which identifies the input of the embedding, so an entry can be reused by any snapshot of any course
+that produces the same key.
+"""
+
+from typing import Optional, List
+
+import arrow
+
+from db.actions.cached_embedding import (
+    find_cached_embedding,
+    delete_cached_embeddings_not_used_since,
+    delete_least_recently_used_cached_embeddings,
+)
+from services.llm.supported_models import LLMModel
+from db.models import CachedEmbedding
+import config.settings as settings
+from config.logger import log
+
+
+class EmbeddingCache:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, llm_model_name: LLMModel, key: str) -> Optional[List[float]]:
+        cached = find_cached_embedding(llm_model_name, CachedEmbedding.make_sha(key))
+        if cached is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        CachedEmbedding.update(
+            last_used_at=arrow.utcnow(),
+            hits=CachedEmbedding.hits + 1,
+        ).where(
+            CachedEmbedding.id == cached.id
+        ).execute()
+
+        return cached.embedding
+
+    def put(self, llm_model_name: LLMModel, key: str, embedding: List[float]):
+        # two urls with the same content can be indexed at the same time, in which
+        # case the embedding that was stored first is kept
+        CachedEmbedding.insert(
+            llm_model_name=llm_model_name,
+            sha=CachedEmbedding.make_sha(key),
+            embedding=embedding,
+        ).on_conflict_ignore().execute()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+
+def evict_cached_embeddings():
+    ttl_days = settings.get_settings().EMBEDDING_CACHE_TTL_DAYS
+    max_entries = settings.get_settings().EMBEDDING_CACHE_MAX_ENTRIES
+
+    expired = delete_cached_embeddings_not_used_since(arrow.utcnow().shift(days=-ttl_days))
+    overflowing = delete_least_recently_used_cached_embeddings(keep=max_entries)
+
+    if expired + overflowing > 0:
+        log().info(f"evicted {expired} expired and {overflowing} least recently used embeddings from the cache")
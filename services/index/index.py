@@ -1,47 +1,139 @@
-from typing import List
+from typing import List, Optional
+import asyncio
 
 from services.llm.supported_models import LLMModel, EMBEDDING_MODELS, get_enum_from_enum_value
+from db.actions.url import find_indexed_url_with_content_sha_in_other_snapshot
 from services.llm.prompts import prompt_create_document_summary
 from services.index.chunks import split_text_with_overlap
+from services.index.embedding_cache import EmbeddingCache
 from llms.openai import truncate_text_to_token_limit
 import services.index.opensearch as search
-from db.models import Url, Snapshot
+from db.models import Url, Snapshot, PromptHandle
 import config.settings as settings
 from llms.config import Params
 import services.llm.llm as llm
 from config.logger import log
 
 
+class EmbeddingRequest:
+
+    def __init__(self, llm_model_name: LLMModel, text: str, cache_key: str):
+        self.llm_model_name = llm_model_name
+        self.text = text
+        self.cache_key = cache_key
+        self.embedding: Optional[List[float]] = None
+        self.handle: Optional[PromptHandle] = None
+
+
 class IndexService:
 
     def __init__(self):
         self.client = search.get_client()
+        self.embedding_cache = EmbeddingCache()
+        self.embedding_semaphore = asyncio.Semaphore(settings.get_settings().INDEX_MAX_CONCURRENT_EMBEDDING_WAITS)
 
     async def index_url(self, url: Url):
         if not search.index_exists(self.client, url.snapshot.id):
             search.create_index(self.client, url.snapshot.id)
 
-        summary = await self._create_document_summary(url.content.text, url.snapshot.course.language)
+        copied = False
+        if settings.get_settings().INDEX_UNCHANGED_CONTENT_BY_COPYING:
+            copied = self._copy_documents_of_unchanged_content(url)
 
-        chunks = split_text_with_overlap(url.content.text)
-        for idx, chunk in enumerate(chunks):
-            document_text = self._create_document_text(idx, len(chunks), chunk, summary)
-            sfr_embedding_mistral = await self._get_sfr_embedding_mistral_embeddings(document_text)
-            text_embedding_3_large = await self._get_text_embedding_3_large_embeddings(document_text)
-
-            search.index_document(self.client, url.snapshot, f"{url.id}-{idx}", {
-                'name': url.content.name,
-                'text': document_text,
-                'text_raw': chunk,
-                'url': url.href,
-                'sfr_embedding_mistral': sfr_embedding_mistral,
-                'text_embedding_3_large': text_embedding_3_large,
-            })
+        if not copied:
+            await self._index_content(url)
 
         url.refresh()
         url.state = Url.States.INDEXED
         url.save()
 
+    def _copy_documents_of_unchanged_content(self, url: Url) -> bool:
+        """
+        If the content of the url was indexed in an earlier snapshot of the course, copy the documents of
+        that content into the index of this snapshot, summary, text and embeddings included, instead of
+        creating them again. Returns False if there was nothing to copy.
+        """
+        sha = url.content.sha
+        previous_url = find_indexed_url_with_content_sha_in_other_snapshot(url.snapshot, sha)
+        if previous_url is None:
+            return False
+
+        previous_index = previous_url.snapshot.id
+        if not search.index_exists(self.client, previous_index):
+            return False
+
+        documents = search.find_documents_with_content_sha(self.client, previous_index, sha)
+        if len(documents) == 0:
+            return False
+
+        copies = {}
+        for doc_id, body in documents.items():
+            chunk_idx = doc_id.split('-')[-1]
+            copies[f"{url.id}-{chunk_idx}"] = {**body, 'name': url.content.name, 'url': url.href}
+
+        log().info(f"content of url {url.id} is unchanged since snapshot {previous_index}, "
+                   f"copying its {len(copies)} documents instead of indexing it again")
+        search.index_documents(self.client, url.snapshot.id, copies)
+        return True
+
+    async def _index_content(self, url: Url):
+        # the hit and miss counters of the embedding cache are reported per url
+        self.embedding_cache = EmbeddingCache()
+
+        summary = await self._create_document_summary(url.content.text, url.snapshot.course.language)
+
+        chunks = split_text_with_overlap(url.content.text)
+        document_texts = [
+            self._create_document_text(idx, len(chunks), chunk, summary) for idx, chunk in enumerate(chunks)
+        ]
+        cache_keys = [
+            self._create_embedding_cache_key(url.content.sha, idx, len(chunks), chunk)
+            for idx, chunk in enumerate(chunks)
+        ]
+
+        # the embeddings of every chunk are requested before waiting for any of them,
+        # so that the embedding workers can claim and compute them in batches
+        log().debug(f"requesting embeddings for {len(chunks)} chunks...")
+        sfr_embedding_mistral_requests = [
+            self._request_embedding(LLMModel.SALESFORCE_SFR_EMBEDDING_MISTRAL, text, key)
+            for text, key in zip(document_texts, cache_keys)
+        ]
+        text_embedding_3_large_requests = [
+            self._request_embedding(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, text, key)
+            for text, key in zip(document_texts, cache_keys)
+        ]
+
+        async def embed_chunk(idx: int) -> (int, List[float], List[float]):
+            sfr_embedding_mistral, text_embedding_3_large = await asyncio.gather(
+                self._get_sfr_embedding_mistral_embeddings(sfr_embedding_mistral_requests[idx]),
+                self._get_text_embedding_3_large_embeddings(text_embedding_3_large_requests[idx]),
+            )
+            return idx, sfr_embedding_mistral, text_embedding_3_large
+
+        # the embeddings of all chunks are waited for at the same time, and each
+        # chunk is handed to the indexer as soon as both of its embeddings are done
+        indexer = search.BulkIndexer(self.client, url.snapshot.id)
+        tasks = [asyncio.ensure_future(embed_chunk(idx)) for idx in range(len(chunks))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                idx, sfr_embedding_mistral, text_embedding_3_large = await task
+                indexer.add(f"{url.id}-{idx}", {
+                    'name': url.content.name,
+                    'text': document_texts[idx],
+                    'text_raw': chunks[idx],
+                    'url': url.href,
+                    'sfr_embedding_mistral': sfr_embedding_mistral,
+                    'text_embedding_3_large': text_embedding_3_large,
+                    'content_sha': url.content.sha,
+                })
+        finally:
+            for task in tasks:
+                task.cancel()
+        indexer.close()
+
+        log().info(f"embedding cache had {self.embedding_cache.hits} hits and {self.embedding_cache.misses} misses "
+                   f"for url {url.id}, hit rate: {self.embedding_cache.hit_rate:.0%}")
+
     async def _create_document_summary(self, text: str, language: str) -> str:
         # using the openai tokeniser, which may not yield the same token count as
         # the model set in MODEL_USED_FOR_SUMMARIES. However, it's a decent estimate
@@ -71,17 +163,36 @@ Document summary: {summary}
 Chunk content: {text}
         """.strip()
 
-    async def _get_sfr_embedding_mistral_embeddings(self, text: str) -> List[float]:
-        log().debug("requesting SALESFORCE_SFR_EMBEDDING_MISTRAL embedding...")
-        handle = llm.LLMService.dispatch_prompt(text, LLMModel.SALESFORCE_SFR_EMBEDDING_MISTRAL)
-        handle = await llm.LLMService.wait_for_handle(handle, timeout_seconds=20 * 60)
-        return handle.embedding
-
-    async def _get_text_embedding_3_large_embeddings(self, text: str) -> List[float]:
-        log().debug("requesting OPENAI_TEXT_EMBEDDING_3_LARGE embedding...")
-        handle = llm.LLMService.dispatch_prompt(text, LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE)
-        handle = await llm.LLMService.wait_for_handle(handle)
-        return handle.embedding
+    def _create_embedding_cache_key(self, content_sha: str, chunk_idx: int, chunk_count: int, text: str) -> str:
+        # the summary in the document text is sampled, so it's different every time the same content is
+        # indexed. The embeddings are instead cached by the content and chunk they were made for, and the
+        # embedding of a chunk is reused even if the summary it was made with differs from the new one
+        return f"{content_sha}:{chunk_idx + 1}/{chunk_count}:{text}"
+
+    def _request_embedding(self, llm_model_name: LLMModel, text: str, cache_key: str) -> EmbeddingRequest:
+        request = EmbeddingRequest(llm_model_name, text, cache_key)
+        request.embedding = self.embedding_cache.get(llm_model_name, cache_key)
+        if request.embedding is None:
+            request.handle = llm.LLMService.dispatch_prompt(text, llm_model_name)
+        return request
+
+    async def _wait_for_embedding(self, request: EmbeddingRequest, timeout_seconds: int = 120) -> List[float]:
+        if request.embedding is not None:
+            return request.embedding
+
+        async with self.embedding_semaphore:
+            handle = await llm.LLMService.wait_for_handle(request.handle, timeout_seconds=timeout_seconds)
+        request.embedding = handle.embedding
+        self.embedding_cache.put(request.llm_model_name, request.cache_key, request.embedding)
+        return request.embedding
+
+    async def _get_sfr_embedding_mistral_embeddings(self, request: EmbeddingRequest) -> List[float]:
+        log().debug("waiting for SALESFORCE_SFR_EMBEDDING_MISTRAL embedding...")
+        return await self._wait_for_embedding(request, timeout_seconds=20 * 60)
+
+    async def _get_text_embedding_3_large_embeddings(self, request: EmbeddingRequest) -> List[float]:
+        log().debug("waiting for OPENAI_TEXT_EMBEDDING_3_LARGE embedding...")
+        return await self._wait_for_embedding(request)
 
     def query_index(self, snapshot: Snapshot, query: str) -> List[search.Document]:
         return search.search_index(self.client, snapshot.id, query)
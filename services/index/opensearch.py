@@ -1,12 +1,18 @@
-from typing import List
+from typing import List, Dict
+import json
+import time
 
-from opensearchpy import OpenSearch
+from opensearchpy import OpenSearch, helpers
 
 from services.llm.supported_models import EMBEDDING_MODELS, EMBEDDING_MODELS_DIMENSIONS
 import config.settings as settings
 from config.logger import log
 
 
+class BulkIndexingError(Exception):
+    pass
+
+
 class Document:
 
     def __init__(self, name: str, url: str, text: str):
@@ -50,6 +56,9 @@ def create_index(client: OpenSearch, index_name: str):
         },
         'mappings': {
             'properties': {
+                'content_sha': {
+                    'type': 'keyword',
+                },
             }
         }
     }
@@ -72,14 +81,98 @@ def create_index(client: OpenSearch, index_name: str):
     )
 
 
-def index_document(client: OpenSearch, index_name: str, doc_id: str, body: dict) -> str:
-    log().info(f"add document with id '{doc_id}' to index '{index_name}'")
-    client.index(
-        index=index_name,
-        id=doc_id,
-        body=body,
-        refresh=True,
-    )
+def index_documents(client: OpenSearch, index_name: str, documents: Dict[str, dict]):
+    indexer = BulkIndexer(client, index_name)
+    for doc_id, body in documents.items():
+        indexer.add(doc_id, body)
+    indexer.close()
+
+
+class BulkIndexer:
+    """
+    Buffers documents for an index and writes them with the _bulk api, instead of one request per document.
+
+    The buffer is flushed when it holds max_documents documents or max_bytes of json, or when a document is
+    added more than max_interval_seconds after the last flush. The interval is only checked by add(), there
+    is no timer, so documents can stay buffered for longer than max_interval_seconds if no other document is
+    added, until the next add() or close(). The index is only refreshed once, when the indexer is closed, so
+    the documents become searchable together, and an earlier flush wouldn't make them searchable any sooner.
+    Documents that the cluster rejects are collected, and reported by close() with a BulkIndexingError.
+    """
+
+    def __init__(
+        self,
+        client: OpenSearch,
+        index_name: str,
+        max_documents: int = 100,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_interval_seconds: float = 5,
+    ):
+        self.client = client
+        self.index_name = index_name
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_interval_seconds = max_interval_seconds
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time.monotonic()
+        self.indexed = 0
+        self.failures = []
+
+    def add(self, doc_id: str, body: dict):
+        self.buffer.append({'_index': self.index_name, '_id': doc_id, '_source': body})
+        self.buffered_bytes += len(json.dumps(body))
+
+        if len(self.buffer) >= self.max_documents or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+        elif time.monotonic() - self.last_flush >= self.max_interval_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if len(self.buffer) == 0:
+            return
+
+        log().info(f"bulk indexing {len(self.buffer)} documents into index '{self.index_name}'")
+        indexed, failures = helpers.bulk(self.client, self.buffer, raise_on_error=False)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.indexed += indexed
+
+        for failure in failures:
+            log().error(f"failed to index document into index '{self.index_name}': {failure}")
+        self.failures += failures
+
+    def close(self):
+        self.flush()
+        self.client.indices.refresh(index=self.index_name)
+
+        if len(self.failures) > 0:
+            failed_ids = [_failed_document_id(failure) for failure in self.failures]
+            raise BulkIndexingError(f"{len(self.failures)} documents could not be added to index "
+                                    f"'{self.index_name}': {failed_ids}")
+
+
+def _failed_document_id(failure: dict) -> str:
+    for item in failure.values():
+        return item.get('_id')
+
+
+def find_documents_with_content_sha(client: OpenSearch, index_name: str, content_sha: str) -> Dict[str, dict]:
+    log().info(f"finding documents with content sha '{content_sha}' in index '{index_name}'")
+    query = {
+        'query': {
+            'term': {
+                'content_sha': content_sha,
+            }
+        }
+    }
+
+    documents = {}
+    for doc in helpers.scan(client, index=index_name, query=query):
+        documents[doc['_id']] = doc['_source']
+
+    return documents
 
 
 def search_index(client: OpenSearch, index_name: str, query_string: str, max_docs: int = 3) -> List[Document]:
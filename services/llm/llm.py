@@ -1,14 +1,27 @@
+from typing import Optional, List
 import asyncio
-from typing import Optional
 import time
 
+from redis.exceptions import RedisError
 from redis.asyncio import Redis
+import arrow
 
-from db.actions.prompt_handles import find_most_recent_pending_handle_for_model
+from db.actions.prompt_handles import (
+    find_most_recent_pending_handle_for_model,
+    claim_pending_handles_for_model,
+    fail_prompt_handle_if_pending,
+)
 from services.llm.supported_models import LLMModel
+import cache.notifications as notifications
+from cache.stream_hub import get_stream_hub
 from db.models import PromptHandle
+import config.settings as settings
+from config.logger import log
 from llms.config import Params
-import cache.mutex as mutex
+
+# waiting for a prompt handle relies on the notification published by the
+# worker, the database is only polled at this interval as a fallback
+FALLBACK_POLL_INTERVAL_SECONDS = 2
 
 
 class NoPendingPromptHandleError(Exception):
@@ -19,6 +32,10 @@ class LLMServiceTimeoutException(Exception):
     pass
 
 
+class LLMServiceFailedException(Exception):
+    pass
+
+
 class LLMService:
 
     def __init__(self, model: LLMModel, redis: Redis):
@@ -35,32 +52,82 @@ class LLMService:
         handle.save()
         return handle
 
+    @staticmethod
+    def cancel(handle: PromptHandle):
+        """
+        Give up on a handle whose response is no longer needed. A handle that no worker has claimed yet is
+        marked as failed, so that workers skip it, a handle that is already in progress is left to finish.
+        """
+        if fail_prompt_handle_if_pending(handle):
+            log().debug(f"cancelled pending prompt handle {handle.id}")
+
     @staticmethod
     async def wait_for_handle(handle: PromptHandle, timeout_seconds: int = 120) -> PromptHandle:
+        """
+        Wait until a worker has finished the handle. The worker publishes a notification on the
+        handle's channel when it's done, so the handle is only re-read from the database when that
+        notification arrives, or every few seconds as a fallback in case the notification is missed.
+        The notification is received through the stream hub shared by the whole process, and a handle
+        that has already finished is returned without subscribing at all.
+        """
         start_time = time.monotonic()
-        while True:
-            handle.refresh()
-            if handle.state == PromptHandle.States.FINISHED:
-                break
-            elif time.monotonic() - start_time > timeout_seconds:
-                raise LLMServiceTimeoutException(f"Waiting for prompt handle {handle.id} timed out.")
-            await asyncio.sleep(0.01)
-        return handle
 
-    async def checkout(self) -> PromptHandle:
-        handle = self.next()
+        handle.refresh()
+        if handle.state == PromptHandle.States.FINISHED:
+            return handle
+        elif handle.state == PromptHandle.States.FAILED:
+            raise LLMServiceFailedException(f"Prompt handle {handle.id} failed.")
 
-        lock_name = f'prompt_handle_{handle.id}'
-        await mutex.acquire_lock(self.redis, lock_name)
+        hub = None
+        subscription = None
+        try:
+            hub = await get_stream_hub()
+            subscription = await hub.subscribe(notifications.prompt_handle_channel(handle.id))
+        except RedisError:
+            log().warning(f"failed to subscribe to notifications of prompt handle {handle.id}, "
+                          f"falling back to polling the database.")
 
         try:
-            handle.state = PromptHandle.States.IN_PROGRESS
-            handle.save()
+            while True:
+                # the handle is refreshed after subscribing, so that a notification
+                # sent before the subscription was made can't be missed
+                handle.refresh()
+                if handle.state == PromptHandle.States.FINISHED:
+                    break
+                elif handle.state == PromptHandle.States.FAILED:
+                    raise LLMServiceFailedException(f"Prompt handle {handle.id} failed.")
+                elif time.monotonic() - start_time > timeout_seconds:
+                    raise LLMServiceTimeoutException(f"Waiting for prompt handle {handle.id} timed out.")
+
+                if subscription is not None:
+                    try:
+                        await asyncio.wait_for(subscription.queue.get(), timeout=FALLBACK_POLL_INTERVAL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(FALLBACK_POLL_INTERVAL_SECONDS)
         finally:
-            await mutex.release_lock(self.redis, lock_name)
+            if subscription is not None:
+                await hub.unsubscribe(subscription)
 
         return handle
 
+    async def checkout(self) -> PromptHandle:
+        handles = self.claim(1)
+        if len(handles) == 0:
+            raise NoPendingPromptHandleError("no pending handles was found")
+        return handles[0]
+
+    def claim(self, limit: int = 1) -> List[PromptHandle]:
+        """
+        Claim up to `limit` of the oldest pending handles for the model, in a single query. Handles claimed
+        by another worker at the same time are skipped rather than waited for, so the returned list may be
+        shorter than the limit, or empty. Handles that have been in progress for longer than
+        LLM_WORKER_CLAIM_TIMEOUT_SECONDS are claimed again, in case the worker that claimed them died.
+        """
+        claim_timeout = settings.get_settings().LLM_WORKER_CLAIM_TIMEOUT_SECONDS
+        return claim_pending_handles_for_model(self.model, limit, arrow.utcnow().shift(seconds=-claim_timeout))
+
     def next(self) -> PromptHandle:
         handle = find_most_recent_pending_handle_for_model(self.model)
         if handle is None:
@@ -0,0 +1,57 @@
+from typing import Callable
+import asyncio
+import time
+
+
+class _Bucket:
+
+    def __init__(self, per_minute: int, clock: Callable[[], float]):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.refill_per_second = per_minute / 60
+        self.clock = clock
+        self.last_refill = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    def seconds_until_available(self, amount: float) -> float:
+        missing = amount - self.level
+        if missing <= 0:
+            return 0
+        return missing / self.refill_per_second
+
+
+class RateLimiter:
+    """
+    A token bucket for the requests per minute and one for the tokens per minute of an api. Callers are
+    let through in the order they called acquire, once both buckets have room for their request.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, clock: Callable[[], float] = time.monotonic):
+        self.requests = _Bucket(requests_per_minute, clock)
+        self.tokens = _Bucket(tokens_per_minute, clock)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        # a request larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tokens.capacity)
+
+        async with self.lock:
+            while True:
+                self.requests.refill()
+                self.tokens.refill()
+
+                wait_seconds = max(
+                    self.requests.seconds_until_available(1),
+                    self.tokens.seconds_until_available(tokens),
+                )
+                if wait_seconds <= 0:
+                    break
+
+                await asyncio.sleep(wait_seconds)
+
+            self.requests.level -= 1
+            self.tokens.level -= tokens
@@ -0,0 +1,66 @@
+from typing import Optional
+import asyncio
+
+
+class TokenCoalescer:
+    """
+    Collects the tokens sent to a sink, such as a TokenStreamPublisher, and sends them on as a single piece of
+    text. The collected text is flushed once it reaches `max_chars` characters, or `max_delay_ms` milliseconds
+    after the first token was collected, whichever comes first. Most tokens are a few characters long, so this
+    cuts the redis publishes and websocket frames per response by several times, while the delay keeps the
+    stream feeling live.
+    """
+
+    def __init__(self, sink, max_delay_ms: int = 30, max_chars: int = 64):
+        self.sink = sink
+        self.max_delay_ms = max_delay_ms
+        self.max_chars = max_chars
+        self.buffer = ''
+        self.timer: Optional[asyncio.Task] = None
+        self.error: Optional[BaseException] = None
+        # keeps the pieces of text in order when the timer flushes while a flush is still sending
+        self.lock = asyncio.Lock()
+
+    async def send(self, text: str):
+        self._raise_error_of_timer()
+
+        self.buffer += text
+        if len(self.buffer) >= self.max_chars:
+            await self.flush()
+        elif self.timer is None and self.buffer:
+            self.timer = asyncio.create_task(self._flush_after_delay())
+
+    async def flush(self):
+        self._cancel_timer()
+        async with self.lock:
+            if not self.buffer:
+                return
+
+            text = self.buffer
+            self.buffer = ''
+            await self.sink.send(text)
+
+    async def finish(self):
+        self._raise_error_of_timer()
+        await self.flush()
+        await self.sink.finish()
+
+    async def _flush_after_delay(self):
+        await asyncio.sleep(self.max_delay_ms / 1000)
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # raised by the next call to send or finish, since nobody awaits this task
+            self.error = e
+
+    def _cancel_timer(self):
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+
+    def _raise_error_of_timer(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
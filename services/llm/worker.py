@@ -1,24 +1,32 @@
-from websockets import ConnectionClosedOK
-from typing import Callable
+from websockets import ConnectionClosedOK, ConnectionClosed, WebSocketClientProtocol
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional, Dict, List
+from functools import partial
 import websockets
 import asyncio
 import time
 
+from redis.exceptions import RedisError
 import arrow
 
+from cache.token_streams import TokenStreamPublisher, TERMINATION_STRING, end_token_stream, token_stream_channel
 from services.llm.supported_models import LLMModel, EMBEDDING_MODELS
-from services.llm.llm import LLMService, NoPendingPromptHandleError
+from llms.openai import count_tokens, MAX_TOKENS as OPENAI_MAX_TOKENS
+from llms.batching import ContinuousBatchingEngine, SequenceOutput
+from services.llm.rate_limiter import RateLimiter
+from services.llm.llm import LLMService
 from llms.generate import generate_text_streaming, load_hf_model
 from services.llm.prompts import prepend_system_prompt
-from cache.mutex import LockAlreadyAcquiredException
+from services.llm.token_coalescer import TokenCoalescer
+from llms.threaded import stream_in_thread
+import cache.notifications as notifications
 from llms.embeddings import compute_embedding
 from db.models import PromptHandle
+from db.connection import db
 import config.settings as settings
 from llms.config import Params
 from config.logger import log
 
-TERMINATION_STRING = "<<<END_OF_STREAM>>>"
-
 
 def _get_websocket_url(handle: PromptHandle) -> str:
     if settings.get_settings().PORT == 443:
@@ -34,6 +42,67 @@ def _get_websocket_url(handle: PromptHandle) -> str:
     return websocket_url
 
 
+def _set_time_spent_pending(handle: PromptHandle):
+    current_time = arrow.now()
+    wait_time = current_time - handle.created_at
+    handle.time_spent_pending_ms = wait_time.total_seconds() * 1000
+
+
+def _record_time_spent_pending(handle: PromptHandle):
+    _set_time_spent_pending(handle)
+    handle.save()
+
+
+def _create_token_stream_publisher(redis, handle: PromptHandle):
+    publisher = TokenStreamPublisher(
+        redis,
+        handle.websocket_uri,
+        compact=settings.get_settings().LLM_WORKER_COMPACT_TOKEN_FRAMES,
+        retention_seconds=settings.get_settings().LLM_WORKER_TOKEN_STREAM_RETENTION_SECONDS,
+    )
+    return _coalesce_tokens(publisher)
+
+
+def _coalesce_tokens(sink):
+    flush_interval_ms = settings.get_settings().LLM_WORKER_TOKEN_FLUSH_INTERVAL_MS
+    if flush_interval_ms <= 0:
+        return sink
+    return TokenCoalescer(sink, flush_interval_ms, settings.get_settings().LLM_WORKER_TOKEN_FLUSH_CHARS)
+
+
+def _get_prompt_and_params(handle: PromptHandle) -> (str, Params):
+    params = Params()
+    if handle.llm_model_params is not None:
+        params = handle.llm_model_params
+
+    prompt = handle.prompt
+    if handle.llm_model_name != LLMModel.OPENAI_GPT4:
+        prompt = prepend_system_prompt(params.system_prompt, handle.prompt)
+
+    return prompt, params
+
+
+class DanglingTagFilter:
+    """
+    Since the model has a tendency to generate <|user|> strings, this filter holds back
+    "<" and "<|" tokens until the next token arrives. This ensures the model doesn't
+    leave dangling "<|" tokens at the end of messages.
+    """
+
+    def __init__(self):
+        self.held_back = ''
+
+    def filter(self, token: str) -> Optional[str]:
+        token = self.held_back + token
+        self.held_back = ''
+
+        if token == '<' or token == '<|':
+            self.held_back = token
+            return None
+
+        return token
+
+
 class Worker:
 
     def __init__(
@@ -44,13 +113,28 @@ class Worker:
             model_loader_func: Callable = load_hf_model,
             text_generator: Callable = generate_text_streaming,
             embedding_function: Callable = compute_embedding,
+            batch_embedding_function: Optional[Callable] = None,
+            embedding_batch_size: Optional[int] = None,
+            embedding_claim_size: Optional[int] = None,
+            generate_in_thread: bool = True,
     ):
         self.service = llm_service
         self.running = False
         self.llm_model_name = llm_model_name.value
         self.device = device
         self.text_generator = text_generator
+        self.generation_executor = None
+        if generate_in_thread:
+            # a single thread, so the model is only ever run by one generation at a time
+            self.generation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generation')
         self.embedding_function = embedding_function
+        self.batch_embedding_function = batch_embedding_function
+        self.embedding_batch_size = embedding_batch_size or settings.get_settings().LLM_WORKER_EMBEDDING_BATCH_SIZE
+        # several batches are claimed at a time, so the texts can be sorted by length across batches
+        self.embedding_claim_size = max(
+            embedding_claim_size or settings.get_settings().LLM_WORKER_EMBEDDING_CLAIM_SIZE,
+            self.embedding_batch_size,
+        )
 
         log().info(f"Loading model \"{self.llm_model_name}\" onto device \"{self.device}\"")
         self.model, self.tokenizer = model_loader_func(self.llm_model_name, self.device)
@@ -60,10 +144,7 @@ class Worker:
         log().info(f"Processing handle with id {handle.id} created at {handle.created_at}")
         log().debug(f"The prompt of the handle is: \"{handle.prompt}\"")
 
-        current_time = arrow.now()
-        wait_time = current_time - handle.created_at
-        handle.time_spent_pending_ms = wait_time.total_seconds() * 1000
-        handle.save()
+        _record_time_spent_pending(handle)
 
         if handle.llm_model_name in EMBEDDING_MODELS:
             return await self._process_embedding_prompt_handle(handle)
@@ -91,66 +172,56 @@ class Worker:
         handle.response_time_taken_s = int(time_taken)
         handle.save()
 
-    async def _process_standard_prompt_handle(self, handle: PromptHandle):
-        websocket_url = _get_websocket_url(handle)
+        await self._notify_finished(handle)
+
+    async def process_embedding_prompt_handles(self, handles: List[PromptHandle]):
+        log().info(f"Processing {len(handles)} embedding handles with ids {[handle.id for handle in handles]}")
+
+        for handle in handles:
+            _set_time_spent_pending(handle)
+
+        log().debug("compute embeddings...")
+        start_time = time.time()
 
+        prompts = [handle.prompt for handle in handles]
+        embeddings = await self.batch_embedding_function(self.model, self.tokenizer, prompts, self.embedding_batch_size)
+
+        end_time = time.time()
+        time_taken = end_time - start_time
+
+        log().debug(f"finished computing {len(embeddings)} embeddings.")
+
+        with db.atomic():
+            for handle, embedding in zip(handles, embeddings):
+                handle.embedding = embedding
+                handle.state = PromptHandle.States.FINISHED
+                handle.response_length = 0
+                handle.response_time_taken_s = int(time_taken)
+                handle.save()
+
+        for handle in handles:
+            await self._notify_finished(handle)
+
+    async def _process_standard_prompt_handle(self, handle: PromptHandle):
         response = ""
         number_of_tokens = 0
         time_taken = None
 
-        log().debug(f"connecting to websocket {websocket_url}")
         try:
-            async with websockets.connect(websocket_url) as websocket:
-                log().debug("generating response...")
-
-                params = Params()
-                if handle.llm_model_params is not None:
-                    params = handle.llm_model_params
-
-                prompt = handle.prompt
-                if handle.llm_model_name != LLMModel.OPENAI_GPT4:
-                    prompt = prepend_system_prompt(params.system_prompt, handle.prompt)
-
-                index = 1
-                start_time = time.time()
-                found_less_than = False
-                found_less_than_and_pipe = False
-                async for token in self.text_generator(self.model, self.tokenizer, self.device, params, prompt):
-                    # since the model has a tendency to generate <|user|> strings
-                    # this check is here to ensure the model doesn't start generating
-                    # dangling "<|" tokens at the end of messages
-                    if found_less_than:
-                        token = f'<{token}'
-                        found_less_than = False
-
-                    if found_less_than_and_pipe:
-                        token = f'<|{token}'
-                        found_less_than_and_pipe = False
-
-                    if token == '<':
-                        found_less_than = True
-                        continue
-
-                    if token == '<|':
-                        found_less_than_and_pipe = True
-                        continue
-
-                    await websocket.send(token)
-
-                    response += token
-                    index += 1
-                    number_of_tokens += 1
-                    if index % 50 == 0:
-                        log().info(f"Generated {index} tokens...")
-
-                end_time = time.time()
-                time_taken = end_time - start_time
-                await websocket.send(TERMINATION_STRING)
-                await websocket.close()
+            if settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS:
+                log().debug(f"publishing tokens to the token stream of handle {handle.id}")
+                sink = _create_token_stream_publisher(self.service.redis, handle)
+                response, number_of_tokens, time_taken = await self._stream_response(handle, sink)
+            else:
+                websocket_url = _get_websocket_url(handle)
+                log().debug(f"connecting to websocket {websocket_url}")
+                async with websockets.connect(websocket_url) as websocket:
+                    sink = _coalesce_tokens(_WebsocketTokenSink(websocket))
+                    response, number_of_tokens, time_taken = await self._stream_response(handle, sink)
+                log().debug("Disconnected from the websocket")
         except ConnectionClosedOK:
             log().warning("Websocket closed by the server, with: ConnectionClosedOK.")
 
-        log().debug("Disconnected from the websocket")
         log().debug(f"The complete response was: {response}")
 
         handle.refresh()
@@ -160,22 +231,379 @@ class Worker:
         handle.response_time_taken_s = int(time_taken)
         handle.save()
 
+        await self._notify_finished(handle)
+
+    async def _stream_response(self, handle: PromptHandle, sink) -> (str, int, float):
+        log().debug("generating response...")
+
+        prompt, params = _get_prompt_and_params(handle)
+
+        response = ""
+        number_of_tokens = 0
+        index = 1
+        start_time = time.time()
+        tag_filter = DanglingTagFilter()
+        async for token in self._generate_text(params, prompt):
+            token = tag_filter.filter(token)
+            if token is None:
+                continue
+
+            await sink.send(token)
+
+            response += token
+            index += 1
+            number_of_tokens += 1
+            if index % 50 == 0:
+                log().info(f"Generated {index} tokens...")
+
+        end_time = time.time()
+        time_taken = end_time - start_time
+        await sink.finish()
+
+        return response, number_of_tokens, time_taken
+
+    def _generate_text(self, params: Params, prompt: str):
+        def create_generator():
+            return self.text_generator(self.model, self.tokenizer, self.device, params, prompt)
+
+        if self.generation_executor is None:
+            return create_generator()
+        return stream_in_thread(create_generator, self.generation_executor)
+
+    async def _fail(self, handles: List[PromptHandle]):
+        # the handles are marked as failed, rather than left in progress, so that
+        # whoever is waiting for them stops waiting as soon as they're notified
+        PromptHandle.update(state=PromptHandle.States.FAILED).where(
+            PromptHandle.id << [handle.id for handle in handles]
+        ).execute()
+
+        for handle in handles:
+            if handle.llm_model_name not in EMBEDDING_MODELS:
+                await self._end_token_stream(handle)
+            await self._notify_finished(handle)
+
+    async def _end_token_stream(self, handle: PromptHandle):
+        try:
+            if settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS:
+                await end_token_stream(
+                    self.service.redis,
+                    handle.websocket_uri,
+                    compact=settings.get_settings().LLM_WORKER_COMPACT_TOKEN_FRAMES,
+                    retention_seconds=settings.get_settings().LLM_WORKER_TOKEN_STREAM_RETENTION_SECONDS,
+                )
+            else:
+                # the http api forwards the plain text published on behalf of websocket workers as is
+                await self.service.redis.publish(token_stream_channel(handle.websocket_uri), TERMINATION_STRING)
+        except RedisError:
+            log().error(f"failed to end the token stream of handle {handle.id}", exc_info=True)
+
+    async def _notify_finished(self, handle: PromptHandle):
+        try:
+            await notifications.notify_prompt_handle_finished(self.service.redis, handle.id)
+        except RedisError:
+            # whoever is waiting for the handle will still see it finish, just a bit
+            # later, since the waiting side falls back to polling the database
+            log().error(f"failed to publish that handle {handle.id} finished", exc_info=True)
+
     async def run(self):
         self.running = True
         while self.running:
             try:
-                if self.service.has_next():
-                    try:
-                        handle = await self.service.checkout()
-                        await self.process_prompt_handle(handle)
-                    except LockAlreadyAcquiredException:
-                        log().debug("Found a lock the handle. Skipping for now.")
-                    except NoPendingPromptHandleError:
-                        log().error("NoPendingPromptHandleError was thrown. is probably caused by a race condition.")
+                if self.batch_embedding_function is not None:
+                    handles = self.service.claim(self.embedding_claim_size)
+                    if len(handles) > 0:
+                        await self._process_claimed(handles, self.process_embedding_prompt_handles(handles))
+                else:
+                    for handle in self.service.claim(1):
+                        await self._process_claimed([handle], self.process_prompt_handle(handle))
                 await asyncio.sleep(0.05)
             except KeyboardInterrupt:
                 self.stop()
 
+    async def _process_claimed(self, handles: List[PromptHandle], processing: Awaitable):
+        # the handles are claimed, so if processing them fails they're failed, rather
+        # than left in progress until the claim times out and another worker retries them
+        try:
+            await processing
+        except Exception:  # noqa
+            log().error(f"failed to process handles {[handle.id for handle in handles]}", exc_info=True)
+            await self._fail(handles)
+
     def stop(self):
         log().info("Stopping worker...")
         self.running = False
+
+
+class _WebsocketTokenSink:
+    """
+    Streams tokens to the http api over a websocket, the http api then publishes them to redis on behalf
+    of the worker. This is how tokens are streamed when LLM_WORKER_PUBLISH_TOKENS_TO_REDIS is disabled.
+    """
+
+    def __init__(self, websocket: WebSocketClientProtocol):
+        self.websocket = websocket
+
+    async def send(self, text: str):
+        await self.websocket.send(text)
+
+    async def finish(self):
+        await self.websocket.send(TERMINATION_STRING)
+        await self.websocket.close()
+
+
+class _BatchedHandleStream:
+
+    def __init__(self, handle: PromptHandle, sink):
+        self.handle = handle
+        self.sink = sink
+        self.tag_filter = DanglingTagFilter()
+        self.response = ''
+        self.number_of_tokens = 0
+        self.start_time = time.time()
+
+
+class BatchedWorker(Worker):
+    """
+    A worker for huggingface models that generates the responses of many prompt handles at once.
+
+    The handles are decoded together by a ContinuousBatchingEngine. Pending handles are admitted into
+    the running batch between decoding steps, whenever the batch has room for them, and every handle
+    streams its tokens to its own websocket and is finished as soon as its own sequence is done. The
+    decoding steps run in the worker's generation thread, so the event loop isn't blocked while a step
+    runs. The tokens of a step are handed to the sinks before the next step starts, since the engine
+    can't be changed while it's stepping, but with token coalescing most of them are only buffered, and
+    the buffered text is sent by the coalescers' timers while the next step is running.
+    """
+
+    def __init__(
+            self,
+            llm_service: LLMService,
+            llm_model_name: LLMModel,
+            device: str,
+            max_batch_size: int,
+            model_loader_func: Callable = load_hf_model,
+            engine_factory: Callable = ContinuousBatchingEngine,
+    ):
+        super().__init__(llm_service, llm_model_name, device, model_loader_func=model_loader_func)
+        self.engine = engine_factory(self.model, self.tokenizer, self.device, max_batch_size)
+        self.streams: Dict[int, _BatchedHandleStream] = {}
+
+    async def admit_prompt_handle(self, handle: PromptHandle):
+        log().info(f"Admitting handle with id {handle.id} created at {handle.created_at} into the batch")
+        _record_time_spent_pending(handle)
+
+        if settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS:
+            sink = _create_token_stream_publisher(self.service.redis, handle)
+        else:
+            websocket_url = _get_websocket_url(handle)
+            log().debug(f"connecting to websocket {websocket_url}")
+            sink = _coalesce_tokens(_WebsocketTokenSink(await websockets.connect(websocket_url)))
+
+        prompt, params = _get_prompt_and_params(handle)
+        try:
+            self.engine.add_sequence(handle.id, params, prompt)
+        except Exception:  # noqa
+            # ends the stream of the handle, and closes its websocket if it has one
+            await sink.finish()
+            raise
+        self.streams[handle.id] = _BatchedHandleStream(handle, sink)
+
+    async def step(self):
+        outputs = await asyncio.get_running_loop().run_in_executor(self.generation_executor, self.engine.step)
+        for output in outputs:
+            stream = self.streams[output.sequence_id]
+            try:
+                await self._stream_output(stream, output)
+            except Exception:  # noqa
+                # a sink that fails, such as a redis publish that errors, only
+                # fails its own handle, the rest of the batch keeps generating
+                log().error(f"failed to stream the response of handle {stream.handle.id}, retiring its sequence.",
+                            exc_info=True)
+                self.engine.retire_sequence(output.sequence_id)
+                self.streams.pop(stream.handle.id, None)
+                await self._fail([stream.handle])
+
+    async def _fail_batch(self):
+        streams = list(self.streams.values())
+        self.streams = {}
+        for stream in streams:
+            self.engine.retire_sequence(stream.handle.id)
+            try:
+                # ends the stream and closes the websocket of the sink, if it has one
+                await stream.sink.finish()
+            except Exception:  # noqa
+                log().warning(f"failed to end the stream of handle {stream.handle.id}", exc_info=True)
+
+        await self._fail([stream.handle for stream in streams])
+
+    async def _stream_output(self, stream: _BatchedHandleStream, output: SequenceOutput):
+        token = stream.tag_filter.filter(output.text)
+        if token:
+            try:
+                await stream.sink.send(token)
+            except ConnectionClosed:
+                log().warning(f"Websocket of handle {stream.handle.id} was closed, retiring its sequence.")
+                self.engine.retire_sequence(output.sequence_id)
+                await self._finish_prompt_handle(stream)
+                return
+
+            stream.response += token
+            stream.number_of_tokens += 1
+
+        if output.finished:
+            await self._finish_prompt_handle(stream)
+
+    async def _finish_prompt_handle(self, stream: _BatchedHandleStream):
+        del self.streams[stream.handle.id]
+        time_taken = time.time() - stream.start_time
+
+        try:
+            await stream.sink.finish()
+        except ConnectionClosed:
+            log().warning("Websocket closed by the server before the termination string was sent.")
+
+        log().debug(f"The complete response of handle {stream.handle.id} was: {stream.response}")
+
+        handle = stream.handle
+        handle.refresh()
+        handle.state = PromptHandle.States.FINISHED
+        handle.response = stream.response
+        handle.response_length = stream.number_of_tokens
+        handle.response_time_taken_s = int(time_taken)
+        handle.save()
+
+        await self._notify_finished(handle)
+
+    async def _admit_pending_prompt_handles(self):
+        free_slots = self.engine.free_slots()
+        if free_slots == 0:
+            return
+
+        for handle in self.service.claim(free_slots):
+            try:
+                await self.admit_prompt_handle(handle)
+            except Exception:  # noqa
+                # the handle is already claimed, so it's failed rather than left in progress, and
+                # the rest of the claimed handles are still admitted
+                log().error(f"failed to admit handle {handle.id} into the batch", exc_info=True)
+                await self._fail([handle])
+
+    async def run(self):
+        self.running = True
+
+        # once the worker is stopped no new handles are admitted, but the
+        # sequences that are already in the batch are generated until the end
+        while self.running or self.engine.has_unfinished_sequences():
+            try:
+                if self.running:
+                    await self._admit_pending_prompt_handles()
+
+                if self.engine.has_unfinished_sequences():
+                    try:
+                        await self.step()
+                    except Exception:  # noqa
+                        # the state of the batch is unknown once a step has failed, such as when
+                        # the prefill ran out of memory, so every handle in it is failed
+                        log().error(f"decoding step failed, failing the {len(self.streams)} handles in the batch",
+                                    exc_info=True)
+                        await self._fail_batch()
+                    await asyncio.sleep(0)
+                else:
+                    await asyncio.sleep(0.05)
+            except KeyboardInterrupt:
+                self.stop()
+
+
+class ConcurrentWorker(Worker):
+    """
+    A worker for models behind a remote api, such as the OpenAI models, that keeps several prompt handles
+    in flight at once instead of waiting for one to finish before claiming the next.
+
+    Every request first has to pass the rate limiter, with an estimate of the number of tokens it will use,
+    so that the worker stays within the requests and tokens per minute budget of the api. A batch of embeddings
+    may be sent as several requests, so the batch embedding function is given the rate limiter, and passes it
+    once for every request it sends.
+    """
+
+    def __init__(
+            self,
+            llm_service: LLMService,
+            llm_model_name: LLMModel,
+            device: str,
+            max_concurrent_requests: int,
+            rate_limiter: RateLimiter,
+            model_loader_func: Callable = load_hf_model,
+            text_generator: Callable = generate_text_streaming,
+            embedding_function: Callable = compute_embedding,
+            batch_embedding_function: Optional[Callable] = None,
+            embedding_batch_size: Optional[int] = None,
+            token_counter: Callable = count_tokens,
+    ):
+        if batch_embedding_function is not None:
+            batch_embedding_function = partial(batch_embedding_function, rate_limiter=rate_limiter)
+
+        super().__init__(
+            llm_service,
+            llm_model_name,
+            device,
+            model_loader_func=model_loader_func,
+            text_generator=text_generator,
+            embedding_function=embedding_function,
+            batch_embedding_function=batch_embedding_function,
+            embedding_batch_size=embedding_batch_size,
+            generate_in_thread=False,
+        )
+        self.max_concurrent_requests = max_concurrent_requests
+        self.rate_limiter = rate_limiter
+        self.token_counter = token_counter
+        self.in_flight = set()
+
+    def estimate_tokens(self, handle: PromptHandle) -> int:
+        tokens = self.token_counter(handle.prompt)
+        if handle.llm_model_name not in EMBEDDING_MODELS:
+            _, params = _get_prompt_and_params(handle)
+            tokens += min(params.max_new_tokens, OPENAI_MAX_TOKENS)
+        return tokens
+
+    def _claim_requests(self, free_slots: int) -> List[List[PromptHandle]]:
+        if self.batch_embedding_function is None:
+            return [[handle] for handle in self.service.claim(free_slots)]
+
+        # with a batch embedding function, every request embeds a whole batch of handles
+        requests = []
+        for _ in range(free_slots):
+            handles = self.service.claim(self.embedding_batch_size)
+            if len(handles) == 0:
+                break
+            requests.append(handles)
+        return requests
+
+    async def _process_rate_limited_request(self, handles: List[PromptHandle]):
+        try:
+            if self.batch_embedding_function is not None:
+                await self.process_embedding_prompt_handles(handles)
+            else:
+                await self.rate_limiter.acquire(self.estimate_tokens(handles[0]))
+                await self.process_prompt_handle(handles[0])
+        except Exception:  # noqa
+            log().error(f"failed to process handles {[handle.id for handle in handles]}", exc_info=True)
+            await self._fail(handles)
+
+    async def run(self):
+        self.running = True
+
+        # once the worker is stopped no new handles are claimed, but
+        # the handles that are in flight are processed until the end
+        while self.running or len(self.in_flight) > 0:
+            try:
+                free_slots = self.max_concurrent_requests - len(self.in_flight)
+                if self.running and free_slots > 0:
+                    for handles in self._claim_requests(free_slots):
+                        self.in_flight.add(asyncio.create_task(self._process_rate_limited_request(handles)))
+
+                if len(self.in_flight) > 0:
+                    _, self.in_flight = await asyncio.wait(self.in_flight, timeout=0.05)
+                else:
+                    await asyncio.sleep(0.05)
+            except KeyboardInterrupt:
+                self.stop()
@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest_asyncio
+import pytest
+
+from cache.stream_hub import StreamHub, get_stream_hub, close_stream_hub
+
+
+class FakePubSub:
+
+    def __init__(self):
+        self.channels = set()
+        self.messages = asyncio.Queue()
+        self.closed = False
+
+    async def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    async def listen(self):
+        while True:
+            message = await self.messages.get()
+            if message is None:
+                return
+            yield message
+
+    async def aclose(self):
+        self.closed = True
+
+    def publish(self, channel: str, data: str):
+        if channel in self.channels:
+            self.messages.put_nowait({'type': 'message', 'channel': channel, 'data': data})
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.pubsubs = []
+        self.closed = False
+
+    def pubsub(self):
+        self.pubsubs.append(FakePubSub())
+        return self.pubsubs[-1]
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest_asyncio.fixture
+async def hub():
+    hub = StreamHub(FakeRedis())
+    yield hub
+    await hub.aclose()
+
+
+async def _received(subscription, count: int) -> list:
+    messages = []
+    listener = subscription.listen()
+    async for message in listener:
+        messages.append(message['data'])
+        if len(messages) == count:
+            break
+    await listener.aclose()
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_all_subscriptions_share_one_pubsub(hub):
+    redis = hub.redis
+
+    await hub.subscribe('session-1')
+    await hub.subscribe('session-2')
+    await hub.subscribe('session-2')
+
+    assert len(redis.pubsubs) == 1
+    assert redis.pubsubs[0].channels == {'session-1', 'session-2'}
+
+
+@pytest.mark.asyncio
+async def test_messages_are_fanned_out_to_the_subscriptions_of_their_channel(hub):
+    redis = hub.redis
+    subscription_1 = await hub.subscribe('session-1')
+    subscription_2 = await hub.subscribe('session-1')
+    other_subscription = await hub.subscribe('session-2')
+
+    redis.pubsubs[0].publish('session-1', 'baby')
+    redis.pubsubs[0].publish('session-2', 'what is love?')
+    redis.pubsubs[0].publish('session-1', ' don\'t')
+
+    assert await asyncio.wait_for(_received(subscription_1, 2), 1) == ['baby', ' don\'t']
+    assert await asyncio.wait_for(_received(subscription_2, 2), 1) == ['baby', ' don\'t']
+    assert await asyncio.wait_for(_received(other_subscription, 1), 1) == ['what is love?']
+
+
+@pytest.mark.asyncio
+async def test_channel_is_unsubscribed_once_its_last_subscription_is(hub):
+    redis = hub.redis
+    subscription_1 = await hub.subscribe('session-1')
+    subscription_2 = await hub.subscribe('session-1')
+
+    await hub.unsubscribe(subscription_1)
+    assert redis.pubsubs[0].channels == {'session-1'}
+
+    await hub.unsubscribe(subscription_2)
+    assert redis.pubsubs[0].channels == set()
+    assert hub.subscriptions == {}
+
+
+@pytest.mark.asyncio
+async def test_listening_to_a_subscription_stops_when_it_is_unsubscribed(hub):
+    subscription = await hub.subscribe('session-1')
+    listener = asyncio.create_task(_received(subscription, 1))
+    await asyncio.sleep(0)
+
+    await hub.unsubscribe(subscription)
+
+    assert await asyncio.wait_for(listener, 1) == []
+
+
+@pytest.mark.asyncio
+async def test_reader_is_started_again_by_the_next_subscription_once_it_has_stopped(hub):
+    redis = hub.redis
+    await hub.subscribe('session-1')
+    redis.pubsubs[0].messages.put_nowait(None)
+    await asyncio.wait_for(hub.reader, 1)
+
+    subscription = await hub.subscribe('session-2')
+    redis.pubsubs[0].publish('session-2', 'hello')
+
+    assert await asyncio.wait_for(_received(subscription, 1), 1) == ['hello']
+
+
+@pytest.mark.asyncio
+async def test_closing_the_hub_stops_its_reader_and_closes_its_connection(hub):
+    redis = hub.redis
+    subscription = await hub.subscribe('session-1')
+    listener = asyncio.create_task(_received(subscription, 1))
+    await asyncio.sleep(0)
+
+    await hub.aclose()
+
+    assert await asyncio.wait_for(listener, 1) == []
+    assert hub.reader.done()
+    assert redis.pubsubs[0].closed
+    assert redis.closed
+
+
+@pytest.mark.asyncio
+async def test_hub_of_the_running_loop_is_closed(mocker):
+    redis = FakeRedis()
+    mocker.patch('cache.redis.get_redis_connection', return_value=redis)
+    hub = await get_stream_hub()
+    assert await get_stream_hub() is hub
+
+    await close_stream_hub()
+
+    assert redis.closed
+    assert await get_stream_hub() is not hub
+    await close_stream_hub()
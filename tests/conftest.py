@@ -3,11 +3,12 @@ import sys
 import os
 
 from playwright.async_api import Browser, BrowserContext, Page
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, MistralConfig, MistralForCausalLM
 from websockets import WebSocketClientProtocol
 from fastapi.testclient import TestClient
 from numpy.random import rand, randint
 from redis.asyncio import Redis
+import torch
 import pytest
 
 # this will fix issue where the python path won't contain the packages
@@ -20,7 +21,9 @@ from services.index.supported_indices import IndexType  # noqa
 from services.llm.supported_models import LLMModel  # noqa
 from services.crawler.crawler import CrawlerService  # noqa
 from config.settings import Settings  # noqa
+import config.settings as settings  # noqa
 from db.connection import db  # noqa
+from tests.mock_redis import MockPipeline  # noqa
 import http_api  # noqa
 
 
@@ -82,6 +85,42 @@ def mock_load_hf_model(mocker):
     return load_hf_model
 
 
+@pytest.fixture
+def tiny_hf_model():
+    """
+    A randomly initialised mistral model small enough to run on cpu in the testsuite,
+    along with a character level tokenizer. Useful for testing the text generation
+    code against a real model without downloading anything.
+    """
+    class CharTokenizer:
+        eos_token_id = 0
+
+        class Encoding:
+            def __init__(self, input_ids: list):
+                self.input_ids = input_ids
+
+        def __call__(self, text: str):
+            return self.Encoding([ord(char) % 127 + 1 for char in text])
+
+        def decode(self, token_ids: list, skip_special_tokens: bool = True) -> str:
+            return ''.join(chr(token_id) for token_id in token_ids if token_id != self.eos_token_id)
+
+    torch.manual_seed(42)
+    config = MistralConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024,
+    )
+    model = MistralForCausalLM(config)
+    model.eval()
+
+    return model, CharTokenizer()
+
+
 @pytest.fixture
 def create_mock_generate_text_streaming(mocker):
     def create_mock(mock_tokens):
@@ -113,6 +152,7 @@ def create_mock_compute_embedding(mocker):
 @pytest.fixture
 def create_websocket_mocks(mocker):
     def create_mocks():
+        settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS = False
         mock_ws = AsyncMock(spec=WebSocketClientProtocol)
         mock_ctx_manager = AsyncMock()
         mock_ctx_manager.__aenter__.return_value = mock_ws
@@ -199,7 +239,11 @@ def new_chat(authenticated_session, valid_course):
 @pytest.fixture
 def redis_connection(mocker) -> Redis:
     mock_redis = create_autospec(Redis, instance=True)
-    return mocker.patch('cache.redis.get_redis_connection', return_value=mock_redis)
+    mock_redis.pipeline = MagicMock(side_effect=lambda transaction=True: MockPipeline(mock_redis))
+    mock_connection = mocker.patch('cache.redis.get_redis_connection', return_value=mock_redis)
+    # some tests use the patched function itself as the connection
+    mock_connection.pipeline = MagicMock(side_effect=lambda transaction=True: MockPipeline(mock_connection))
+    return mock_connection
 
 
 @pytest.fixture
@@ -124,6 +124,29 @@ def test_assistant_messages_returns_prompt_handle_response_if_done_streaming(
     assert response['messages'][1]['content'] == 'foo'
 
 
+def test_assistant_messages_are_failed_if_their_prompt_handle_failed(
+    api_client,
+    authenticated_session,
+    new_chat,
+    llm_prompt
+):
+    url = f'/course/{new_chat.course.canvas_id}/chat/{new_chat.chat.public_id}/messages'
+    api_client.post(url, json={'content': llm_prompt}, headers=authenticated_session.headers)
+
+    assistant_msg = new_chat.chat.messages[1]
+    handle = assistant_msg.prompt_handle
+    handle.state = PromptHandle.States.FAILED
+    handle.save()
+
+    messages = api_client.get(url, headers=authenticated_session.headers).json()['messages']
+    message = api_client.get(f'{url}/{assistant_msg.message_id}', headers=authenticated_session.headers).json()
+
+    for response in [messages[1], message]:
+        assert response['state'] == Message.States.FAILED
+        assert not response['streaming']
+        assert response['websocket'] is None
+
+
 def test_chat_llm_model_and_index_is_selected_from_session_default(
     api_client,
     authenticated_session,
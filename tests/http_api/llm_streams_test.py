@@ -0,0 +1,274 @@
+from unittest.mock import AsyncMock
+import contextlib
+import asyncio
+import uuid
+
+from fastapi import WebSocket
+import pytest_asyncio
+import pytest
+import arrow
+
+from http_api.websocket_protocols.llm_streams import listen_to_redis, replay_token_stream, WebsocketTimeouts
+from cache.token_streams import encode_frame, TokenFrame, TokenStreamPublisher, TERMINATION_STRING
+from tests.mock_redis import MockPipeline
+
+
+class FakeSubscription:
+
+    def __init__(self, messages: list):
+        self.messages = messages
+
+    async def listen(self):
+        for data in self.messages:
+            yield {'type': 'message', 'data': data}
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.streams = {}
+        self.expiry = {}
+        self.expirations = []
+        self.published = []
+
+    async def xadd(self, key: str, fields: dict):
+        entries = self.streams.setdefault(key, [])
+        entries.append((f'{len(entries)}-0', fields))
+
+    async def xrange(self, key: str):
+        return self.streams.get(key, [])
+
+    async def expire(self, key: str, seconds: int):
+        self.expiry[key] = seconds
+        self.expirations.append(key)
+
+    async def publish(self, channel: str, data: str):
+        self.published.append(data)
+
+    def pipeline(self, transaction: bool = True):
+        return MockPipeline(self)
+
+
+async def _publish_tokens(redis: FakeRedis, tokens: list, end: bool = False):
+    publisher = TokenStreamPublisher(redis, '/ws/some-session', retention_seconds=60)
+    for token in tokens:
+        await publisher.send(token)
+    if end:
+        await publisher.finish()
+
+
+def _websocket_session() -> dict:
+    return {
+        'id': uuid.uuid4(),
+        'started_at': arrow.now(),
+        'last_activity_time': arrow.now(),
+        'write_only': False,
+        'closed': False,
+        'tokens_transmitted': 0,
+        'last_seq': 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_frames_published_by_workers_are_forwarded_as_text_with_termination_string():
+    websocket = AsyncMock(spec=WebSocket)
+    subscription = FakeSubscription([
+        encode_frame(TokenFrame(1, 'hello')),
+        encode_frame(TokenFrame(2, ' {"seq": 7}')),
+        encode_frame(TokenFrame(3, end=True)),
+    ])
+
+    await listen_to_redis(subscription, websocket, _websocket_session())
+
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == ['hello', ' {"seq": 7}', TERMINATION_STRING]
+
+
+@pytest.mark.asyncio
+async def test_plain_text_published_on_behalf_of_websocket_workers_is_forwarded_as_is():
+    websocket = AsyncMock(spec=WebSocket)
+    subscription = FakeSubscription(['hello', '{', TERMINATION_STRING])
+
+    await listen_to_redis(subscription, websocket, _websocket_session())
+
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == ['hello', '{', TERMINATION_STRING]
+
+
+@pytest.mark.asyncio
+async def test_compact_frames_are_forwarded_as_text_with_termination_string():
+    websocket = AsyncMock(spec=WebSocket)
+    subscription = FakeSubscription([
+        encode_frame(TokenFrame(1, 'hello there', offset=0), compact=True),
+        encode_frame(TokenFrame(2, ' 1 2 3 ', offset=11), compact=True),
+        encode_frame(TokenFrame(3, end=True, offset=18), compact=True),
+    ])
+
+    await listen_to_redis(subscription, websocket, _websocket_session())
+
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == ['hello there', ' 1 2 3 ', TERMINATION_STRING]
+
+
+@pytest.mark.asyncio
+async def test_published_frames_are_kept_in_a_stream_that_expires():
+    redis = FakeRedis()
+
+    await _publish_tokens(redis, ['baby', ' don\'t'], end=True)
+
+    assert [fields['frame'] for _, fields in redis.streams['token_stream:some-session']] == redis.published
+    assert redis.expiry == {'token_stream:some-session': 60}
+
+
+@pytest.mark.asyncio
+async def test_expiry_of_the_stream_is_pushed_back_by_every_frame():
+    redis = FakeRedis()
+
+    await _publish_tokens(redis, ['baby', ' don\'t', ' hurt'])
+
+    assert redis.expirations == ['token_stream:some-session'] * 3
+
+
+@pytest.mark.asyncio
+async def test_requester_is_sent_the_text_it_missed_from_the_resume_offset():
+    websocket = AsyncMock(spec=WebSocket)
+    redis = FakeRedis()
+    await _publish_tokens(redis, ['baby', ' don\'t', ' hurt'])
+    websocket_session = _websocket_session()
+
+    ended = await replay_token_stream(redis, websocket, 'some-session', websocket_session, resume_offset=6)
+
+    assert not ended
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == ['on\'t', ' hurt']
+    assert websocket_session['last_seq'] == 3
+
+
+@pytest.mark.asyncio
+async def test_replay_of_an_ended_stream_sends_termination_string():
+    websocket = AsyncMock(spec=WebSocket)
+    redis = FakeRedis()
+    await _publish_tokens(redis, ['baby', ' don\'t'], end=True)
+
+    ended = await replay_token_stream(redis, websocket, 'some-session', _websocket_session())
+
+    assert ended
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == ['baby', ' don\'t', TERMINATION_STRING]
+
+
+@pytest.mark.asyncio
+async def test_frames_already_sent_by_the_replay_are_not_sent_again():
+    websocket = AsyncMock(spec=WebSocket)
+    redis = FakeRedis()
+    await _publish_tokens(redis, ['baby', ' don\'t'])
+    websocket_session = _websocket_session()
+    await replay_token_stream(redis, websocket, 'some-session', websocket_session)
+
+    # frames published after subscribing to the channel, but before reading the stream, are received twice
+    subscription = FakeSubscription([
+        encode_frame(TokenFrame(2, ' don\'t', offset=4)),
+        encode_frame(TokenFrame(3, ' hurt', offset=10)),
+        encode_frame(TokenFrame(4, end=True, offset=15)),
+    ])
+    await listen_to_redis(subscription, websocket, websocket_session)
+
+    assert [c.args[0] for c in websocket.send_text.call_args_list] == [
+        'baby', ' don\'t', ' hurt', TERMINATION_STRING
+    ]
+
+
+@pytest_asyncio.fixture
+async def websocket_timeouts():
+    timeouts = WebsocketTimeouts()
+    yield timeouts
+    if timeouts.task is not None:
+        timeouts.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await timeouts.task
+
+
+@pytest.mark.asyncio
+async def test_websocket_is_closed_once_it_has_been_inactive_for_longer_than_its_timeout(websocket_timeouts):
+    websocket = AsyncMock(spec=WebSocket)
+    websocket_session = _websocket_session()
+    websocket_session['tokens_transmitted'] = 1
+
+    websocket_timeouts.track(websocket, websocket_session, timeout_duration=0.05)
+    await asyncio.sleep(0.02)
+    websocket.close.assert_not_called()
+
+    await asyncio.sleep(0.1)
+    websocket.close.assert_awaited_once()
+    assert websocket_session['closed']
+    assert websocket_timeouts.number_of_timeouts == 1
+    assert websocket_timeouts.websockets == {}
+
+
+@pytest.mark.asyncio
+async def test_activity_pushes_the_deadline_of_the_websocket_back(websocket_timeouts):
+    websocket = AsyncMock(spec=WebSocket)
+    websocket_session = _websocket_session()
+    websocket_session['tokens_transmitted'] = 1
+
+    websocket_timeouts.track(websocket, websocket_session, timeout_duration=0.1)
+    for _ in range(4):
+        await asyncio.sleep(0.05)
+        websocket_session['last_activity_time'] = arrow.now()
+    websocket.close.assert_not_called()
+
+    await asyncio.sleep(0.2)
+    websocket.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_requester_waiting_for_a_worker_is_not_timed_out(websocket_timeouts):
+    websocket = AsyncMock(spec=WebSocket)
+
+    websocket_timeouts.track(websocket, _websocket_session(), timeout_duration=0.02)
+    await asyncio.sleep(0.1)
+
+    websocket.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_requester_that_reconnected_after_every_frame_is_timed_out(websocket_timeouts):
+    websocket = AsyncMock(spec=WebSocket)
+    websocket_session = _websocket_session()
+    websocket_session['last_seq'] = 3
+
+    websocket_timeouts.track(websocket, websocket_session, timeout_duration=0.02)
+    await asyncio.sleep(0.1)
+
+    websocket.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_untracked_websocket_is_not_closed(websocket_timeouts):
+    websocket = AsyncMock(spec=WebSocket)
+    websocket_session = _websocket_session()
+    websocket_session['tokens_transmitted'] = 1
+
+    websocket_timeouts.track(websocket, websocket_session, timeout_duration=0.02)
+    websocket_timeouts.untrack(websocket_session)
+    await asyncio.sleep(0.1)
+
+    websocket.close.assert_not_called()
+    assert websocket_timeouts.number_of_closed == 1
+
+
+def test_websockets_are_timed_out_in_every_event_loop_they_are_tracked_in():
+    timeouts = WebsocketTimeouts()
+
+    async def track_and_time_out():
+        websocket = AsyncMock(spec=WebSocket)
+        websocket_session = _websocket_session()
+        websocket_session['tokens_transmitted'] = 1
+
+        timeouts.track(websocket, websocket_session, timeout_duration=0.02)
+        await asyncio.sleep(0.1)
+        websocket.close.assert_awaited_once()
+
+        timeouts.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await timeouts.task
+
+    asyncio.run(track_and_time_out())
+    asyncio.run(track_and_time_out())
+
+    assert timeouts.number_of_timeouts == 2
@@ -0,0 +1,90 @@
+import pytest
+
+from db.models import CachedAnswer, ChatConfig, Faq, FaqAnswer, FaqSnapshot, PromptHandle, Snapshot
+from services.index.supported_indices import IndexType
+from jobs.faq.precompute_faq_answers import job
+from services.llm.supported_models import LLMModel
+import config.settings as settings
+
+
+@pytest.fixture
+def course_with_faqs(valid_course):
+    faq_snapshot = FaqSnapshot.get(FaqSnapshot.course == valid_course)
+    Faq(question="when is the deadline for lab 2?", snapshot=faq_snapshot).save()
+    Faq(question="who is the examiner?", snapshot=faq_snapshot).save()
+
+    ChatConfig(llm_model_name=LLMModel.OPENAI_GPT4, index_type=IndexType.NO_INDEX).save()
+    ChatConfig(llm_model_name=LLMModel.GOOGLE_GEMMA_7B, index_type=IndexType.NO_INDEX, is_active=False).save()
+
+    Snapshot(course=valid_course).save()
+
+    return valid_course
+
+
+@pytest.mark.asyncio
+async def test_answers_are_dispatched_for_every_faq_and_active_chat_config(course_with_faqs):
+    await job()
+
+    answers = list(FaqAnswer.select())
+    assert len(answers) == 4
+    assert {answer.llm_model_name for answer in answers} == {LLMModel.MISTRAL_7B_INSTRUCT, LLMModel.OPENAI_GPT4}
+    assert all(answer.prompt_handle.state == PromptHandle.States.PENDING for answer in answers)
+    assert 'when is the deadline for lab 2?' in answers[0].prompt_handle.prompt
+
+
+@pytest.mark.asyncio
+async def test_answers_are_only_dispatched_again_once_the_course_has_a_new_snapshot(course_with_faqs):
+    await job()
+    await job()
+
+    assert FaqAnswer.select().count() == 4
+    assert PromptHandle.select().count() == 4
+
+    snapshot = Snapshot(course=course_with_faqs)
+    snapshot.save()
+    await job()
+
+    assert FaqAnswer.select().count() == 4
+    assert FaqAnswer.select().where(FaqAnswer.snapshot == snapshot).count() == 4
+
+
+@pytest.mark.asyncio
+async def test_answers_to_faqs_of_a_previous_faq_snapshot_are_deleted(course_with_faqs):
+    await job()
+
+    faq_snapshot = FaqSnapshot(course=course_with_faqs)
+    faq_snapshot.save()
+    faq = Faq(question="where is the lecture hall?", snapshot=faq_snapshot)
+    faq.save()
+    await job()
+
+    assert [answer.faq.id for answer in FaqAnswer.select()] == [faq.id, faq.id]
+
+
+@pytest.mark.asyncio
+async def test_failed_answers_are_dispatched_again(course_with_faqs):
+    await job()
+
+    failed = FaqAnswer.select().first()
+    failed.prompt_handle.state = PromptHandle.States.FAILED
+    failed.prompt_handle.save()
+    await job()
+
+    assert FaqAnswer.select().count() == 4
+    assert PromptHandle.select().count() == 5
+    assert all(answer.prompt_handle.state == PromptHandle.States.PENDING for answer in FaqAnswer.select())
+
+
+@pytest.mark.asyncio
+async def test_answers_are_not_stored_in_the_answer_cache(mocker, course_with_faqs):
+    settings.get_settings().ANSWER_CACHE_ENABLED = True
+    mock_embed = mocker.patch('services.chat.answer_cache._embed', return_value=[1.0, 0.0])
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', return_value='a question')
+    mocker.patch('services.index.index.IndexService.query_index_with_vector', return_value=[])
+    ChatConfig.update(index_type=IndexType.VECTOR_SEARCH_OPENAI_TEXT_EMBEDDING_3_LARGE).execute()
+
+    await job()
+
+    assert FaqAnswer.select().count() == 4
+    assert CachedAnswer.select().count() == 0
+    mock_embed.assert_not_called()
@@ -0,0 +1,107 @@
+import pytest
+
+from llms.batching import ContinuousBatchingEngine, drain
+from llms.generate import generate_text_streaming
+from llms.config import Params
+
+PROMPTS = [
+    'hello there',
+    'a much longer prompt than the other ones in this list',
+    'x',
+]
+
+
+async def _generate_sequentially(model, tokenizer, params: Params, prompt: str) -> str:
+    out = ''
+    async for token in generate_text_streaming(model, tokenizer, 'cpu', params, prompt):
+        out += token
+    return out
+
+
+@pytest.mark.asyncio
+async def test_batched_generation_produces_same_text_as_sequential_generation(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=20)
+
+    engine = ContinuousBatchingEngine(model, tokenizer, 'cpu', max_batch_size=8)
+    for idx, prompt in enumerate(PROMPTS):
+        engine.add_sequence(idx, params, prompt)
+
+    texts = drain(engine)
+
+    for idx, prompt in enumerate(PROMPTS):
+        assert texts[idx] == await _generate_sequentially(model, tokenizer, params, prompt)
+
+
+@pytest.mark.asyncio
+async def test_sequences_can_be_admitted_into_a_running_batch(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=20)
+
+    engine = ContinuousBatchingEngine(model, tokenizer, 'cpu', max_batch_size=8)
+    engine.add_sequence('first', params, PROMPTS[0])
+
+    texts = {'first': '', 'second': ''}
+    for _ in range(5):
+        for output in engine.step():
+            texts[output.sequence_id] += output.text
+
+    engine.add_sequence('second', params, PROMPTS[1])
+    for sequence_id, text in drain(engine).items():
+        texts[sequence_id] += text
+
+    assert texts['first'] == await _generate_sequentially(model, tokenizer, params, PROMPTS[0])
+    assert texts['second'] == await _generate_sequentially(model, tokenizer, params, PROMPTS[1])
+
+
+def test_sequences_are_retired_independently(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    # make sure the random model cannot end any of the sequences early
+    tokenizer.eos_token_id = -1
+
+    engine = ContinuousBatchingEngine(model, tokenizer, 'cpu', max_batch_size=8)
+    engine.add_sequence('short', Params(temperature=0, max_new_tokens=3), PROMPTS[0])
+    engine.add_sequence('long', Params(temperature=0, max_new_tokens=10), PROMPTS[1])
+
+    steps_until_finished = {}
+    step = 0
+    while engine.has_unfinished_sequences():
+        step += 1
+        for output in engine.step():
+            if output.finished:
+                steps_until_finished[output.sequence_id] = step
+
+    assert steps_until_finished == {'short': 3, 'long': 10}
+
+
+def test_engine_has_no_capacity_when_batch_is_full(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+
+    engine = ContinuousBatchingEngine(model, tokenizer, 'cpu', max_batch_size=2)
+    engine.add_sequence(1, Params(), PROMPTS[0])
+    assert engine.has_capacity()
+
+    engine.add_sequence(2, Params(), PROMPTS[1])
+    assert not engine.has_capacity()
+
+    engine.retire_sequence(1)
+    assert engine.has_capacity()
+
+
+def test_running_sequences_keep_decoding_while_a_long_prompt_is_prefilled_in_slices(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=20)
+    long_prompt = 'a much longer prompt than the other ones in this list'
+
+    engine = ContinuousBatchingEngine(model, tokenizer, 'cpu', max_batch_size=8, prefill_chunk_size=8)
+    engine.add_sequence('short', params, 'x')
+    engine.step()
+    engine.add_sequence('long', params, long_prompt)
+
+    slices = -(-len(long_prompt) // 8)
+    for _ in range(slices - 1):
+        outputs = engine.step()
+        assert [output.sequence_id for output in outputs] == ['short']
+
+    outputs = engine.step()
+    assert [output.sequence_id for output in outputs] == ['short', 'long']
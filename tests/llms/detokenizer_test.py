@@ -0,0 +1,94 @@
+import pytest
+
+from llms.detokenizer import IncrementalDetokenizer, StopStringMatcher
+from llms.generate import generate_text_streaming
+from llms.config import Params
+
+
+class ByteTokenizer:
+    """
+    Every token is a single byte of utf-8, like the byte fallback tokens of byte-level tokenizers, so
+    characters outside of ascii are split over several tokens.
+    """
+
+    def encode(self, text: str) -> list:
+        return list(text.encode('utf-8'))
+
+    def decode(self, token_ids: list, skip_special_tokens: bool = True) -> str:
+        return bytes(token_ids).decode('utf-8', errors='replace')
+
+
+class SentencePieceTokenizer:
+    """
+    Tokens carry their leading space as a marker, which is dropped when the token starts the decoded text.
+    """
+
+    vocabulary = ['▁the', '▁answer', '▁is', '▁4', '2', '.']
+
+    def decode(self, token_ids: list, skip_special_tokens: bool = True) -> str:
+        return ''.join(self.vocabulary[token_id] for token_id in token_ids).replace('▁', ' ').lstrip(' ')
+
+
+def _detokenize(tokenizer, token_ids: list) -> list:
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    return [detokenizer.add_token(token_id) for token_id in token_ids]
+
+
+def test_incremental_text_is_the_same_as_decoding_all_tokens_at_once():
+    tokenizer = SentencePieceTokenizer()
+    token_ids = [0, 1, 2, 3, 4, 5]
+
+    pieces = _detokenize(tokenizer, token_ids)
+
+    assert pieces == ['the', ' answer', ' is', ' 4', '2', '.']
+    assert ''.join(pieces) == tokenizer.decode(token_ids)
+
+
+def test_multi_byte_characters_are_held_back_until_they_are_complete():
+    tokenizer = ByteTokenizer()
+    text = 'svar på frågan 🙂'
+
+    pieces = _detokenize(tokenizer, tokenizer.encode(text))
+
+    assert ''.join(pieces) == text
+    assert not any('�' in piece for piece in pieces)
+    assert pieces[-4:] == ['', '', '', '🙂']
+
+
+def test_stop_strings_are_found_across_pieces_of_text():
+    matcher = StopStringMatcher(['</s>', 'USER:'])
+
+    assert not matcher.feed('The answer is 42. US')
+    assert not matcher.feed('E')
+    assert matcher.feed('R: next question')
+
+
+def test_stop_strings_are_found_when_one_is_a_suffix_of_a_partial_match_of_another():
+    matcher = StopStringMatcher(['abcd', 'bc'])
+
+    assert not matcher.feed('xa')
+    assert matcher.feed('bc')
+
+
+def test_text_without_stop_strings_never_matches():
+    matcher = StopStringMatcher([])
+
+    assert not matcher.feed('anything at all')
+
+
+@pytest.mark.asyncio
+async def test_generation_stops_at_a_stop_string_spanning_several_tokens(tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=20)
+
+    full_text = ''
+    async for token in generate_text_streaming(model, tokenizer, 'cpu', params, 'x'):
+        full_text += token
+
+    stop_string = full_text[9:11]
+    params = Params(temperature=0, max_new_tokens=20, stop_strings=[stop_string])
+    stopped_text = ''
+    async for token in generate_text_streaming(model, tokenizer, 'cpu', params, 'x'):
+        stopped_text += token
+
+    assert stopped_text == full_text[:full_text.index(stop_string) + len(stop_string) - 1]
@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from llms.embeddings import compute_embedding, compute_embeddings
+import llms.embeddings
+
+TEXTS = [
+    'a much longer text than the other ones in this list',
+    'x',
+    'hello there',
+    'some text of medium length',
+]
+
+
+class PaddingCharTokeniser:
+    """
+    A character level tokeniser that pads on the right, with the same call signature as the
+    huggingface tokenisers used by the embedding functions.
+    """
+
+    def __init__(self):
+        self.number_of_calls = 0
+
+    def __call__(self, texts: list, max_length: int, truncation: bool):
+        self.number_of_calls += 1
+        input_ids = [[ord(char) % 127 + 1 for char in text][:max_length] for text in texts]
+        return {'input_ids': input_ids, 'attention_mask': [[1] * len(ids) for ids in input_ids]}
+
+    def pad(self, encodings: dict, padding: bool, return_tensors: str):
+        input_ids = encodings['input_ids']
+        longest = max(len(ids) for ids in input_ids)
+        return {
+            'input_ids': torch.tensor([ids + [0] * (longest - len(ids)) for ids in input_ids]),
+            'attention_mask': torch.tensor([[1] * len(ids) + [0] * (longest - len(ids)) for ids in input_ids]),
+        }
+
+
+@pytest.mark.asyncio
+async def test_batched_embeddings_are_the_same_as_embedding_each_text_on_its_own(tiny_hf_model):
+    model, _ = tiny_hf_model
+    tokeniser = PaddingCharTokeniser()
+
+    embeddings = await compute_embeddings(model.model, tokeniser, TEXTS, batch_size=3)
+
+    assert len(embeddings) == len(TEXTS)
+    for text, embedding in zip(TEXTS, embeddings):
+        expected = await compute_embedding(model.model, tokeniser, text)
+        assert torch.allclose(torch.tensor(embedding), torch.tensor(expected), atol=1e-5)
+
+
+@pytest.mark.asyncio
+async def test_batches_are_formed_from_texts_of_similar_length(mocker, tiny_hf_model):
+    model, _ = tiny_hf_model
+    tokeniser = PaddingCharTokeniser()
+    pad_spy = mocker.spy(llms.embeddings, '_pad_inputs')
+
+    await compute_embeddings(model.model, tokeniser, TEXTS, batch_size=2)
+
+    batches = [[len(ids) for ids in c.args[1]['input_ids']] for c in pad_spy.call_args_list]
+    assert batches == [[len('x'), len('hello there')], [len('some text of medium length'), len(TEXTS[0])]]
+    # the lengths the texts are sorted by come from the same tokenisation as the batches
+    assert tokeniser.number_of_calls == 1
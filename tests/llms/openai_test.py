@@ -0,0 +1,93 @@
+from unittest.mock import AsyncMock
+from types import SimpleNamespace
+
+from openai import RateLimitError
+import pytest
+import httpx
+
+from llms.openai import with_rate_limit_retries, compute_embeddings
+import config.settings as settings
+
+
+def _rate_limit_error() -> RateLimitError:
+    response = httpx.Response(429, request=httpx.Request('POST', 'https://api.openai.com/v1/embeddings'))
+    return RateLimitError('rate limit exceeded', response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def openai_settings(mocker):
+    # llms.openai imports get_settings directly, so it isn't covered by the settings mock in conftest
+    return mocker.patch('llms.openai.get_settings', return_value=settings.get_settings())
+
+
+@pytest.mark.asyncio
+async def test_requests_are_retried_with_backoff_when_rate_limited(mocker):
+    sleep_mock = mocker.patch('asyncio.sleep', new_callable=AsyncMock)
+    mocker.patch('random.random', return_value=0)
+    create_request = AsyncMock(side_effect=[_rate_limit_error(), _rate_limit_error(), 'response'])
+
+    response = await with_rate_limit_retries(create_request)
+
+    assert response == 'response'
+    assert create_request.await_count == 3
+    assert [c.args[0] for c in sleep_mock.call_args_list] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_error_is_raised_when_retries_are_used_up(mocker):
+    settings.get_settings().OPENAI_MAX_RETRIES = 2
+    mocker.patch('asyncio.sleep', new_callable=AsyncMock)
+    create_request = AsyncMock(side_effect=_rate_limit_error())
+
+    with pytest.raises(RateLimitError):
+        await with_rate_limit_retries(create_request)
+
+    assert create_request.await_count == 3
+
+
+def _embeddings_response(inputs: list):
+    # the api doesn't promise to return the embeddings in the order of the inputs
+    data = [SimpleNamespace(index=idx, embedding=[float(len(text))]) for idx, text in enumerate(inputs)]
+    return SimpleNamespace(data=list(reversed(data)), usage=None)
+
+
+@pytest.mark.asyncio
+async def test_embeddings_of_many_texts_are_computed_in_as_few_requests_as_possible(mocker):
+    client = mocker.Mock()
+    client.embeddings.create = AsyncMock(side_effect=lambda input, model: _embeddings_response(input))
+    texts = ['one', 'three', 'seventeen', 'x', 'yy']
+
+    embeddings = await compute_embeddings(client, None, texts, batch_size=2)
+
+    assert embeddings == [[3.0], [5.0], [9.0], [1.0], [2.0]]
+    assert [c.kwargs['input'] for c in client.embeddings.create.call_args_list] == [
+        ['one', 'three'], ['seventeen', 'x'], ['yy']
+    ]
+
+
+@pytest.mark.asyncio
+async def test_embedding_requests_are_capped_by_the_token_budget(mocker):
+    mocker.patch('llms.openai.EMBEDDING_REQUEST_TOKEN_BUDGET', 10)
+    mocker.patch('llms.openai.count_tokens', side_effect=len)
+    client = mocker.Mock()
+    client.embeddings.create = AsyncMock(side_effect=lambda input, model: _embeddings_response(input))
+
+    await compute_embeddings(client, None, ['one', 'three', 'seventeen', 'x'])
+
+    assert [c.kwargs['input'] for c in client.embeddings.create.call_args_list] == [
+        ['one', 'three'], ['seventeen', 'x']
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_is_passed_once_for_every_embedding_request(mocker):
+    mocker.patch('llms.openai.EMBEDDING_REQUEST_TOKEN_BUDGET', 10)
+    mocker.patch('llms.openai.count_tokens', side_effect=len)
+    client = mocker.Mock()
+    client.embeddings.create = AsyncMock(side_effect=lambda input, model: _embeddings_response(input))
+    rate_limiter = mocker.Mock()
+    rate_limiter.acquire = AsyncMock()
+
+    await compute_embeddings(client, None, ['one', 'three', 'seventeen', 'x'], rate_limiter=rate_limiter)
+
+    assert [c.args[0] for c in rate_limiter.acquire.call_args_list] == [len('onethree'), len('seventeenx')]
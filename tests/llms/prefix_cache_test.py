@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+import torch
+
+from llms.generate import generate_text_streaming
+from llms.prefix_cache import PrefixCache
+from llms.config import Params
+
+SYSTEM_PROMPT = 'You are a helpful assistant for a course on complexity theory. '
+FIRST_TURN = SYSTEM_PROMPT + 'user: what is NP?\nassistant:'
+SECOND_TURN = FIRST_TURN + ' a class of problems.\nuser: and P?\nassistant:'
+
+
+async def _generate(model, tokenizer, prompt: str, prefix_cache=None) -> str:
+    params = Params(temperature=0, max_new_tokens=10)
+    out = ''
+    async for token in generate_text_streaming(model, tokenizer, 'cpu', params, prompt, prefix_cache=prefix_cache):
+        out += token
+    return out
+
+
+def _fake_past_key_values(length: int) -> tuple:
+    return tuple((torch.zeros(1, 2, length, 4), torch.zeros(1, 2, length, 4)) for _ in range(2))
+
+
+@pytest.mark.asyncio
+async def test_follow_up_prompt_only_prefills_the_tokens_after_the_cached_prefix(mocker, tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    prefix_cache = PrefixCache(max_bytes=10 * 1024 * 1024, block_size=8)
+
+    await _generate(model, tokenizer, FIRST_TURN, prefix_cache)
+
+    forward_spy = mocker.spy(model, 'forward')
+    text = await _generate(model, tokenizer, SECOND_TURN, prefix_cache)
+
+    prefilled_tokens = forward_spy.call_args_list[0].kwargs['input_ids'].shape[1]
+    assert prefilled_tokens == len(SECOND_TURN) - (len(FIRST_TURN) // 8) * 8
+    assert prefix_cache.hits == 1
+    assert text == await _generate(model, tokenizer, SECOND_TURN)
+
+
+def test_lookup_returns_the_longest_cached_prefix():
+    prefix_cache = PrefixCache(max_bytes=10 * 1024 * 1024, block_size=4)
+    prefix_cache.store(list(range(10)), _fake_past_key_values(10))
+
+    length, past_key_values = prefix_cache.lookup(list(range(6)) + [42, 43, 44])
+
+    assert length == 4
+    assert past_key_values[0][0].shape[2] == 4
+
+
+def test_lookup_always_leaves_the_last_token_to_be_prefilled():
+    prefix_cache = PrefixCache(max_bytes=10 * 1024 * 1024, block_size=4)
+    prefix_cache.store(list(range(8)), _fake_past_key_values(8))
+
+    length, _ = prefix_cache.lookup(list(range(8)))
+
+    assert length == 4
+
+
+def test_least_recently_used_entries_are_evicted_when_the_memory_budget_is_exceeded():
+    entry_size = sum(key.nbytes + value.nbytes for key, value in _fake_past_key_values(4))
+    prefix_cache = PrefixCache(max_bytes=2 * entry_size, block_size=4)
+
+    prefix_cache.store([1, 1, 1, 1], _fake_past_key_values(4))
+    prefix_cache.store([2, 2, 2, 2], _fake_past_key_values(4))
+    prefix_cache.lookup([1, 1, 1, 1, 0])
+    prefix_cache.store([3, 3, 3, 3], _fake_past_key_values(4))
+
+    assert prefix_cache.size_bytes == 2 * entry_size
+    assert prefix_cache.lookup([1, 1, 1, 1, 0])[0] == 4
+    assert prefix_cache.lookup([2, 2, 2, 2, 0])[0] == 0
+    assert prefix_cache.lookup([3, 3, 3, 3, 0])[0] == 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('prefill_chunk_size', [1, 7, 64])
+async def test_chunked_prefill_generates_the_same_text_as_a_single_prefill(tiny_hf_model, prefill_chunk_size):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=10)
+
+    expected = await _generate(model, tokenizer, SECOND_TURN)
+    text = ''
+    async for token in generate_text_streaming(
+        model,
+        tokenizer,
+        'cpu',
+        params,
+        SECOND_TURN,
+        prefill_chunk_size=prefill_chunk_size,
+    ):
+        text += token
+
+    assert text == expected
+
+
+@pytest.mark.asyncio
+async def test_chunked_prefill_yields_to_the_event_loop_between_slices(mocker, tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=1)
+    sleep = mocker.spy(asyncio, 'sleep')
+    forward_spy = mocker.spy(model, 'forward')
+
+    async for _ in generate_text_streaming(model, tokenizer, 'cpu', params, SECOND_TURN, prefill_chunk_size=16):
+        pass
+
+    slices = -(-len(SECOND_TURN) // 16)
+    assert [call.kwargs['input_ids'].shape[1] for call in forward_spy.call_args_list][:-1] == [16] * (slices - 1)
+    assert sleep.call_count >= slices - 1
@@ -0,0 +1,92 @@
+from transformers import MistralForCausalLM
+from torch import nn
+import pytest
+import torch
+
+from llms.quantization import quantize_model, QuantizedLinear, UnsupportedQuantizationError
+from llms.generate import load_hf_model
+import config.settings as settings
+
+
+@pytest.mark.parametrize('quantization,tolerance', [('int8', 0.01), ('int4', 0.15)])
+def test_quantized_weights_are_close_to_the_original_weights(quantization, tolerance):
+    torch.manual_seed(0)
+    linear = nn.Linear(256, 64)
+
+    quantized = quantize_model(nn.Sequential(linear), quantization)[0]
+
+    assert isinstance(quantized, QuantizedLinear)
+    relative_error = (quantized.dequantize() - linear.weight).norm() / linear.weight.norm()
+    assert relative_error < tolerance
+
+
+def test_int4_weights_are_packed_two_per_byte():
+    linear = nn.Linear(256, 64)
+
+    quantized = quantize_model(nn.Sequential(linear), 'int4')[0]
+
+    assert quantized.qweight.dtype == torch.uint8
+    assert quantized.qweight.shape == (64, 128)
+
+
+def test_all_linear_layers_but_the_output_layer_are_quantized(tiny_hf_model):
+    model, _ = tiny_hf_model
+    input_ids = torch.as_tensor([[1, 2, 3, 4, 5]])
+    with torch.no_grad():
+        expected = model(input_ids=input_ids).logits
+
+    quantize_model(model, 'int8', group_size=16)
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits
+
+    assert isinstance(model.model.layers[0].self_attn.q_proj, QuantizedLinear)
+    assert isinstance(model.model.layers[0].mlp.down_proj, QuantizedLinear)
+    assert isinstance(model.lm_head, nn.Linear)
+    assert torch.allclose(logits, expected, atol=0.05)
+
+
+def test_unsupported_quantization_is_rejected():
+    with pytest.raises(UnsupportedQuantizationError):
+        quantize_model(nn.Sequential(nn.Linear(4, 4)), 'int3')
+
+
+def test_model_is_loaded_from_safetensors_and_quantized(mocker, tmp_path, tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    model.save_pretrained(tmp_path, safe_serialization=True)
+    # llms.generate and llms.loading import get_settings directly, so they aren't covered by the settings mock
+    mocker.patch('llms.generate.get_settings', return_value=settings.get_settings())
+    mocker.patch('llms.loading.get_settings', return_value=settings.get_settings())
+    mocker.patch('llms.loading.AutoTokenizer.from_pretrained', return_value=tokenizer)
+
+    loaded_model, loaded_tokenizer = load_hf_model(str(tmp_path), 'cpu', quantization='int4')
+
+    assert loaded_tokenizer is tokenizer
+    assert isinstance(loaded_model.model.layers[0].self_attn.o_proj, QuantizedLinear)
+    assert loaded_model.dtype == torch.float16
+
+
+def test_model_without_safetensors_weights_is_loaded_from_its_pytorch_weights(mocker, tmp_path, tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    model.save_pretrained(tmp_path, safe_serialization=False)
+    mocker.patch('llms.generate.get_settings', return_value=settings.get_settings())
+    mocker.patch('llms.loading.get_settings', return_value=settings.get_settings())
+    mocker.patch('llms.loading.AutoTokenizer.from_pretrained', return_value=tokenizer)
+
+    loaded_model, _ = load_hf_model(str(tmp_path), 'cpu')
+
+    assert not (tmp_path / 'model.safetensors').exists()
+    assert isinstance(loaded_model, MistralForCausalLM)
+
+
+def test_large_layers_are_dequantized_a_block_of_rows_at_a_time(mocker):
+    torch.manual_seed(0)
+    quantized = quantize_model(nn.Sequential(nn.Linear(64, 40)), 'int4', group_size=16)[0]
+    x = torch.randn(3, 64)
+    expected = quantized(x)
+    dequantize = mocker.spy(quantized, 'dequantize')
+    mocker.patch('llms.quantization.DEQUANTIZE_BLOCK_SIZE', 64 * 16)
+
+    output = quantized(x)
+
+    assert dequantize.call_count == 3
+    assert torch.allclose(output, expected, atol=1e-5)
@@ -0,0 +1,68 @@
+import torch
+
+from llms.sampling_strategies import sample_tokens, top_k_and_p_probabilities, top_k_and_p_sampling
+
+
+def _sample_frequencies(logits: torch.Tensor, samples: int, **kwargs) -> torch.Tensor:
+    batch = logits.expand(samples, -1)
+    token_ids = sample_tokens(batch, **{name: value * samples for name, value in kwargs.items()})
+    return torch.bincount(token_ids, minlength=logits.shape[-1]) / samples
+
+
+def test_greedy_sequences_get_their_most_likely_token():
+    logits = torch.tensor([
+        [0.0, 5.0, 1.0, 2.0],
+        [3.0, 0.0, 1.0, 2.0],
+    ])
+
+    token_ids = sample_tokens(logits, temperatures=[0, 0], top_k=[2, 0], top_p=[0.5, 1.0])
+
+    assert token_ids.tolist() == [1, 0]
+
+
+def test_every_sequence_in_a_batch_uses_its_own_params():
+    torch.manual_seed(0)
+    logits = torch.arange(10, dtype=torch.float).flip(0).expand(200, -1)
+
+    token_ids = sample_tokens(
+        logits,
+        temperatures=[0, 1] * 100,
+        top_k=[0, 3] * 100,
+        top_p=[1.0, 1.0] * 100,
+    )
+
+    assert (token_ids[0::2] == 0).all()
+    assert set(token_ids[1::2].tolist()) == {0, 1, 2}
+
+
+def test_top_p_only_considers_the_tokens_that_survived_top_k():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0, 0.0]])
+
+    probabilities, indices = top_k_and_p_probabilities(logits, temperatures=[1], top_k=[3], top_p=[0.7])
+
+    assert indices.tolist() == [[0, 1, 2]]
+    assert probabilities[0, 2] == 0
+    assert torch.isclose(probabilities[0, :2].sum(), torch.tensor(1.0))
+
+
+def test_temperature_is_applied_before_filtering():
+    logits = torch.tensor([[2.0, 1.0, 0.0]])
+
+    sharp, _ = top_k_and_p_probabilities(logits, temperatures=[0.5], top_k=[0], top_p=[1.0])
+    flat, _ = top_k_and_p_probabilities(logits, temperatures=[2.0], top_k=[0], top_p=[1.0])
+
+    assert sharp[0, 0] > torch.softmax(logits, dim=-1)[0, 0] > flat[0, 0]
+
+
+def test_sampled_tokens_follow_the_same_distribution_as_the_unfused_sampling_at_temperature_one():
+    torch.manual_seed(0)
+    logits = torch.randn(32)
+    samples = 20000
+
+    fused = _sample_frequencies(logits.unsqueeze(0), samples, temperatures=[1.0], top_k=[8], top_p=[0.7])
+    unfused = torch.bincount(
+        torch.as_tensor([top_k_and_p_sampling(logits.clone(), 8, 0.7) for _ in range(samples)]),
+        minlength=32,
+    ) / samples
+
+    assert torch.allclose(fused, unfused, atol=0.02)
@@ -0,0 +1,114 @@
+from copy import deepcopy
+
+from transformers import MistralConfig, MistralForCausalLM
+import pytest
+import torch
+
+from llms.speculative import generate_text_streaming as generate_text_streaming_speculatively
+from llms.speculative import _verify, _distributions
+from llms.generate import generate_text_streaming
+from llms.config import Params
+
+PROMPTS = [
+    'hello there',
+    'x',
+    'a much longer prompt than the other ones in this list',
+]
+
+
+@pytest.fixture
+def tiny_draft_model():
+    torch.manual_seed(7)
+    config = MistralConfig(
+        vocab_size=128,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        max_position_embeddings=1024,
+    )
+    model = MistralForCausalLM(config)
+    model.eval()
+    return model
+
+
+async def _collect(generator) -> str:
+    out = ''
+    async for token in generator:
+        out += token
+    return out
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('num_speculative_tokens', [1, 3, 5])
+async def test_greedy_speculative_decoding_produces_the_same_text_as_the_target_model(
+    tiny_hf_model,
+    tiny_draft_model,
+    num_speculative_tokens,
+):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=20)
+
+    for prompt in PROMPTS:
+        expected = await _collect(generate_text_streaming(model, tokenizer, 'cpu', params, prompt))
+        text = await _collect(generate_text_streaming_speculatively(
+            model,
+            tokenizer,
+            'cpu',
+            params,
+            prompt,
+            draft_model=tiny_draft_model,
+            num_speculative_tokens=num_speculative_tokens,
+        ))
+        assert text == expected
+
+
+@pytest.mark.asyncio
+async def test_target_model_runs_once_per_proposal_when_the_draft_model_agrees_with_it(mocker, tiny_hf_model):
+    model, tokenizer = tiny_hf_model
+    params = Params(temperature=0, max_new_tokens=16)
+    expected = await _collect(generate_text_streaming(model, tokenizer, 'cpu', params, 'x'))
+    draft_model = deepcopy(model)
+    forward_spy = mocker.spy(model, 'forward')
+
+    text = await _collect(generate_text_streaming_speculatively(
+        model,
+        tokenizer,
+        'cpu',
+        params,
+        'x',
+        draft_model=draft_model,
+        num_speculative_tokens=4,
+    ))
+
+    assert text == expected
+    # one prefill for the first token, and one verification per 5 tokens (4 proposed tokens and the bonus token)
+    assert len(text) == 16
+    assert forward_spy.call_count == 1 + 3
+
+
+def test_verified_tokens_follow_the_target_distribution():
+    torch.manual_seed(0)
+    p = torch.tensor([0.6, 0.3, 0.1, 0.0])
+    q = torch.tensor([0.1, 0.2, 0.3, 0.4])
+
+    counts = torch.zeros(4)
+    for _ in range(20000):
+        proposed = int(torch.multinomial(q, num_samples=1))
+        accepted, next_token_id = _verify([proposed], [q], [p, p])
+        counts[accepted[0] if accepted else next_token_id] += 1
+
+    assert torch.allclose(counts / counts.sum(), p, atol=0.02)
+
+
+def test_distributions_follow_the_sampling_params():
+    logits = torch.tensor([[4.0, 3.0, 2.0, 1.0, 0.0]])
+
+    greedy = _distributions(logits, Params(temperature=0))[0]
+    top_k = _distributions(logits, Params(temperature=1, top_k_limit=2, enable_top_p_filter=False))[0]
+    top_p = _distributions(logits, Params(temperature=1, enable_top_k_filter=False, top_p_threshold=0.7))[0]
+
+    assert greedy.tolist() == [1, 0, 0, 0, 0]
+    assert top_k[2:].sum() == 0 and torch.isclose(top_k.sum(), torch.tensor(1.0))
+    assert top_p[2:].sum() == 0 and top_p[1] > 0
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import time
+
+import pytest
+
+from llms.threaded import stream_in_thread
+
+
+async def _blocking_generator(tokens: list, seconds_per_token: float = 0):
+    for token in tokens:
+        time.sleep(seconds_per_token)  # a forward pass, blocking its thread
+        yield token
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_streamed_in_order_from_another_thread():
+    threads = set()
+
+    async def generator():
+        for token in ['a', 'b', 'c']:
+            threads.add(threading.get_ident())
+            yield token
+
+    tokens = [token async for token in stream_in_thread(generator)]
+
+    assert tokens == ['a', 'b', 'c']
+    assert threads == {next(iter(threads))} and threading.get_ident() not in threads
+
+
+@pytest.mark.asyncio
+async def test_event_loop_keeps_running_while_tokens_are_generated():
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.create_task(tick())
+    tokens = [token async for token in stream_in_thread(lambda: _blocking_generator(['a', 'b'], 0.1))]
+    ticker.cancel()
+
+    assert tokens == ['a', 'b']
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_errors_of_the_generator_are_raised_in_the_caller():
+    async def failing_generator():
+        yield 'a'
+        raise ValueError('the model broke')
+
+    tokens = []
+    with pytest.raises(ValueError, match='the model broke'):
+        async for token in stream_in_thread(failing_generator):
+            tokens.append(token)
+
+    assert tokens == ['a']
+
+
+@pytest.mark.asyncio
+async def test_generator_stops_when_the_caller_stops_iterating():
+    generated = []
+
+    async def generator():
+        for token in range(100):
+            generated.append(token)
+            time.sleep(0.01)
+            yield str(token)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    stream = stream_in_thread(generator, executor)
+    async for token in stream:
+        if token == '2':
+            break
+    await stream.aclose()
+
+    assert len(generated) < 100
+    executor.shutdown()
@@ -0,0 +1,113 @@
+from llms.truncation import truncate_prompt
+
+
+class WordTokenizer:
+    """
+    Every word is a token.
+    """
+
+    class Encoding:
+        def __init__(self, input_ids: list):
+            self.input_ids = input_ids
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.words = {}
+
+    def __call__(self, text: str):
+        input_ids = []
+        for word in text.split():
+            if word not in self.vocabulary:
+                self.vocabulary[word] = len(self.vocabulary)
+                self.words[self.vocabulary[word]] = word
+            input_ids.append(self.vocabulary[word])
+        return self.Encoding(input_ids)
+
+    def decode(self, input_ids: list) -> str:
+        return ' '.join(self.words[token_id] for token_id in input_ids)
+
+
+PROMPT = """
+Chat rules:
+===================================
+
+RULE: be nice
+
+Documents you may source information from if useful (use citations):
+===================================
+
+name: first doc
+url: https://example.com/1
+```
+most relevant text
+```
+
+
+name: second doc
+url: https://example.com/2
+```
+least relevant text
+```
+
+
+Chat history:
+===================================
+<|user|> what is NP?
+<|assistant|> a class of problems
+<|user|> and P?
+<|assistant|>
+""".strip()
+
+
+def _truncate(max_tokens: int) -> str:
+    tokenizer = WordTokenizer()
+    return tokenizer.decode(truncate_prompt(tokenizer, PROMPT, max_tokens))
+
+
+def test_prompt_that_fits_is_not_truncated():
+    assert _truncate(1000) == ' '.join(PROMPT.split())
+
+
+def test_oldest_chat_turns_are_dropped_first():
+    text = _truncate(len(PROMPT.split()) - 3)
+
+    assert 'what is NP?' not in text
+    assert 'a class of problems' in text
+    assert 'least relevant text' in text
+
+
+def test_documents_are_dropped_from_the_least_relevant_one_once_only_the_last_turn_is_left():
+    text = _truncate(len(PROMPT.split()) - 12)
+
+    assert 'a class of problems' not in text
+    assert 'least relevant text' not in text
+    assert 'most relevant text' in text
+
+
+def test_system_prompt_headings_and_last_turn_are_always_kept():
+    text = _truncate(len(PROMPT.split()) - 29)
+
+    assert text.startswith('Chat rules: =================================== RULE: be nice')
+    assert 'relevant text' not in text
+    assert 'Chat history:' in text
+    assert text.endswith('<|user|> and P? <|assistant|>')
+
+
+def test_prompt_is_cut_from_the_front_when_nothing_more_can_be_dropped():
+    tokenizer = WordTokenizer()
+
+    input_ids = truncate_prompt(tokenizer, PROMPT, 5)
+
+    assert tokenizer.decode(input_ids) == '=================================== <|user|> and P? <|assistant|>'
+
+
+def test_headings_and_chat_turns_in_the_text_of_a_document_are_dropped_with_the_document():
+    prompt = PROMPT.replace('least relevant text', 'Introduction\n============\n<|user|> least relevant text')
+    tokenizer = WordTokenizer()
+
+    text = tokenizer.decode(truncate_prompt(tokenizer, prompt, len(prompt.split()) - 14))
+
+    assert 'least relevant text' not in text
+    assert 'Introduction' not in text
+    assert 'most relevant text' in text
+    assert text.count('```') == 2
@@ -0,0 +1,26 @@
+class MockPipeline:
+    """
+    Queues the commands of a redis pipeline, and runs them on the (mock) redis connection it was created from
+    when it's executed, so the commands can be asserted on the connection as if they weren't pipelined.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        def queue_command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+
+        return queue_command
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
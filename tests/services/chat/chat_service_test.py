@@ -1,10 +1,15 @@
+import asyncio
+
 import pytest
 
 from db.models import Message, Course, ChatConfig, Chat, FeedbackQuestion, Feedback, PromptHandle, FaqSnapshot, Faq
+from db.models import Snapshot, CachedAnswer, FaqAnswer
 from services.index.supported_indices import IndexType
 from db.models.feedback_question import FAQ_TRIGGER
 from db.models.feedback import QUESTION_UNANSWERED
+from services.chat.answer_cache import evict_cached_answers
 from services.chat.chat_service import ChatService
+import config.settings as settings
 from services.llm.supported_models import LLMModel
 
 
@@ -190,3 +195,301 @@ async def test_chat_service_can_trigger_feedback_message_on_faq_messages(create_
     )
     assert feedback.exists()
     assert feedback.first().answer == QUESTION_UNANSWERED
+
+
+@pytest.mark.asyncio
+async def test_index_is_queried_while_the_question_is_still_being_generated(mocker, new_chat):
+    new_chat.chat.index_type = IndexType.FULL_TEXT_SEARCH
+    new_chat.chat.save()
+    new_chat.add_some_messages()
+    index_queried = asyncio.Event()
+
+    async def generate_question(messages, chat):
+        await index_queried.wait()
+        return 'when is the deadline for lab 2?'
+
+    async def generate_keyword_query(messages, chat):
+        return 'lab 2 deadline'
+
+    def query_index(self, snapshot, query):
+        index_queried.set()
+        return []
+
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', side_effect=generate_question)
+    mocker.patch('services.chat.chat_service.generate_keyword_query_from_messages', side_effect=generate_keyword_query)
+    mocker.patch('services.chat.chat_service.ChatService.find_most_recent_snapshot_for_chat')
+    mock_query_index = mocker.patch('services.index.index.IndexService.query_index', autospec=True,
+                                    side_effect=query_index)
+    mock_prompt = mocker.patch('services.llm.prompts.prompt_make_next_ai_message_with_documents')
+
+    next_message = Message(chat=new_chat.chat, content=None, sender=Message.Sender.ASSISTANT)
+    next_message.save()
+
+    await asyncio.wait_for(ChatService.start_next_message(new_chat.chat, next_message), 1)
+
+    assert mock_query_index.call_args.kwargs['query'] == 'lab 2 deadline'
+    mock_prompt.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_index_is_not_queried_when_there_is_no_question(mocker, new_chat):
+    new_chat.chat.index_type = IndexType.FULL_TEXT_SEARCH
+    new_chat.chat.save()
+    new_chat.add_some_messages()
+
+    async def generate_keyword_query(messages, chat):
+        await asyncio.Event().wait()
+
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', return_value='NO_QUESTION')
+    mocker.patch('services.chat.chat_service.generate_keyword_query_from_messages', side_effect=generate_keyword_query)
+    mock_query_index = mocker.patch('services.index.index.IndexService.query_index')
+    mock_prompt = mocker.patch('services.llm.prompts.prompt_make_next_ai_message')
+
+    next_message = Message(chat=new_chat.chat, content=None, sender=Message.Sender.ASSISTANT)
+    next_message.save()
+
+    await asyncio.wait_for(ChatService.start_next_message(new_chat.chat, next_message), 1)
+
+    mock_query_index.assert_not_called()
+    mock_prompt.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_keyword_query_is_cancelled_when_there_is_no_question(mocker, new_chat):
+    new_chat.chat.index_type = IndexType.FULL_TEXT_SEARCH
+    new_chat.chat.save()
+    new_chat.add_some_messages()
+
+    keyword_query_dispatched = asyncio.Event()
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        keyword_query_dispatched.set()
+        await asyncio.Event().wait()
+
+    async def generate_question(messages, chat):
+        await keyword_query_dispatched.wait()
+        return 'NO_QUESTION'
+
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', side_effect=generate_question)
+    mocker.patch('services.chat.questions.prompt_generate_keyword_query_from_chat_history', return_value='query')
+    mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+    mocker.patch('services.llm.prompts.prompt_make_next_ai_message', return_value='answer the student')
+
+    next_message = Message(chat=new_chat.chat, content=None, sender=Message.Sender.ASSISTANT)
+    next_message.save()
+
+    await asyncio.wait_for(ChatService.start_next_message(new_chat.chat, next_message), 1)
+    await asyncio.sleep(0)
+
+    cancelled = PromptHandle.select().where(PromptHandle.state == PromptHandle.States.FAILED)
+    assert [handle.prompt for handle in cancelled] == ['query']
+    assert next_message.prompt_handle.state == PromptHandle.States.PENDING
+
+
+@pytest.mark.asyncio
+async def test_keyword_query_that_a_worker_has_claimed_is_not_cancelled(mocker, new_chat):
+    new_chat.chat.index_type = IndexType.FULL_TEXT_SEARCH
+    new_chat.chat.save()
+    new_chat.add_some_messages()
+
+    keyword_query_claimed = asyncio.Event()
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        handle.state = PromptHandle.States.IN_PROGRESS
+        handle.save()
+        keyword_query_claimed.set()
+        await asyncio.Event().wait()
+
+    async def generate_question(messages, chat):
+        await keyword_query_claimed.wait()
+        return 'NO_QUESTION'
+
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', side_effect=generate_question)
+    mocker.patch('services.chat.questions.prompt_generate_keyword_query_from_chat_history', return_value='query')
+    mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+    mocker.patch('services.llm.prompts.prompt_make_next_ai_message', return_value='answer the student')
+
+    next_message = Message(chat=new_chat.chat, content=None, sender=Message.Sender.ASSISTANT)
+    next_message.save()
+
+    await asyncio.wait_for(ChatService.start_next_message(new_chat.chat, next_message), 1)
+    await asyncio.sleep(0)
+
+    assert PromptHandle.select().where(PromptHandle.state == PromptHandle.States.FAILED).count() == 0
+    assert PromptHandle.select().where(PromptHandle.state == PromptHandle.States.IN_PROGRESS).count() == 1
+
+
+@pytest.fixture
+def answer_cache_simulation(mocker, valid_course, authenticated_session):
+    settings.get_settings().ANSWER_CACHE_ENABLED = True
+    settings.get_settings().ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.9
+
+    embeddings = {
+        'when is the deadline for lab 2?': [1.0, 0.0, 0.1],
+        'what is the deadline of lab 2?': [1.0, 0.0, 0.2],
+        'who is the examiner?': [0.0, 1.0, 0.0],
+    }
+    snapshot = Snapshot(course=valid_course)
+    snapshot.save()
+
+    class AnswerCacheSimulation:
+
+        def __init__(self):
+            self.snapshot = snapshot
+            self.question = None
+            mocker.patch('services.chat.answer_cache._embed', side_effect=self._embed)
+            mocker.patch('services.chat.chat_service.generate_question_from_messages', side_effect=self._question)
+            mocker.patch('services.chat.chat_service.generate_keyword_query_from_messages', return_value='query')
+            mocker.patch('services.chat.chat_service.ChatService.find_most_recent_snapshot_for_chat',
+                         side_effect=lambda chat: self.snapshot)
+            mocker.patch('services.index.index.IndexService.query_index', return_value=[])
+
+        async def _embed(self, question: str):
+            return embeddings[question]
+
+        async def _question(self, messages, chat):
+            return self.question
+
+        async def ask(self, question: str) -> Message:
+            self.question = question
+            chat = Chat(
+                course=valid_course,
+                session=authenticated_session.session,
+                llm_model_name=LLMModel.MISTRAL_7B_INSTRUCT,
+                index_type=IndexType.FULL_TEXT_SEARCH,
+            )
+            chat.save()
+            Message(chat=chat, content=question, sender=Message.Sender.STUDENT).save()
+            next_message = Message(chat=chat, content=None, sender=Message.Sender.ASSISTANT)
+            next_message.save()
+            return await ChatService.start_next_message(chat, next_message)
+
+        @staticmethod
+        def finish(message: Message, response: str):
+            message.prompt_handle.state = PromptHandle.States.FINISHED
+            message.prompt_handle.response = response
+            message.prompt_handle.response_time_taken_s = 12
+            message.prompt_handle.save()
+
+    return AnswerCacheSimulation()
+
+
+@pytest.mark.asyncio
+async def test_similar_first_question_is_answered_from_the_answer_cache(answer_cache_simulation):
+    first = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+    answer_cache_simulation.finish(first, 'the deadline is on friday.')
+
+    second = await answer_cache_simulation.ask('what is the deadline of lab 2?')
+
+    assert second.prompt_handle.id != first.prompt_handle.id
+    assert second.prompt_handle.state == PromptHandle.States.FINISHED
+    assert second.prompt_handle.response == 'the deadline is on friday.'
+    assert second.state == Message.States.READY
+    assert PromptHandle.select().where(PromptHandle.state == PromptHandle.States.PENDING).count() == 0
+    assert CachedAnswer.get(CachedAnswer.prompt_handle == first.prompt_handle).hits == 1
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_is_not_used_for_different_questions_or_unfinished_answers(answer_cache_simulation):
+    first = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+    not_finished = await answer_cache_simulation.ask('what is the deadline of lab 2?')
+    answer_cache_simulation.finish(first, 'the deadline is on friday.')
+    different = await answer_cache_simulation.ask('who is the examiner?')
+
+    assert not_finished.prompt_handle.state == PromptHandle.States.PENDING
+    assert different.prompt_handle.state == PromptHandle.States.PENDING
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_is_looked_up_before_the_index_is_queried(mocker, answer_cache_simulation):
+    first = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+    answer_cache_simulation.finish(first, 'the deadline is on friday.')
+    mock_query_index = mocker.patch('services.index.index.IndexService.query_index', return_value=[])
+
+    second = await answer_cache_simulation.ask('what is the deadline of lab 2?')
+
+    assert second.prompt_handle.response == 'the deadline is on friday.'
+    mock_query_index.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_question_is_embedded_while_it_is_being_rewritten(mocker, answer_cache_simulation):
+    embedded = asyncio.Event()
+
+    async def embed(question: str):
+        embedded.set()
+        return [1.0, 0.0, 0.1]
+
+    async def generate_question(messages, chat):
+        await embedded.wait()
+        return 'when is the deadline for lab 2?'
+
+    mocker.patch('services.chat.answer_cache._embed', side_effect=embed)
+    mocker.patch('services.chat.chat_service.generate_question_from_messages', side_effect=generate_question)
+
+    message = await asyncio.wait_for(answer_cache_simulation.ask('when is the deadline for lab 2?'), 1)
+
+    assert CachedAnswer.get(CachedAnswer.prompt_handle == message.prompt_handle).embedding == [1.0, 0.0, 0.1]
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_only_compares_the_most_recent_answers(answer_cache_simulation):
+    settings.get_settings().ANSWER_CACHE_MAX_CANDIDATES = 1
+    first = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+    answer_cache_simulation.finish(first, 'the deadline is on friday.')
+    other = await answer_cache_simulation.ask('who is the examiner?')
+    answer_cache_simulation.finish(other, 'the examiner is alice.')
+
+    second = await answer_cache_simulation.ask('what is the deadline of lab 2?')
+
+    assert second.prompt_handle.state == PromptHandle.States.PENDING
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_is_not_used_once_the_course_has_a_new_snapshot(answer_cache_simulation, valid_course):
+    first = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+    answer_cache_simulation.finish(first, 'the deadline is on friday.')
+
+    answer_cache_simulation.snapshot = Snapshot(course=valid_course)
+    answer_cache_simulation.snapshot.save()
+    second = await answer_cache_simulation.ask('when is the deadline for lab 2?')
+
+    assert second.prompt_handle.state == PromptHandle.States.PENDING
+
+    evict_cached_answers(valid_course)
+    assert [cached.prompt_handle.id for cached in CachedAnswer.select()] == [second.prompt_handle.id]
+
+
+@pytest.mark.asyncio
+async def test_faq_is_answered_with_a_copy_of_its_precomputed_answer(mocker, new_chat, valid_course):
+    mock_dispatch = mocker.patch('services.llm.llm.LLMService.dispatch_prompt')
+    snapshot = Snapshot(course=valid_course)
+    snapshot.save()
+    faq = Faq(question="when is the deadline for lab 2?", snapshot=FaqSnapshot.get(FaqSnapshot.course == valid_course))
+    faq.save()
+    precomputed = PromptHandle(
+        prompt="when is the deadline for lab 2?",
+        llm_model_name=new_chat.chat.llm_model_name,
+        state=PromptHandle.States.FINISHED,
+        response="the deadline is on friday.",
+    )
+    precomputed.save()
+    FaqAnswer(
+        faq=faq,
+        snapshot=snapshot,
+        llm_model_name=new_chat.chat.llm_model_name,
+        index_type=new_chat.chat.index_type,
+        prompt_handle=precomputed,
+    ).save()
+
+    Message(chat=new_chat.chat, content=faq.question, sender=Message.Sender.STUDENT, faq=faq).save()
+    next_message = Message(chat=new_chat.chat, content=None, sender=Message.Sender.ASSISTANT, faq=faq)
+    next_message.save()
+
+    message = await ChatService.start_next_message(new_chat.chat, next_message)
+
+    mock_dispatch.assert_not_called()
+    assert message.prompt_handle.id != precomputed.id
+    assert message.prompt_handle.state == PromptHandle.States.FINISHED
+    assert message.prompt_handle.response == "the deadline is on friday."
+    assert message.state == Message.States.READY
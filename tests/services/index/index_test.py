@@ -1,10 +1,14 @@
 from unittest.mock import AsyncMock
+import asyncio
 
 import pytest
+import arrow
 
+from services.index.embedding_cache import EmbeddingCache, evict_cached_embeddings
 from services.llm.supported_models import LLMModel, EMBEDDING_MODELS
+from db.models import Url, PromptHandle, CachedEmbedding, Snapshot, Content
 from services.index.index import IndexService
-from db.models import Url, PromptHandle
+import config.settings as settings
 
 
 @pytest.mark.asyncio
@@ -12,6 +16,8 @@ async def test_service_checks_if_index_exist_when_adding_url(new_snapshot, mocke
     mocker.patch('services.index.opensearch.get_client')
     mock_index_exists = mocker.patch('services.index.opensearch.index_exists', return_value=True)
     mocker.patch('services.llm.llm.LLMService.wait_for_handle')
+    mocker.patch('services.index.embedding_cache.EmbeddingCache.put')
+    mocker.patch('services.index.opensearch.BulkIndexer')
 
     url = new_snapshot.add_url_with_content()
 
@@ -28,6 +34,8 @@ async def test_service_creates_index_if_not_exists(new_snapshot, mocker):
     mock_index_exists = mocker.patch('services.index.opensearch.index_exists', return_value=False)
     mock_create_index = mocker.patch('services.index.opensearch.create_index')
     mocker.patch('services.llm.llm.LLMService.wait_for_handle')
+    mocker.patch('services.index.embedding_cache.EmbeddingCache.put')
+    mocker.patch('services.index.opensearch.BulkIndexer')
 
     url = new_snapshot.add_url_with_content()
 
@@ -66,7 +74,8 @@ Chunk content: some content
     wait_for_handle_mock = mocker.patch('services.llm.llm.LLMService.wait_for_handle', new_callable=AsyncMock)
     wait_for_handle_mock.side_effect = [handle_1, handle_2, handle_2]
 
-    mock_index_document = mocker.patch('services.index.opensearch.index_document')
+    mock_bulk_indexer = mocker.patch('services.index.opensearch.BulkIndexer')
+    mock_add_document = mock_bulk_indexer.return_value.add
 
     url = new_snapshot.add_url_with_content()
 
@@ -74,14 +83,225 @@ Chunk content: some content
 
     await index_service.index_url(url)
 
-    mock_index_document.assert_called_once_with(index_service.client, url.snapshot, f"{url.id}-0", {
+    mock_bulk_indexer.assert_called_once_with(index_service.client, url.snapshot.id)
+    mock_bulk_indexer.return_value.close.assert_called_once()
+    mock_add_document.assert_called_once_with(f"{url.id}-0", {
         'name': url.content.name,
         'text': chunk,
         'text_raw': url.content.text,
         'url': url.href,
         EMBEDDING_MODELS[LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE]: [0.1, 0.2, 0.3],
         EMBEDDING_MODELS[LLMModel.SALESFORCE_SFR_EMBEDDING_MISTRAL]: [0.1, 0.2, 0.3],
+        'content_sha': url.content.sha,
     })
 
     url.refresh()
     assert url.state == Url.States.INDEXED
+
+
+@pytest.mark.asyncio
+async def test_service_requests_the_embeddings_of_all_chunks_before_waiting_for_any(new_snapshot, mocker):
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mocker.patch('services.index.index.split_text_with_overlap', return_value=['chunk 1', 'chunk 2', 'chunk 3'])
+    mock_add_document = mocker.patch('services.index.opensearch.BulkIndexer').return_value.add
+
+    handle_counts_when_waiting = []
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        if handle.llm_model_name in EMBEDDING_MODELS:
+            handle_counts_when_waiting.append(PromptHandle.select().where(
+                PromptHandle.llm_model_name << list(EMBEDDING_MODELS.keys())
+            ).count())
+            handle.embedding = [0.1, 0.2, 0.3]
+        return handle
+
+    mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+
+    url = new_snapshot.add_url_with_content()
+
+    await IndexService().index_url(url)
+
+    assert handle_counts_when_waiting == [6] * 6
+    assert mock_add_document.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_service_reuses_cached_embeddings_of_unchanged_content(new_snapshot, mocker):
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mock_add_document = mocker.patch('services.index.opensearch.BulkIndexer').return_value.add
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        if handle.llm_model_name in EMBEDDING_MODELS:
+            handle.embedding = [0.1, 0.2, 0.3]
+        else:
+            handle.response = "document summary..."
+        return handle
+
+    wait_for_handle_mock = mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+
+    url = new_snapshot.add_url_with_content()
+    await IndexService().index_url(url)
+    assert wait_for_handle_mock.call_count == 3
+
+    wait_for_handle_mock.reset_mock()
+    index_service = IndexService()
+    await index_service.index_url(url)
+
+    # only the summary is requested again, both embeddings come from the cache
+    assert wait_for_handle_mock.call_count == 1
+    assert index_service.embedding_cache.hit_rate == 1.0
+    assert mock_add_document.call_args_list[0] == mock_add_document.call_args_list[1]
+
+    cached = CachedEmbedding.select().where(
+        CachedEmbedding.llm_model_name == LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE
+    ).get()
+    assert cached.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_service_reuses_cached_embeddings_when_the_summary_of_the_content_differs(new_snapshot, mocker):
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mock_add_document = mocker.patch('services.index.opensearch.BulkIndexer').return_value.add
+
+    summaries = iter(["a summary of the document", "another summary of the same document"])
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        if handle.llm_model_name in EMBEDDING_MODELS:
+            handle.embedding = [0.1, 0.2, 0.3]
+        else:
+            handle.response = next(summaries)
+        return handle
+
+    wait_for_handle_mock = mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+
+    url = new_snapshot.add_url_with_content()
+    index_service = IndexService()
+    await index_service.index_url(url)
+
+    wait_for_handle_mock.reset_mock()
+    await index_service.index_url(url)
+
+    # the cache counters only count the lookups of the last url
+    assert wait_for_handle_mock.call_count == 1
+    assert index_service.embedding_cache.hits == 2
+    assert index_service.embedding_cache.misses == 0
+    assert "another summary of the same document" in mock_add_document.call_args_list[1].args[1]['text']
+
+
+def test_expired_and_least_recently_used_cached_embeddings_are_evicted():
+    settings.get_settings().EMBEDDING_CACHE_TTL_DAYS = 30
+    settings.get_settings().EMBEDDING_CACHE_MAX_ENTRIES = 1
+
+    cache = EmbeddingCache()
+    for text in ['one', 'two', 'three']:
+        cache.put(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, text, [0.1])
+
+    CachedEmbedding.update(last_used_at=arrow.utcnow().shift(days=-1)).where(
+        CachedEmbedding.sha == CachedEmbedding.make_sha('two')
+    ).execute()
+    CachedEmbedding.update(last_used_at=arrow.utcnow().shift(days=-31)).where(
+        CachedEmbedding.sha == CachedEmbedding.make_sha('three')
+    ).execute()
+    cache.get(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, 'one')
+
+    evict_cached_embeddings()
+
+    assert cache.get(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, 'one') == [0.1]
+    assert cache.get(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, 'two') is None
+    assert cache.get(LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE, 'three') is None
+
+
+@pytest.mark.asyncio
+async def test_service_copies_the_documents_of_content_that_was_indexed_in_a_previous_snapshot(
+    new_snapshot,
+    mocker
+):
+    previous_url = new_snapshot.add_url_with_content()
+    previous_url.state = Url.States.INDEXED
+    previous_url.save()
+
+    snapshot = Snapshot(course=new_snapshot.course)
+    snapshot.save()
+    content = Content(text=previous_url.content.text, name="file-renamed.pdf")
+    content.save()
+    url = Url(snapshot=snapshot, href="https://example.com/1", distance=0, content=content)
+    url.save()
+
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mock_find_documents = mocker.patch('services.index.opensearch.find_documents_with_content_sha', return_value={
+        f"{previous_url.id}-0": {'name': 'file.pdf', 'text': 'chunk 1', 'content_sha': content.sha},
+        f"{previous_url.id}-1": {'name': 'file.pdf', 'text': 'chunk 2', 'content_sha': content.sha},
+    })
+    mock_index_documents = mocker.patch('services.index.opensearch.index_documents')
+    wait_for_handle_mock = mocker.patch('services.llm.llm.LLMService.wait_for_handle')
+
+    await IndexService().index_url(url)
+
+    mock_find_documents.assert_called_once_with(None, previous_url.snapshot.id, content.sha)
+    mock_index_documents.assert_called_once_with(None, snapshot.id, {
+        f"{url.id}-0": {'name': 'file-renamed.pdf', 'url': url.href, 'text': 'chunk 1', 'content_sha': content.sha},
+        f"{url.id}-1": {'name': 'file-renamed.pdf', 'url': url.href, 'text': 'chunk 2', 'content_sha': content.sha},
+    })
+    wait_for_handle_mock.assert_not_called()
+
+    url.refresh()
+    assert url.state == Url.States.INDEXED
+
+
+@pytest.mark.asyncio
+async def test_service_indexes_content_if_the_previous_snapshot_has_no_documents_to_copy(new_snapshot, mocker):
+    previous_url = new_snapshot.add_url_with_content()
+    previous_url.state = Url.States.INDEXED
+    previous_url.save()
+
+    snapshot = Snapshot(course=new_snapshot.course)
+    snapshot.save()
+    url = Url(snapshot=snapshot, href="https://example.com/1", distance=0, content=previous_url.content)
+    url.save()
+
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mocker.patch('services.index.opensearch.find_documents_with_content_sha', return_value={})
+    mock_add_document = mocker.patch('services.index.opensearch.BulkIndexer').return_value.add
+    mocker.patch('services.llm.llm.LLMService.wait_for_handle')
+    mocker.patch('services.index.embedding_cache.EmbeddingCache.put')
+
+    await IndexService().index_url(url)
+
+    mock_add_document.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_service_waits_for_the_embeddings_of_all_chunks_at_once_with_a_concurrency_limit(new_snapshot, mocker):
+    settings.get_settings().INDEX_MAX_CONCURRENT_EMBEDDING_WAITS = 4
+
+    mocker.patch('services.index.opensearch.get_client', return_value=None)
+    mocker.patch('services.index.opensearch.index_exists', return_value=True)
+    mocker.patch('services.index.index.split_text_with_overlap', return_value=['chunk 1', 'chunk 2', 'chunk 3'])
+    mock_add_document = mocker.patch('services.index.opensearch.BulkIndexer').return_value.add
+
+    waiting = 0
+    most_waiting_at_once = 0
+
+    async def wait_for_handle(handle, timeout_seconds=120):
+        nonlocal waiting, most_waiting_at_once
+        if handle.llm_model_name in EMBEDDING_MODELS:
+            waiting += 1
+            most_waiting_at_once = max(most_waiting_at_once, waiting)
+            await asyncio.sleep(0.01)
+            waiting -= 1
+            handle.embedding = [0.1, 0.2, 0.3]
+        return handle
+
+    mocker.patch('services.llm.llm.LLMService.wait_for_handle', side_effect=wait_for_handle)
+
+    url = new_snapshot.add_url_with_content()
+
+    await IndexService().index_url(url)
+
+    assert most_waiting_at_once == 4
+    assert sorted(c.args[0] for c in mock_add_document.call_args_list) == [f"{url.id}-{idx}" for idx in range(3)]
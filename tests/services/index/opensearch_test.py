@@ -0,0 +1,65 @@
+import pytest
+
+from services.index.opensearch import BulkIndexer, BulkIndexingError
+
+
+def _bulk_mock(mocker, failures=None):
+    def bulk(client, actions, raise_on_error):
+        return len(actions) - len(failures or []), list(failures or [])
+
+    return mocker.patch('opensearchpy.helpers.bulk', side_effect=bulk)
+
+
+def test_bulk_indexer_flushes_when_buffer_is_full(mocker):
+    mock_bulk = _bulk_mock(mocker)
+    client = mocker.Mock()
+
+    indexer = BulkIndexer(client, 'index', max_documents=2)
+    indexer.add('1-0', {'text': 'one'})
+    assert mock_bulk.call_count == 0
+
+    indexer.add('1-1', {'text': 'two'})
+    assert mock_bulk.call_count == 1
+    assert mock_bulk.call_args.args[1] == [
+        {'_index': 'index', '_id': '1-0', '_source': {'text': 'one'}},
+        {'_index': 'index', '_id': '1-1', '_source': {'text': 'two'}},
+    ]
+    client.indices.refresh.assert_not_called()
+
+
+def test_bulk_indexer_flushes_when_buffer_has_been_held_too_long(mocker):
+    mock_bulk = _bulk_mock(mocker)
+    mock_time = mocker.patch('time.monotonic', return_value=100)
+
+    indexer = BulkIndexer(mocker.Mock(), 'index', max_interval_seconds=5)
+    indexer.add('1-0', {'text': 'one'})
+    assert mock_bulk.call_count == 0
+
+    mock_time.return_value = 106
+    indexer.add('1-1', {'text': 'two'})
+    assert mock_bulk.call_count == 1
+
+
+def test_bulk_indexer_refreshes_the_index_once_when_closed(mocker):
+    mock_bulk = _bulk_mock(mocker)
+    client = mocker.Mock()
+
+    indexer = BulkIndexer(client, 'index', max_documents=2)
+    for idx in range(5):
+        indexer.add(f'1-{idx}', {'text': str(idx)})
+    indexer.close()
+
+    assert mock_bulk.call_count == 3
+    assert indexer.indexed == 5
+    client.indices.refresh.assert_called_once_with(index='index')
+
+
+def test_bulk_indexer_reports_documents_that_failed(mocker):
+    _bulk_mock(mocker, failures=[{'index': {'_id': '1-1', 'status': 400, 'error': 'mapper_parsing_exception'}}])
+
+    indexer = BulkIndexer(mocker.Mock(), 'index')
+    indexer.add('1-0', {'text': 'one'})
+    indexer.add('1-1', {'text': 'two'})
+
+    with pytest.raises(BulkIndexingError, match='1-1'):
+        indexer.close()
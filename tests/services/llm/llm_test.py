@@ -1,10 +1,17 @@
 from unittest.mock import AsyncMock
 
+from redis.exceptions import ConnectionError as RedisConnectionError
 import pytest
+import arrow
 
-from services.llm.llm import NoPendingPromptHandleError, LLMService
+from services.llm.llm import NoPendingPromptHandleError, LLMService, LLMServiceTimeoutException
+from services.llm.llm import LLMServiceFailedException
+from services.llm.llm import FALLBACK_POLL_INTERVAL_SECONDS
+from cache.notifications import prompt_handle_channel, PROMPT_HANDLE_FINISHED
+from cache.stream_hub import Subscription
 from services.llm.supported_models import LLMModel
 from db.models import PromptHandle
+import config.settings as settings
 from llms.config import Params
 
 
@@ -120,20 +127,53 @@ async def test_checkout_returns_a_handle_and_updates_its_state(redis_connection,
     assert handle.state == PromptHandle.States.IN_PROGRESS
 
 
-@pytest.mark.asyncio
-async def test_checkout_acquires_a_redis_lock_on_the_handle(mocker, redis_connection, llm_prompt, llm_model_name):
-    mock_acquire_lock = mocker.patch('cache.mutex.acquire_lock', new_callable=AsyncMock)
-    mock_release_lock = mocker.patch('cache.mutex.release_lock', new_callable=AsyncMock)
-
+def test_claim_returns_a_batch_of_the_oldest_pending_handles(redis_connection, llm_prompt, llm_model_name):
     service = LLMService(llm_model_name, redis_connection)
 
+    handles = []
+    for _ in range(3):
+        handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+        handle.save()
+        handles.append(handle)
+
+    claimed = service.claim(2)
+
+    assert [handle.id for handle in claimed] == [handles[0].id, handles[1].id]
+    for handle in claimed:
+        handle.refresh()
+        assert handle.state == PromptHandle.States.IN_PROGRESS
+
+
+def test_claimed_handles_are_never_claimed_again(redis_connection, llm_prompt, llm_model_name):
+    service_1 = LLMService(llm_model_name, redis_connection)
+    service_2 = LLMService(llm_model_name, redis_connection)
+
     handle_1 = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle_2 = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
     handle_1.save()
+    handle_2.save()
+
+    assert [handle.id for handle in service_1.claim(1)] == [handle_1.id]
+    assert [handle.id for handle in service_2.claim(5)] == [handle_2.id]
+    assert service_1.claim(5) == []
+
+
+def test_handles_claimed_longer_ago_than_the_claim_timeout_are_claimed_again(
+    redis_connection,
+    llm_prompt,
+    llm_model_name
+):
+    settings.get_settings().LLM_WORKER_CLAIM_TIMEOUT_SECONDS = 60
+    service = LLMService(llm_model_name, redis_connection)
 
-    await service.checkout()
+    stale = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    stale.save()
+    recent = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    recent.save()
+    service.claim(2)
+    PromptHandle.update(modified_at=arrow.utcnow().shift(minutes=-2)).where(PromptHandle.id == stale.id).execute()
 
-    mock_acquire_lock.assert_awaited_once_with(redis_connection, f'prompt_handle_{handle_1.id}')
-    mock_release_lock.assert_awaited_once_with(redis_connection, f'prompt_handle_{handle_1.id}')
+    assert [handle.id for handle in service.claim(5)] == [stale.id]
 
 
 def test_model_params_can_be_specified(llm_model_name):
@@ -173,3 +213,108 @@ def test_model_to_use_for_prompt_can_be_specified():
     handle = PromptHandle.get(handle_id)
 
     assert handle.llm_model_name == model_name
+
+
+@pytest.fixture
+def stream_hub(mocker):
+    hub = AsyncMock()
+    hub.subscribe.side_effect = lambda channel: Subscription(channel)
+    mocker.patch('services.llm.llm.get_stream_hub', return_value=hub)
+    return hub
+
+
+@pytest.mark.asyncio
+async def test_wait_for_handle_rechecks_the_handle_when_finished_notification_arrives(
+    stream_hub,
+    llm_prompt,
+    llm_model_name
+):
+    handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle.save()
+
+    async def finish_handle(channel):
+        other = PromptHandle.get(handle.id)
+        other.state = PromptHandle.States.FINISHED
+        other.response = "done"
+        other.save()
+        subscription = Subscription(channel)
+        subscription.queue.put_nowait({'type': 'message', 'channel': channel, 'data': PROMPT_HANDLE_FINISHED})
+        return subscription
+
+    stream_hub.subscribe.side_effect = finish_handle
+
+    handle = await LLMService.wait_for_handle(handle)
+
+    assert handle.response == "done"
+    stream_hub.subscribe.assert_awaited_once_with(prompt_handle_channel(handle.id))
+    stream_hub.unsubscribe.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_handle_does_not_subscribe_when_the_handle_has_already_finished(
+    stream_hub,
+    llm_prompt,
+    llm_model_name
+):
+    handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle.save()
+    PromptHandle.update(state=PromptHandle.States.FINISHED).where(PromptHandle.id == handle.id).execute()
+
+    handle = await LLMService.wait_for_handle(handle)
+
+    assert handle.state == PromptHandle.States.FINISHED
+    stream_hub.subscribe.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_handle_falls_back_to_polling_when_redis_is_unavailable(
+    mocker,
+    stream_hub,
+    llm_prompt,
+    llm_model_name
+):
+    handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle.save()
+
+    stream_hub.subscribe.side_effect = RedisConnectionError()
+
+    async def finish_handle(*args, **kwargs):
+        other = PromptHandle.get(handle.id)
+        other.state = PromptHandle.States.FINISHED
+        other.save()
+
+    mock_sleep = mocker.patch('asyncio.sleep', side_effect=finish_handle)
+
+    handle = await LLMService.wait_for_handle(handle)
+
+    assert handle.state == PromptHandle.States.FINISHED
+    mock_sleep.assert_awaited_once_with(FALLBACK_POLL_INTERVAL_SECONDS)
+    stream_hub.unsubscribe.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_handle_raises_when_the_handle_fails(stream_hub, llm_prompt, llm_model_name):
+    handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle.save()
+
+    async def fail_handle(channel):
+        PromptHandle.update(state=PromptHandle.States.FAILED).where(PromptHandle.id == handle.id).execute()
+        return Subscription(channel)
+
+    stream_hub.subscribe.side_effect = fail_handle
+
+    with pytest.raises(LLMServiceFailedException):
+        await LLMService.wait_for_handle(handle)
+
+    stream_hub.unsubscribe.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_handle_times_out(stream_hub, llm_prompt, llm_model_name):
+    handle = PromptHandle(prompt=llm_prompt, llm_model_name=llm_model_name)
+    handle.save()
+
+    with pytest.raises(LLMServiceTimeoutException):
+        await LLMService.wait_for_handle(handle, timeout_seconds=0)
+
+    stream_hub.unsubscribe.assert_awaited_once()
@@ -0,0 +1,64 @@
+import pytest
+
+from services.llm.rate_limiter import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(mocker) -> FakeClock:
+    clock = FakeClock()
+
+    async def sleep(seconds):
+        clock.now += seconds
+
+    mocker.patch('asyncio.sleep', side_effect=sleep)
+    return clock
+
+
+@pytest.mark.asyncio
+async def test_requests_within_the_budget_are_let_through_immediately(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000, clock=clock)
+
+    for _ in range(10):
+        await limiter.acquire(100)
+
+    assert clock.now == 0
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_when_the_requests_per_minute_are_used_up(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100000, clock=clock)
+
+    for _ in range(60):
+        await limiter.acquire(1)
+    await limiter.acquire(1)
+
+    # one request per second is refilled
+    assert clock.now == pytest.approx(1)
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_when_the_tokens_per_minute_are_used_up(clock):
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=6000, clock=clock)
+
+    await limiter.acquire(6000)
+    await limiter.acquire(3000)
+
+    # 100 tokens per second are refilled
+    assert clock.now == pytest.approx(30)
+
+
+@pytest.mark.asyncio
+async def test_requests_larger_than_the_budget_still_get_through(clock):
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=6000, clock=clock)
+
+    await limiter.acquire(10000)
+
+    assert clock.now == 0
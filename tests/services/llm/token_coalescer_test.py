@@ -0,0 +1,104 @@
+from unittest.mock import AsyncMock
+import asyncio
+
+import pytest
+
+from services.llm.token_coalescer import TokenCoalescer
+from cache.token_streams import TokenStreamPublisher, decode_frame
+
+
+def _sent_texts(sink: AsyncMock) -> list:
+    return [c.args[0] for c in sink.send.call_args_list]
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_sent_as_one_piece_of_text_once_max_chars_is_reached():
+    sink = AsyncMock()
+    coalescer = TokenCoalescer(sink, max_delay_ms=10_000, max_chars=8)
+
+    for token in ['baby', ' don', "'t", ' hurt', ' me']:
+        await coalescer.send(token)
+
+    assert _sent_texts(sink) == ['baby don', "'t hurt me"]
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_flushed_after_max_delay():
+    sink = AsyncMock()
+    coalescer = TokenCoalescer(sink, max_delay_ms=10, max_chars=1000)
+
+    await coalescer.send('hello')
+    await coalescer.send(' there')
+    assert sink.send.call_count == 0
+
+    await asyncio.sleep(0.05)
+
+    assert _sent_texts(sink) == ['hello there']
+
+
+@pytest.mark.asyncio
+async def test_finish_flushes_remaining_tokens_before_finishing_the_sink():
+    sink = AsyncMock()
+    coalescer = TokenCoalescer(sink, max_delay_ms=10_000, max_chars=1000)
+
+    await coalescer.send('what is')
+    await coalescer.send(' love')
+    await coalescer.finish()
+
+    assert _sent_texts(sink) == ['what is love']
+    sink.finish.assert_awaited_once()
+    assert sink.method_calls[-1][0] == 'finish'
+
+
+@pytest.mark.asyncio
+async def test_text_is_sent_in_order_when_timer_and_size_flushes_interleave():
+    sent = []
+
+    class SlowSink:
+
+        async def send(self, text: str):
+            await asyncio.sleep(0.005)
+            sent.append(text)
+
+        async def finish(self):
+            pass
+
+    coalescer = TokenCoalescer(SlowSink(), max_delay_ms=1, max_chars=3)
+    text = ''.join(str(i % 10) for i in range(100))
+    for char in text:
+        await coalescer.send(char)
+        await asyncio.sleep(0.001)
+    await coalescer.finish()
+
+    assert ''.join(sent) == text
+
+
+@pytest.mark.asyncio
+async def test_errors_raised_by_a_delayed_flush_are_raised_by_the_next_call():
+    sink = AsyncMock()
+    sink.send.side_effect = ConnectionError('connection closed')
+    coalescer = TokenCoalescer(sink, max_delay_ms=1, max_chars=1000)
+
+    await coalescer.send('hello')
+    await asyncio.sleep(0.02)
+
+    with pytest.raises(ConnectionError):
+        await coalescer.send(' there')
+
+
+@pytest.mark.asyncio
+async def test_coalesced_frames_carry_the_offset_of_their_text(redis_connection):
+    publisher = TokenStreamPublisher(redis_connection, '/ws/some-session', compact=True)
+    coalescer = TokenCoalescer(publisher, max_delay_ms=10_000, max_chars=6)
+
+    for token in ['baby', ' don', "'t", ' hurt', ' me']:
+        await coalescer.send(token)
+    await coalescer.finish()
+
+    frames = [decode_frame(c.args[1]) for c in redis_connection.publish.call_args_list]
+    assert [(f.seq, f.offset, f.text, f.end) for f in frames] == [
+        (1, 0, 'baby don', False),
+        (2, 8, "'t hurt", False),
+        (3, 15, ' me', False),
+        (4, 18, '', True),
+    ]
@@ -1,14 +1,21 @@
-from unittest.mock import call
+from unittest.mock import call, AsyncMock
+import asyncio
 
+from redis.exceptions import ConnectionError as RedisConnectionError
+from websockets import WebSocketClientProtocol
 import pytest
 
-from services.llm.worker import Worker, TERMINATION_STRING
+from services.llm.worker import Worker, BatchedWorker, ConcurrentWorker, TERMINATION_STRING
+from cache.notifications import prompt_handle_channel, PROMPT_HANDLE_FINISHED
+from cache.token_streams import decode_frame, encode_frame, token_stream_channel, token_stream_key, TokenFrame
 from services.llm.prompts import prepend_system_prompt
 from tests.assertions import assert_model_params_equal
 from services.llm.supported_models import LLMModel
+from services.llm.rate_limiter import RateLimiter
 from services.llm.llm import LLMService
 import config.settings as settings
 from db.models import PromptHandle
+from llms.batching import SequenceOutput
 from llms.config import Params
 
 
@@ -20,6 +27,8 @@ def create_worker(
     llm_model_name
 ):
     def create_worker_func(service, mock_tokens, return_mock_generate_text=False, model_is_embedding_model=False):
+        # send every token on its own, rather than coalescing them
+        settings.get_settings().LLM_WORKER_TOKEN_FLUSH_INTERVAL_MS = 0
         mock_generate_text = create_mock_generate_text_streaming(mock_tokens)
         mock_compute_embedding = create_mock_compute_embedding(mock_tokens)
         worker = Worker(
@@ -47,14 +56,15 @@ async def test_worker_will_poll_the_llm_service_every_50_milliseconds_for_next_h
     mock_tokens = ['some', ' ', 'tokens']
 
     service_mock = mocker.Mock(spec=LLMService)
-    has_next_side_effects = [False, False, False, True]
-    service_mock.has_next.side_effect = lambda: has_next_side_effects.pop(0) if has_next_side_effects else False
+    handle = mocker.Mock(spec=PromptHandle)
+    claim_side_effects = [[], [], [], [handle]]
+    service_mock.claim.side_effect = lambda limit: claim_side_effects.pop(0) if claim_side_effects else []
 
     sleep_mock = mocker.patch(
         'asyncio.sleep',
-        side_effect=lambda _: worker.stop() if not has_next_side_effects else None
+        side_effect=lambda _: worker.stop() if not claim_side_effects else None
     )
-    mocker.patch('services.llm.worker.Worker.process_prompt_handle')
+    process_mock = mocker.patch('services.llm.worker.Worker.process_prompt_handle')
 
     worker = create_worker(service_mock, mock_tokens)
     await worker.run()
@@ -63,8 +73,8 @@ async def test_worker_will_poll_the_llm_service_every_50_milliseconds_for_next_h
     expected_calls = [call(0.05) for _ in range(sleep_mock.call_count)]
     sleep_mock.assert_has_calls(expected_calls, any_order=False)
 
-    # This should have been called once as the side effects specify the last call being true
-    service_mock.checkout.assert_called_once()
+    # This should have been called once as the side effects specify the last claim returning a handle
+    process_mock.assert_called_once_with(handle)
 
 
 @pytest.mark.asyncio
@@ -266,3 +276,550 @@ async def test_embedding_models_save_the_vector_embedding_instead_of_text_respon
     handle.refresh()
     assert handle.response is None
     assert handle.embedding == vector
+
+
+class FakeBatchingEngine:
+    def __init__(self, tokens_per_sequence: dict):
+        self.tokens_per_sequence = tokens_per_sequence
+        self.sequences = {}
+        self.max_batch_size = 2
+
+    def add_sequence(self, sequence_id, params, prompt):
+        self.sequences[sequence_id] = list(self.tokens_per_sequence[prompt])
+
+    def retire_sequence(self, sequence_id):
+        self.sequences.pop(sequence_id, None)
+
+    def free_slots(self):
+        return self.max_batch_size - len(self.sequences)
+
+    def has_capacity(self):
+        return self.free_slots() > 0
+
+    def has_unfinished_sequences(self):
+        return len(self.sequences) > 0
+
+    def step(self):
+        outputs = []
+        for sequence_id in list(self.sequences.keys()):
+            token = self.sequences[sequence_id].pop(0)
+            finished = len(self.sequences[sequence_id]) == 0
+            if finished:
+                del self.sequences[sequence_id]
+            outputs.append(SequenceOutput(sequence_id, token, finished))
+        return outputs
+
+
+@pytest.fixture
+def create_batched_worker(mocker, mock_load_hf_model, llm_model_name):
+    def create_batched_worker_func(service, tokens_per_prompt: dict):
+        settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS = False
+        settings.get_settings().LLM_WORKER_TOKEN_FLUSH_INTERVAL_MS = 0
+        websockets = {}
+
+        async def connect(url):
+            websockets[url] = AsyncMock(spec=WebSocketClientProtocol)
+            return websockets[url]
+
+        mocker.patch('websockets.connect', side_effect=connect)
+
+        engine = FakeBatchingEngine(tokens_per_prompt)
+        worker = BatchedWorker(
+            llm_service=service,
+            llm_model_name=llm_model_name,
+            device='cuda',
+            max_batch_size=2,
+            model_loader_func=mock_load_hf_model,
+            engine_factory=lambda model, tokenizer, device, max_batch_size: engine,
+        )
+        return worker, websockets
+
+    return create_batched_worker_func
+
+
+def _websocket_url(handle: PromptHandle) -> str:
+    return f"ws://{settings.get_settings().HOST}:{settings.get_settings().PORT}{handle.websocket_uri}"
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_streams_the_tokens_of_each_handle_to_its_own_websocket(
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handle_1 = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle_1.save()
+    handle_2 = PromptHandle(prompt="what is life?", llm_model_name=llm_model_name)
+    handle_2.save()
+
+    worker, websockets = create_batched_worker(service, {
+        prepend_system_prompt('', handle_1.prompt): ['baby', ' ', 'don\'t', ' ', 'hurt', ' ', 'me'],
+        prepend_system_prompt('', handle_2.prompt): ['42'],
+    })
+    await worker.admit_prompt_handle(handle_1)
+    await worker.admit_prompt_handle(handle_2)
+    while worker.engine.has_unfinished_sequences():
+        await worker.step()
+
+    websocket_1 = websockets[_websocket_url(handle_1)]
+    websocket_2 = websockets[_websocket_url(handle_2)]
+    assert [c.args[0] for c in websocket_1.send.call_args_list] == [
+        'baby', ' ', 'don\'t', ' ', 'hurt', ' ', 'me', TERMINATION_STRING
+    ]
+    assert [c.args[0] for c in websocket_2.send.call_args_list] == ['42', TERMINATION_STRING]
+
+    handle_1.refresh()
+    handle_2.refresh()
+    assert handle_1.state == PromptHandle.States.FINISHED
+    assert handle_1.response == "baby don't hurt me"
+    assert handle_1.response_length == 7
+    assert handle_2.state == PromptHandle.States.FINISHED
+    assert handle_2.response == "42"
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_admits_pending_handles_until_the_batch_is_full(
+    mocker,
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handles = []
+    for prompt in ['one', 'two', 'three']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=llm_model_name)
+        handle.save()
+        handles.append(handle)
+
+    worker, _ = create_batched_worker(service, {
+        prepend_system_prompt('', 'one'): ['1', '1', '1'],
+        prepend_system_prompt('', 'two'): ['2'],
+        prepend_system_prompt('', 'three'): ['3'],
+    })
+
+    await worker._admit_pending_prompt_handles()
+    assert set(worker.streams.keys()) == {handles[0].id, handles[1].id}
+
+    # the second handle finishes after one step which frees up room for the third
+    await worker.step()
+    await worker._admit_pending_prompt_handles()
+    assert set(worker.streams.keys()) == {handles[0].id, handles[2].id}
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_fails_a_handle_that_cannot_be_admitted_and_admits_the_rest(
+    mocker,
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handles = []
+    for prompt in ['one', 'two']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=llm_model_name)
+        handle.save()
+        handles.append(handle)
+
+    # the fake engine fails to add a sequence for a prompt it has no tokens for
+    worker, websockets = create_batched_worker(service, {
+        prepend_system_prompt('', 'two'): ['2'],
+    })
+
+    await worker._admit_pending_prompt_handles()
+
+    handles[0].refresh()
+    assert handles[0].state == PromptHandle.States.FAILED
+    assert set(worker.streams.keys()) == {handles[1].id}
+    websockets[_websocket_url(handles[0])].close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_worker_publishes_a_notification_when_handle_is_finished(
+    redis_connection,
+    create_worker,
+    create_websocket_mocks,
+    llm_model_name
+):
+    create_websocket_mocks()
+    mock_tokens = ['baby', ' ', 'don', '\'', 't', ' ', 'hurt', ' ', 'me']
+
+    service = LLMService(llm_model_name, redis_connection)
+    handle = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle.save()
+
+    worker = create_worker(service, mock_tokens)
+    await worker.process_prompt_handle(handle)
+
+    redis_connection.publish.assert_awaited_once_with(prompt_handle_channel(handle.id), PROMPT_HANDLE_FINISHED)
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker_computes_the_embeddings_of_many_handles_in_one_batch(
+    mocker,
+    redis_connection,
+    mock_load_hf_model,
+):
+    embedding_model = LLMModel.SALESFORCE_SFR_EMBEDDING_MISTRAL
+    service = LLMService(embedding_model, redis_connection)
+
+    handles = []
+    for prompt in ['one', 'two', 'three']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=embedding_model)
+        handle.save()
+        handles.append(handle)
+
+    async def batch_embedding_function(model, tokenizer, texts, batch_size):
+        return [[float(len(text))] for text in texts]
+
+    batch_embedding_mock = AsyncMock(side_effect=batch_embedding_function)
+    worker = Worker(
+        llm_service=service,
+        llm_model_name=embedding_model,
+        device='cpu',
+        model_loader_func=mock_load_hf_model,
+        batch_embedding_function=batch_embedding_mock,
+        embedding_batch_size=2,
+        embedding_claim_size=4,
+    )
+    mocker.patch('asyncio.sleep', side_effect=lambda _: worker.stop())
+
+    await worker.run()
+
+    # more handles are claimed than fit in one batch, the embedding function splits them into batches
+    batch_embedding_mock.assert_awaited_once()
+    assert batch_embedding_mock.call_args.args[2] == ['one', 'two', 'three']
+    assert batch_embedding_mock.call_args.args[3] == 2
+
+    for handle in handles:
+        handle.refresh()
+        assert handle.state == PromptHandle.States.FINISHED
+        assert handle.embedding == [float(len(handle.prompt))]
+    assert redis_connection.publish.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_concurrent_worker_keeps_several_handles_in_flight(
+    mocker,
+    redis_connection,
+    mock_load_hf_model,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handles = []
+    for prompt in ['one', 'two', 'three']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=llm_model_name)
+        handle.save()
+        handles.append(handle)
+
+    rate_limiter = mocker.Mock(spec=RateLimiter)
+    worker = ConcurrentWorker(
+        llm_service=service,
+        llm_model_name=llm_model_name,
+        device='python-api',
+        max_concurrent_requests=2,
+        rate_limiter=rate_limiter,
+        model_loader_func=mock_load_hf_model,
+        token_counter=len,
+    )
+
+    in_flight = 0
+    most_in_flight_at_once = 0
+
+    async def process_prompt_handle(handle):
+        nonlocal in_flight, most_in_flight_at_once
+        in_flight += 1
+        most_in_flight_at_once = max(most_in_flight_at_once, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if handle.id == handles[-1].id:
+            worker.stop()
+
+    mocker.patch.object(worker, 'process_prompt_handle', side_effect=process_prompt_handle)
+
+    await worker.run()
+
+    assert most_in_flight_at_once == 2
+    assert worker.process_prompt_handle.await_count == 3
+    rate_limiter.acquire.assert_any_await(len('one') + Params().max_new_tokens)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_worker_embeds_a_batch_of_handles_per_request(
+    mocker,
+    redis_connection,
+    mock_load_hf_model,
+):
+    embedding_model = LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE
+    service = LLMService(embedding_model, redis_connection)
+    handles = []
+    for prompt in ['one', 'two', 'three', 'four', 'five']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=embedding_model)
+        handle.save()
+        handles.append(handle)
+
+    async def batch_embedding_function(model, tokenizer, texts, batch_size, rate_limiter):
+        return [[float(len(text))] for text in texts]
+
+    batch_embedding_mock = AsyncMock(side_effect=batch_embedding_function)
+    rate_limiter = mocker.Mock(spec=RateLimiter)
+    worker = ConcurrentWorker(
+        llm_service=service,
+        llm_model_name=embedding_model,
+        device='python-api',
+        max_concurrent_requests=2,
+        rate_limiter=rate_limiter,
+        model_loader_func=mock_load_hf_model,
+        batch_embedding_function=batch_embedding_mock,
+        embedding_batch_size=2,
+        token_counter=len,
+    )
+    original_claim = worker._claim_requests
+
+    def claim_requests_and_stop_when_empty(free_slots):
+        requests = original_claim(free_slots)
+        if len(requests) == 0:
+            worker.stop()
+        return requests
+
+    mocker.patch.object(worker, '_claim_requests', side_effect=claim_requests_and_stop_when_empty)
+
+    await worker.run()
+
+    assert [c.args[2] for c in batch_embedding_mock.call_args_list] == [['one', 'two'], ['three', 'four'], ['five']]
+    # the batch embedding function passes the rate limiter for every request it sends
+    assert all(c.kwargs['rate_limiter'] is rate_limiter for c in batch_embedding_mock.call_args_list)
+    rate_limiter.acquire.assert_not_awaited()
+    for handle in handles:
+        handle.refresh()
+        assert handle.state == PromptHandle.States.FINISHED
+        assert handle.embedding == [float(len(handle.prompt))]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_worker_marks_the_handles_of_a_failed_request_as_failed(
+    mocker,
+    redis_connection,
+    mock_load_hf_model,
+):
+    embedding_model = LLMModel.OPENAI_TEXT_EMBEDDING_3_LARGE
+    service = LLMService(embedding_model, redis_connection)
+    handles = []
+    for prompt in ['one', 'two']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=embedding_model)
+        handle.save()
+        handles.append(handle)
+
+    worker = ConcurrentWorker(
+        llm_service=service,
+        llm_model_name=embedding_model,
+        device='python-api',
+        max_concurrent_requests=1,
+        rate_limiter=mocker.Mock(spec=RateLimiter),
+        model_loader_func=mock_load_hf_model,
+        batch_embedding_function=AsyncMock(side_effect=Exception("the api is unavailable")),
+        embedding_batch_size=2,
+        token_counter=len,
+    )
+
+    await worker._process_rate_limited_request(handles)
+
+    for handle in handles:
+        handle.refresh()
+        assert handle.state == PromptHandle.States.FAILED
+        redis_connection.publish.assert_any_await(prompt_handle_channel(handle.id), PROMPT_HANDLE_FINISHED)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_worker_ends_the_token_stream_of_a_failed_handle(
+    mocker,
+    redis_connection,
+    mock_load_hf_model,
+    llm_model_name
+):
+    settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS = True
+    service = LLMService(llm_model_name, redis_connection)
+    handle = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle.save()
+
+    worker = ConcurrentWorker(
+        llm_service=service,
+        llm_model_name=llm_model_name,
+        device='python-api',
+        max_concurrent_requests=1,
+        rate_limiter=mocker.Mock(spec=RateLimiter),
+        model_loader_func=mock_load_hf_model,
+        token_counter=len,
+    )
+    mocker.patch.object(worker, 'process_prompt_handle', side_effect=Exception("the api is unavailable"))
+    redis_connection.xrevrange.return_value = [
+        ('1-0', {'frame': encode_frame(TokenFrame(2, ' world', offset=5))}),
+    ]
+
+    await worker._process_rate_limited_request([handle])
+
+    handle.refresh()
+    assert handle.state == PromptHandle.States.FAILED
+    assert _published_frames(redis_connection, handle) == [(3, '', True)]
+    assert decode_frame(redis_connection.publish.call_args_list[0].args[1]).offset == 11
+
+
+@pytest.mark.asyncio
+async def test_worker_fails_a_claimed_handle_it_fails_to_process(
+    mocker,
+    redis_connection,
+    create_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handle = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle.save()
+
+    worker = create_worker(service, ['baby'])
+
+    async def process_prompt_handle(handle):
+        worker.stop()
+        raise Exception("the model crashed")
+
+    mocker.patch.object(worker, 'process_prompt_handle', side_effect=process_prompt_handle)
+
+    await worker.run()
+
+    handle.refresh()
+    assert handle.state == PromptHandle.States.FAILED
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_fails_every_handle_in_the_batch_when_a_step_fails(
+    mocker,
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handles = []
+    for prompt in ['one', 'two']:
+        handle = PromptHandle(prompt=prompt, llm_model_name=llm_model_name)
+        handle.save()
+        handles.append(handle)
+
+    worker, websockets = create_batched_worker(service, {
+        prepend_system_prompt('', 'one'): ['1', '1'],
+        prepend_system_prompt('', 'two'): ['2', '2'],
+    })
+
+    def step():
+        worker.stop()
+        raise RuntimeError("CUDA out of memory")
+
+    mocker.patch.object(worker.engine, 'step', side_effect=step)
+
+    await worker.run()
+
+    assert worker.streams == {}
+    assert not worker.engine.has_unfinished_sequences()
+    for handle in handles:
+        handle.refresh()
+        assert handle.state == PromptHandle.States.FAILED
+        websockets[_websocket_url(handle)].close.assert_awaited_once()
+
+
+def _published_frames(redis_connection, handle: PromptHandle) -> list:
+    channel = token_stream_channel(handle.websocket_uri)
+    frames = [decode_frame(c.args[1]) for c in redis_connection.publish.call_args_list if c.args[0] == channel]
+    return [(frame.seq, frame.text, frame.end) for frame in frames]
+
+
+@pytest.mark.asyncio
+async def test_worker_publishes_the_tokens_to_the_token_stream_of_the_handle(
+    mocker,
+    redis_connection,
+    create_worker,
+    llm_model_name
+):
+    connect = mocker.patch('websockets.connect')
+    service = LLMService(llm_model_name, redis_connection)
+    handle = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle.save()
+
+    worker = create_worker(service, ['baby', ' ', 'don\'t'])
+    await worker.process_prompt_handle(handle)
+
+    connect.assert_not_called()
+    assert _published_frames(redis_connection, handle) == [
+        (1, 'baby', False),
+        (2, ' ', False),
+        (3, 'don\'t', False),
+        (4, '', True),
+    ]
+    handle.refresh()
+    assert handle.response == "baby don't"
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_publishes_the_tokens_of_each_handle_to_its_own_token_stream(
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handle_1 = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle_1.save()
+    handle_2 = PromptHandle(prompt="what is life?", llm_model_name=llm_model_name)
+    handle_2.save()
+
+    worker, websockets = create_batched_worker(service, {
+        prepend_system_prompt('', handle_1.prompt): ['baby', ' ', 'don\'t'],
+        prepend_system_prompt('', handle_2.prompt): ['42'],
+    })
+    settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS = True
+    await worker.admit_prompt_handle(handle_1)
+    await worker.admit_prompt_handle(handle_2)
+    while worker.engine.has_unfinished_sequences():
+        await worker.step()
+
+    assert websockets == {}
+    assert _published_frames(redis_connection, handle_1) == [
+        (1, 'baby', False),
+        (2, ' ', False),
+        (3, 'don\'t', False),
+        (4, '', True),
+    ]
+    assert _published_frames(redis_connection, handle_2) == [(1, '42', False), (2, '', True)]
+
+
+@pytest.mark.asyncio
+async def test_batched_worker_fails_only_the_handle_whose_token_stream_errors(
+    redis_connection,
+    create_batched_worker,
+    llm_model_name
+):
+    service = LLMService(llm_model_name, redis_connection)
+    handle_1 = PromptHandle(prompt="what is love?", llm_model_name=llm_model_name)
+    handle_1.save()
+    handle_2 = PromptHandle(prompt="what is life?", llm_model_name=llm_model_name)
+    handle_2.save()
+
+    worker, _ = create_batched_worker(service, {
+        prepend_system_prompt('', handle_1.prompt): ['baby', ' ', 'don\'t'],
+        prepend_system_prompt('', handle_2.prompt): ['4', '2'],
+    })
+    settings.get_settings().LLM_WORKER_PUBLISH_TOKENS_TO_REDIS = True
+
+    async def xadd(key, fields):
+        if key == token_stream_key(handle_1.websocket_uri):
+            raise RedisConnectionError()
+
+    redis_connection.xadd.side_effect = xadd
+
+    await worker.admit_prompt_handle(handle_1)
+    await worker.admit_prompt_handle(handle_2)
+    while worker.engine.has_unfinished_sequences():
+        await worker.step()
+
+    handle_1.refresh()
+    handle_2.refresh()
+    assert handle_1.state == PromptHandle.States.FAILED
+    assert handle_2.state == PromptHandle.States.FINISHED
+    assert handle_2.response == "42"
+    redis_connection.publish.assert_any_await(prompt_handle_channel(handle_1.id), PROMPT_HANDLE_FINISHED)